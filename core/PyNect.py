@@ -1,3 +1,5 @@
+import logging
+
 import cv2 as open_cv
 from pylibfreenect2 import Freenect2
 from pylibfreenect2 import createConsoleLogger, setGlobalLogger
@@ -12,10 +14,14 @@ from core import open_message_dialog
 from core.util import call_by_ws, config as c, check_if_folder_exist, check_if_is_project
 from core.util.config import logger, nect_config, purge_option_config
 from core.util.constants import OPEN_PROJECTS, P_PATH, ERROR_ICON, I18N_MODALITY, I18N_FRAMES, CONFIG, CALIBRATION_PATH, \
-    F_RGB, F_IR
+    F_RGB, F_IR, REFRESH_RATE, WR_EVENT, STATS_LOG_MS
 from core.util.language_resource import i18n
+from core.models.pipeline import PipelineManager
+from core.models.replay import replay_serials, is_replay_serial
+from core.models.writer import WriterPool
 from core.controllers.controller import MenuController, Controller, TreeController, \
     SensorController, SelectedFileController, SelectedProjectController, ProjectActionController
+from core.views.scheduler import DisplayScheduler
 from core.views.view import MenuBar, View, ProjectTreeView, SensorView, ScrollWrapperView, \
     SelectedFileView, ProjectInfoView, ProjectActionView
 
@@ -43,11 +49,23 @@ class PyNect(tk.Tk):
         self.selected_project = None
 
         self.__check_devices()
+        self.pipelines = PipelineManager(self.fn)
         self.__recover_model()
         self.__create_style()
+        # created before the gui, every preview registers to it
+        self.display = DisplayScheduler(self, nect_config[CONFIG][REFRESH_RATE])
+        # pictures are encoded and written off the tk thread
+        self.writer = WriterPool(self)
         self.__create_gui()
         self.__create_controllers()
         self.__bind_controllers()
+        self.display.start()
+        self.writer.start()
+        if logger.isEnabledFor(logging.DEBUG):
+            self.after(STATS_LOG_MS, self.__log_stats)
+        # the first start benchmark does not hold the gui, devices use the fallback pipeline until it is over
+        self.pipelines.select_async(self, [serial for serial in self.devices if not is_replay_serial(serial)],
+                                    self.__pipelines_selected)
 
         logger.debug("make opencv use only 1 thread")
         open_cv.setNumThreads(1)  # since OpenCV 4.1.2
@@ -62,13 +80,14 @@ class PyNect(tk.Tk):
         controller.bind(view)
 
     def has_connected_device(self) -> bool:
-        logger.debug(f"enumerate kinect devices")
-        return self.fn.enumerateDevices() != 0
+        return len(self.devices) != 0
 
     def __check_devices(self):
-        logger.debug(f"check connected devices")
+        logger.debug(f"enumerate kinect devices")
+        self.devices = [self.fn.getDeviceSerialNumber(i).decode('utf-8') for i in range(self.fn.enumerateDevices())]
+        # recorded sessions are listed as virtual devices
+        self.devices += replay_serials()
         if self.has_connected_device():
-            self.devices = [self.fn.getDeviceSerialNumber(i).decode('utf-8') for i in range(self.fn.enumerateDevices())]
             logger.debug(f"connected devices {self.devices}")
         else:
             logger.debug(f"no device connected")
@@ -181,6 +200,22 @@ class PyNect(tk.Tk):
         self.bind("<<selected_project>>", self.select_project)
         logger.debug("attach virtual event controllers for <<selected_file>>")
         self.bind("<<selected_file>>", self.select_file)
+        logger.debug(f"attach virtual event controllers for {WR_EVENT}")
+        self.bind(WR_EVENT, lambda event: self.sensor_controller.writes_done())
+
+    def __log_stats(self):
+        logger.debug(f"display scheduler: {self.display.ticks} ticks, {self.display.skipped} skipped, "
+                     f"{self.display.stats()}")
+        logger.debug(f"writer pool: {self.writer.stats()}")
+        device = self.kinect.selected_device()
+        if device is not None and device.opened():
+            logger.debug(f"preview frames of {device.serial()}: {device.frame_stats()}")
+        self.after(STATS_LOG_MS, self.__log_stats)
+
+    def __pipelines_selected(self, winner):
+        logger.debug(f"pipeline benchmark over, {winner} selected")
+        if winner is not None:
+            open_message_dialog(self, "pipeline_selected", extra=self.pipelines.report())
 
     def select_project(self, event):
         path = self.tree_controller.get_last_selected_project()
@@ -206,8 +241,15 @@ class PyNect(tk.Tk):
         else:
             return
 
+    def calibrate(self, serial):
+        self.sensor_controller.calibration(serial)
+
+    def toggle_recording(self):
+        self.sensor_controller.toggle_recording()
+
     def update_fps(self):
-        pass
+        logger.debug(f"update fps to {nect_config[CONFIG][REFRESH_RATE]} ms")
+        self.display.set_interval(nect_config[CONFIG][REFRESH_RATE])
 
     def update_app_language(self):
         logger.debug("update app language")
@@ -16,11 +16,12 @@ def open_error_dialog(master, missing, icon=ERROR_ICON):
                   icon=icon).show()
 
 
-def open_message_dialog(master, message, icon=INFORMATION_ICON):
+def open_message_dialog(master, message, icon=INFORMATION_ICON, extra=None):
+    # extra is appended to the detail of the message
     logger.debug(f"open project_{message} dialog")
     data = i18n.project_message[message]
     DialogMessage(master=master,
                   title=data[I18N_TITLE],
                   message=data[I18N_MESSAGE],
-                  detail=data[I18N_DETAIL],
+                  detail=data[I18N_DETAIL] if not extra else data[I18N_DETAIL] + "\n" + extra,
                   icon=icon).show()
@@ -1,93 +1,663 @@
 # single Kinect v2 camera calibration (RGB or IR)
+import multiprocessing
+import os
+import queue
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import numpy as np
 import cv2
-import shelve
-import os
-from glob import glob
+import numpy as np
+
+from core.models.calibration_store import calibration_store, image_hash
+from core.util.config import logger, nect_config, PATTERN_SIZE_PARSED
+from core.util.constants import *
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+CALIBRATE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 120, 0.001)
+# the fast check rejects images without a board before the expensive quad search
+CB_SEARCH_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+
+
+def pyramid_level(img, max_side=CB_PYRAMID_MAX_SIDE):
+    # halves the image until its long side fits max_side: (level, scale from level to full resolution)
+    scale = 1
+    level = img
+    while max(level.shape[:2]) > max_side:
+        level = cv2.pyrDown(level)
+        scale *= 2
+    return level, scale
+
+
+def usable_guess(camera_matrix, image_size):
+    # a starting point the solver accepts: positive focal lengths and the principal point inside the image
+    if camera_matrix is None:
+        return False
+    fx, fy, cx, cy = camera_matrix[0, 0], camera_matrix[1, 1], camera_matrix[0, 2], camera_matrix[1, 2]
+    return fx > 0 and fy > 0 and 0 <= cx < image_size[0] and 0 <= cy < image_size[1]
+
+
+def detect_corners(path, pattern_size, max_side=CB_PYRAMID_MAX_SIDE):
+    # runs in a worker process: (path, image size, corners or None, seconds spent in each stage).
+    # the board is searched on a pyramid level, frames without it are rejected there, and only the corners found
+    # are refined at full resolution
+    cv2.setNumThreads(1)
+    timings = {}
+    start = time.perf_counter()
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    timings[CB_STAGE_LOAD] = time.perf_counter() - start
+    if img is None:
+        return path, None, None, timings
+    h, w = img.shape[:2]
+    start = time.perf_counter()
+    level, scale = pyramid_level(img, max_side)
+    timings[CB_STAGE_PYRAMID] = time.perf_counter() - start
+    start = time.perf_counter()
+    found, corners = cv2.findChessboardCorners(level, tuple(pattern_size), flags=CB_SEARCH_FLAGS)
+    timings[CB_STAGE_SEARCH] = time.perf_counter() - start
+    if not found:
+        return path, (w, h), None, timings
+    start = time.perf_counter()
+    # pyrDown keeps the even pixels, a pixel of a level is at twice its position on the level below
+    corners = corners * scale
+    # the window never reaches half a square, where it would take in the neighbour corners
+    board = corners.reshape(pattern_size[1], pattern_size[0], 2)
+    square = min(np.linalg.norm(np.diff(board, axis=0), axis=2).min(),
+                 np.linalg.norm(np.diff(board, axis=1), axis=2).min())
+    limit = max(2, int(square / 2) - 1)
+    # the first window covers the error of the coarse corners, up to a pixel of the level
+    win = min(limit, CB_SUBPIX_WIN + scale - 1)
+    coarse = corners.copy()
+    cv2.cornerSubPix(img, corners, (win, win), (-1, -1), SUBPIX_CRITERIA)
+    if scale > 1:
+        # the second one covers how far the first pass actually moved the corners
+        residual = float(np.abs(corners - coarse).max())
+        win = min(limit, CB_SUBPIX_WIN + int(np.ceil(residual)))
+        cv2.cornerSubPix(img, corners, (win, win), (-1, -1), SUBPIX_CRITERIA)
+    timings[CB_STAGE_REFINE] = time.perf_counter() - start
+    return path, (w, h), corners.reshape(-1, 2), timings
+
+
+def pose_features(corners, image_size, pattern_size):
+    # board center, size and tilt in the picture, tilts count double as they are what constrains the focal length
+    columns, rows = pattern_size
+    board = np.asarray(corners, dtype=np.float64).reshape(rows, columns, 2) / image_size
+    center = board.reshape(-1, 2).mean(axis=0)
+    diagonal = np.linalg.norm(board[-1, -1] - board[0, 0])
+    top, bottom = board[0, -1] - board[0, 0], board[-1, -1] - board[-1, 0]
+    left, right = board[-1, 0] - board[0, 0], board[-1, -1] - board[0, -1]
+    horizontal = np.log(np.linalg.norm(top) / max(np.linalg.norm(bottom), 1e-6))
+    vertical = np.log(np.linalg.norm(left) / max(np.linalg.norm(right), 1e-6))
+    return np.array([center[0], center[1], diagonal, 2 * horizontal, 2 * vertical])
+
+
+def rank_frames(img_points, image_size, pattern_size, grid=CALIB_COVERAGE_GRID):
+    # indices of the pictures from the most to the least informative. greedy: the next one is the picture adding the
+    # most image cells not covered yet plus the farthest pose from the ones already taken
+    features = np.array([pose_features(points, image_size, pattern_size) for points in img_points])
+    cells = []
+    for points in img_points:
+        hit = np.clip((np.asarray(points).reshape(-1, 2) / image_size * grid).astype(int), 0, np.array(grid) - 1)
+        cells.append(set(map(tuple, hit)))
+    covered = set()
+    distance = np.full(len(img_points), np.inf)
+    remaining = list(range(len(img_points)))
+    order = []
+    while remaining:
+        gain = np.array([len(cells[i] - covered) for i in remaining]) / (grid[0] * grid[1])
+        diversity = np.where(np.isinf(distance[remaining]), 0, distance[remaining])
+        best = remaining[int(np.argmax(gain + diversity))]
+        order.append(best)
+        remaining.remove(best)
+        covered |= cells[best]
+        distance = np.minimum(distance, np.linalg.norm(features - features[best], axis=1))
+    return order
+
+
+def outlier_views(errors, k=CALIB_OUTLIER_MAD, min_error=CALIB_OUTLIER_MIN_ERROR):
+    # indices of the views whose reprojection error is far above the others
+    errors = np.asarray(errors)
+    median = np.median(errors)
+    mad = 1.4826 * np.median(np.abs(errors - median))
+    return np.flatnonzero((errors > median + k * mad) & (errors > min_error))
+
+
+class CalibrationResult:
+
+    def __init__(self, rms, camera_matrix, dist_coefs, image_size, used, rejected, errors):
+        self.rms = rms
+        self.camera_matrix = camera_matrix
+        self.dist_coefs = dist_coefs
+        self.image_size = image_size
+        # image paths the calibration was solved from, and {path: reason} of the ones discarded
+        self.used = used
+        self.rejected = rejected
+        # reprojection error of each used image
+        self.errors = errors
 
 
 class Calibrator(ABC):
+    # calibration of one camera of a device from the pictures saved in its calibration folder. corners are detected
+    # in a process pool and cached in the calibration store by image content, visualization is off unless show is set
+
+    def __init__(self, serial, pattern_size=PATTERN_SIZE_PARSED, square_size=None, workers=None, show=False,
+                 max_frames=None):
+        self.serial = serial
+        self.pattern_size = tuple(pattern_size)
+        if square_size is None:
+            square_size = nect_config.getfloat(CALIBRATION, SQUARE_SIZE, fallback=SQUARE_SIZE_DEFAULT)
+        self.square_size = square_size
+        if max_frames is None:
+            max_frames = nect_config.getint(CALIBRATION, MAX_FRAMES, fallback=MAX_FRAMES_DEFAULT)
+        self.max_frames = max_frames
+        self.workers = workers or os.cpu_count() or 1
+        self.show = show
+        self.folder = Path(nect_config[CONFIG][CALIBRATION_PATH]) / serial
+        self.store = calibration_store(serial)
+        # stage -> seconds per frame of the last detection
+        self.timings = {}
+
+    @property
     @abstractmethod
-    def check(self):
+    def images_folder(self) -> Path:
         raise NotImplementedError
 
+    @property
+    @abstractmethod
+    def camera(self) -> str:
+        raise NotImplementedError
 
-class RGBCameraCalibrator(Calibrator):
+    def images(self):
+        return sorted(self.images_folder.glob("*.jpg"))
 
     def check(self):
-        return
-
-    def get_intrinsic_camera(self, serial):
-        return
-
-
-'''
-isRGB = True
-
-if isRGB:
-    img_names = const.rgbFolder.glob('*.jpg')
-    CAMERA_PATH = str(const.rgbCameraIntrinsic.resolve())
-else:
-    img_names = const.irFolder.glob('*.jpg')
-    CAMERA_PATH = str(const.irCameraIntrinsic.resolve())
-# create object points
-pattern_points = np.zeros((np.prod(const.pattern_size), 3), np.float32)
-pattern_points[:, :2] = np.indices(const.pattern_size).T.reshape(-1, 2)
-pattern_points *= const.square_size
-# print(pattern_points)
-
-obj_points = []
-img_points = []
-h, w = 0, 0
-for fn in img_names:
-    print(f'processing {fn}...')
-    img = cv2.imread(str(fn.resolve()), 0)
-    if img is None:
-        print("Failed to load", fn)
-        continue
+        # something to calibrate from
+        return len(self.images()) > 0
 
-    h, w = img.shape[:2]
-    found, corners = cv2.findChessboardCorners(img, const.pattern_size, flags=cv2.CALIB_CB_ADAPTIVE_THRESH)
-    if found:
-        cv2.cornerSubPix(img, corners, (5, 5), (-1, -1),
-                         (cv2.TERM_CRITERIA_EPS +
-                          cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
-        # Draw and display the corners
-        cv2.drawChessboardCorners(img, (6, 8), corners, found)
-        cv2.imshow('img', img)
-        cv2.waitKey(500)
-    if not found:
-        print('chessboard not found')
-        continue
-
-    img_points.append(corners.reshape(-1, 2))
-    obj_points.append(pattern_points)
-
-    # save img_points for future stereo calibration
-    img_file = shelve.open(os.path.splitext(fn)[0]+".dat", 'n')
-    img_file['img_points'] = corners.reshape(-1, 2)
-    img_file.close()
-
-    print('ok')
-
-rms, camera_matrix, dist_coefs, rvecs, tvecs = cv2.calibrateCamera(obj_points,
-                                                                   img_points,
-                                                                   (w, h),
-                                                                   None,
-                                                                   None,
-                                                                   criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 120, 0.001),
-                                                                   flags=0)
-
-# save calibration results
-camera_file = shelve.open(CAMERA_PATH, 'n')
-camera_file['camera_matrix'] = camera_matrix
-camera_file['dist_coefs'] = dist_coefs
-camera_file.close()
-
-print("RMS:", rms)
-print("camera matrix:\n", camera_matrix)
-print("distortion coefficients: ", dist_coefs.ravel())
-
-'''
+    def detect(self, progress=None):
+        # {path: (image size, corners or None, content hash)}, progress(done, total) is called from the calling thread
+        paths = [str(path.resolve()) for path in self.images()]
+        detections = {}
+        missing = {}
+        for path in paths:
+            digest = image_hash(path)
+            cached = self.store.corners(digest, self.camera, self.pattern_size)
+            if cached is None:
+                missing[path] = digest
+            else:
+                _, size, corners = cached
+                detections[path] = (size, corners, digest)
+        logger.debug(f"detect corners in {len(missing)} images of {self.images_folder} with {self.workers} workers, "
+                     f"{len(detections)} cached")
+        totals = {}
+        if missing:
+            # spawn, forking a process that runs capture threads is not safe
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(missing)),
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(detect_corners, path, self.pattern_size) for path in missing]
+                for done, future in enumerate(as_completed(futures), 1):
+                    path, size, corners, timings = future.result()
+                    detections[path] = (size, corners, missing[path])
+                    if size is not None:
+                        self.store.set_corners(missing[path], self.camera, Path(path).name, self.pattern_size, size,
+                                               corners)
+                    for stage, seconds in timings.items():
+                        totals[stage] = totals.get(stage, 0.0) + seconds
+                    if progress is not None:
+                        progress(len(detections), len(paths))
+            self.store.save()
+        self.timings = {stage: seconds / len(missing) for stage, seconds in totals.items()}
+        if self.timings:
+            logger.debug(f"corner detection of {self.images_folder}, ms per frame: " +
+                         ", ".join(f"{stage} {seconds * 1000:.1f}" for stage, seconds in self.timings.items()))
+        return detections
+
+    def report(self):
+        # ms per frame of each detection stage
+        return {stage: seconds * 1000 for stage, seconds in self.timings.items()}
+
+    def calibrate(self, progress=None, guess=None) -> CalibrationResult:
+        # guess (camera matrix, distortion coefficients) starts the solver from a previous estimate
+        detections = self.detect(progress)
+        if self.show:
+            self.show_corners(detections)
+        found = sorted(path for path, (_, corners, _) in detections.items() if corners is not None)
+        rejected = {path: CALIB_NO_BOARD for path, (_, corners, _) in detections.items() if corners is None}
+        for path in rejected:
+            logger.debug(f"chessboard not found in {path}")
+        if not found:
+            raise ValueError(f"chessboard not found in any image of {self.images_folder}")
+        image_size = detections[found[0]][0]
+        img_points = {path: np.asarray(detections[path][1], dtype=np.float32) for path in found}
+        # the most informative pictures first, the solver only sees max_frames of them
+        ranking = [found[i] for i in rank_frames([img_points[path] for path in found], image_size,
+                                                 self.pattern_size)]
+        used, spare = ranking[:self.max_frames], ranking[self.max_frames:]
+        rounds = 0
+        while True:
+            rms, camera_matrix, dist_coefs, errors = self.solve([img_points[path] for path in used], image_size,
+                                                                guess)
+            bad = outlier_views(errors) if rounds < CALIB_OUTLIER_ROUNDS else []
+            if len(bad) == 0 or len(used) - len(bad) < CALIB_MIN_FRAMES:
+                break
+            rounds += 1
+            for i in bad:
+                logger.debug(f"{used[i]} rejected, reprojection error {errors[i]:.3f}")
+                rejected[used[i]] = CALIB_OUTLIER
+            used = [path for i, path in enumerate(used) if i not in bad] + spare[:len(bad)]
+            spare = spare[len(bad):]
+            guess = (camera_matrix, dist_coefs)
+        for path in spare:
+            rejected[path] = CALIB_REDUNDANT
+        logger.info(f"{type(self).__name__} of {self.serial}: rms {rms}, {len(used)} images used, "
+                    f"{len(rejected)} rejected")
+        result = CalibrationResult(rms, camera_matrix, dist_coefs, image_size, used, rejected, errors)
+        self.save(result, detections)
+        return result
+
+    def solve(self, img_points, image_size, guess=None):
+        # (rms, camera matrix, distortion coefficients, reprojection error of each view)
+        obj_points = [self.store.object_points(self.pattern_size, self.square_size).astype(np.float32)] * len(
+            img_points)
+        camera_matrix, dist_coefs, flags = None, None, 0
+        if guess is not None and usable_guess(np.asarray(guess[0]), image_size):
+            camera_matrix, dist_coefs = (np.array(value, dtype=np.float64) for value in guess)
+            flags = cv2.CALIB_USE_INTRINSIC_GUESS
+        rms, camera_matrix, dist_coefs, _, _, _, _, errors = cv2.calibrateCameraExtended(
+            obj_points, img_points, image_size, camera_matrix, dist_coefs, criteria=CALIBRATE_CRITERIA, flags=flags)
+        return rms, camera_matrix, dist_coefs, errors.ravel()
+
+    def save(self, result: CalibrationResult, detections):
+        logger.debug(f"save {self.camera} calibration of {self.serial} to {self.store.path}")
+        for path, error in zip(result.used, result.errors):
+            self.store.set_error(detections[path][2], error)
+        chosen = [detections[path][2] for path in result.used]
+        self.store.set_camera(self.camera, result.camera_matrix, result.dist_coefs, result.rms, result.image_size,
+                              chosen)
+        self.store.set_selection(self.camera, chosen,
+                                 {detections[path][2]: reason for path, reason in result.rejected.items()})
+        self.store.save()
+
+    def show_corners(self, detections):
+        for path, (_, corners, _) in sorted(detections.items()):
+            img = cv2.imread(path)
+            if img is None:
+                continue
+            if corners is not None:
+                cv2.drawChessboardCorners(img, self.pattern_size,
+                                          np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2), True)
+            cv2.imshow("img", img)
+            cv2.waitKey(500)
+        cv2.destroyWindow("img")
+
+    def get_intrinsic_camera(self):
+        # saved (camera matrix, distortion coefficients), None if not calibrated
+        return self.store.camera(self.camera)
+
+
+class RGBCameraCalibrator(Calibrator):
+
+    @property
+    def images_folder(self) -> Path:
+        return self.folder / F_RGB
+
+    @property
+    def camera(self) -> str:
+        return CF_RGB
+
+
+class IRCameraCalibrator(Calibrator):
+
+    @property
+    def images_folder(self) -> Path:
+        return self.folder / F_IR
+
+    @property
+    def camera(self) -> str:
+        return CF_IR
+
+
+class StereoResult:
+
+    def __init__(self, rms, rotation, translation, used):
+        self.rms = rms
+        # from the ir to the color camera
+        self.rotation = rotation
+        self.translation = translation
+        # picture names taken by both cameras the extrinsics were solved from
+        self.used = used
+
+
+class StereoCalibrator:
+    # extrinsics between the ir and the color camera from the pictures both took at once (same name in the RGB and IR
+    # folders). the intrinsics of both cameras must be calibrated already, they are kept fixed
+
+    def __init__(self, serial, pattern_size=PATTERN_SIZE_PARSED, square_size=None, max_frames=None):
+        self.serial = serial
+        self.cameras = {CF_RGB: RGBCameraCalibrator(serial, pattern_size, square_size, max_frames=max_frames),
+                        CF_IR: IRCameraCalibrator(serial, pattern_size, square_size, max_frames=max_frames)}
+        self.store = self.cameras[CF_IR].store
+
+    def pairs(self):
+        # {picture name: {camera: (corners, content hash)}} of the pictures with the board found by both cameras
+        detections = {camera: {Path(path).name: (corners, digest) for path, (_, corners, digest) in
+                               calibrator.detect().items() if corners is not None}
+                      for camera, calibrator in self.cameras.items()}
+        return {name: {camera: detections[camera][name] for camera in self.cameras}
+                for name in sorted(detections[CF_IR]) if name in detections[CF_RGB]}
+
+    def calibrate(self) -> StereoResult:
+        ir, rgb = self.cameras[CF_IR], self.cameras[CF_RGB]
+        intrinsics = {camera: self.store.camera(camera) for camera in self.cameras}
+        if any(value is None for value in intrinsics.values()):
+            raise ValueError(f"rgb and ir cameras of {self.serial} must be calibrated before the stereo pair")
+        pairs = self.pairs()
+        if not pairs:
+            raise ValueError(f"no picture of {self.serial} with the chessboard seen by both cameras")
+        names = list(pairs)
+        ir_points = [np.asarray(pairs[name][CF_IR][0], dtype=np.float32) for name in names]
+        ir_size = tuple(self.store.camera_info(CF_IR)["size"])
+        names = [names[i] for i in rank_frames(ir_points, ir_size, ir.pattern_size)][:ir.max_frames]
+        obj_points = self.store.object_points(ir.pattern_size, ir.square_size).astype(np.float32)
+        (ir_camera, ir_dist), (rgb_camera, rgb_dist) = intrinsics[CF_IR], intrinsics[CF_RGB]
+        rms, _, _, _, _, rotation, translation, essential, fundamental = cv2.stereoCalibrate(
+            [obj_points] * len(names), [np.asarray(pairs[name][CF_IR][0], dtype=np.float32) for name in names],
+            [np.asarray(pairs[name][CF_RGB][0], dtype=np.float32) for name in names], ir_camera, ir_dist,
+            rgb_camera, rgb_dist, ir_size, flags=cv2.CALIB_FIX_INTRINSIC, criteria=CALIBRATE_CRITERIA)
+        logger.info(f"stereo calibration of {self.serial}: rms {rms}, {len(names)} pairs used, "
+                    f"baseline {np.linalg.norm(translation):.4f}")
+        self.store.set_stereo(rms, rotation, translation, essential, fundamental,
+                              [[pairs[name][CF_IR][1], pairs[name][CF_RGB][1]] for name in names])
+        self.store.save()
+        return StereoResult(rms, rotation, translation, names)
+
+
+class CalibrationEstimate:
+    # state of an incremental calibration after one solve
+
+    def __init__(self, frames, rms, camera_matrix, dist_coefs, std_intrinsics, coverage, poses, converged):
+        self.frames = frames
+        self.rms = rms
+        self.camera_matrix = camera_matrix
+        self.dist_coefs = dist_coefs
+        # standard deviation of fx, fy, cx, cy, k1, k2, p1, p2, k3
+        self.std_intrinsics = std_intrinsics
+        # corners seen in each cell of the image, and pose regions of the board captured
+        self.coverage = coverage
+        self.poses = poses
+        self.converged = converged
+
+    def relative_std(self):
+        # uncertainty of the focal lengths relative to their value
+        return float(np.max(self.std_intrinsics[:2] / np.diag(self.camera_matrix)[:2]))
+
+
+class IncrementalCalibrator:
+    # calibration of one camera solved again after every picture, starting from the previous estimate, so the last
+    # solve costs a few iterations. corners are cached in the calibration store, the final Calibrator finds them there
+
+    def __init__(self, serial, camera, pattern_size=PATTERN_SIZE_PARSED, square_size=None,
+                 grid=CALIB_COVERAGE_GRID):
+        self.serial = serial
+        self.camera = camera
+        self.pattern_size = tuple(pattern_size)
+        if square_size is None:
+            square_size = nect_config.getfloat(CALIBRATION, SQUARE_SIZE, fallback=SQUARE_SIZE_DEFAULT)
+        self.store = calibration_store(serial)
+        self._object_points = self.store.object_points(self.pattern_size, square_size).astype(np.float32)
+        self._img_points = []
+        self.image_size = None
+        self.grid = tuple(grid)
+        self.coverage = np.zeros((self.grid[1], self.grid[0]), dtype=np.int32)
+        self.poses = PoseCoverage(pattern_size=self.pattern_size)
+        self.estimate = None
+        self._stable = 0
+
+    def add(self, path):
+        # adds the picture at path, the new estimate or None if the board is not in it or pictures are still too few
+        path = str(path)
+        digest = image_hash(path)
+        cached = self.store.corners(digest, self.camera, self.pattern_size)
+        if cached is None:
+            _, size, corners, _ = detect_corners(path, self.pattern_size)
+            if size is None:
+                return None
+            self.store.set_corners(digest, self.camera, Path(path).name, self.pattern_size, size, corners)
+        else:
+            _, size, corners = cached
+        if corners is None:
+            logger.debug(f"chessboard not found in {path}")
+            return None
+        self.image_size = tuple(size)
+        corners = np.asarray(corners, dtype=np.float32)
+        self._img_points.append(corners)
+        self.__update_coverage(corners)
+        if len(self._img_points) < CALIB_MIN_FRAMES:
+            return None
+        return self.solve()
+
+    def __update_coverage(self, corners):
+        normalized = corners / self.image_size
+        cells = np.clip((normalized * self.grid).astype(int), 0, np.array(self.grid) - 1)
+        np.add.at(self.coverage, (cells[:, 1], cells[:, 0]), 1)
+        self.poses.add(normalized)
+
+    def solve(self):
+        camera_matrix, dist_coefs, flags = None, None, 0
+        # the first estimates from few pictures can be far off, the solver starts over from them if needed
+        if self.estimate is not None and usable_guess(self.estimate.camera_matrix, self.image_size):
+            camera_matrix, dist_coefs = self.estimate.camera_matrix.copy(), self.estimate.dist_coefs.copy()
+            flags = cv2.CALIB_USE_INTRINSIC_GUESS
+        start = time.perf_counter()
+        rms, camera_matrix, dist_coefs, _, _, std_intrinsics, _, _ = cv2.calibrateCameraExtended(
+            [self._object_points] * len(self._img_points), self._img_points, self.image_size, camera_matrix,
+            dist_coefs, criteria=CALIBRATE_CRITERIA, flags=flags)
+        std_intrinsics = std_intrinsics.ravel()
+        if self.estimate is not None:
+            old = self.estimate.camera_matrix[[0, 1, 0, 1], [0, 1, 2, 2]]
+            new = camera_matrix[[0, 1, 0, 1], [0, 1, 2, 2]]
+            change = np.max(np.abs(new - old) / np.abs(old))
+            self._stable = self._stable + 1 if change < CALIB_CONVERGED_CHANGE else 0
+        self.estimate = CalibrationEstimate(len(self._img_points), rms, camera_matrix, dist_coefs, std_intrinsics,
+                                            self.coverage.copy(), len(self.poses.covered), False)
+        self.estimate.converged = (self._stable >= CALIB_CONVERGED_SOLVES and
+                                   self.estimate.relative_std() < CALIB_CONVERGED_STD)
+        logger.debug(f"{self.camera} estimate of {self.serial} from {self.estimate.frames} pictures in "
+                     f"{(time.perf_counter() - start) * 1000:.0f} ms: rms {rms:.3f}, "
+                     f"focal std {self.estimate.relative_std():.4f}, converged {self.estimate.converged}")
+        return self.estimate
+
+
+class LiveCalibration(threading.Thread):
+    # incremental calibration of the rgb and ir cameras of a device, fed with the pictures as they are saved
+
+    def __init__(self, serial, pattern_size=PATTERN_SIZE_PARSED):
+        super().__init__(name=f"live-calibration-{serial}", daemon=True)
+        self.serial = serial
+        self._calibrators = {CF_RGB: IncrementalCalibrator(serial, CF_RGB, pattern_size),
+                             CF_IR: IncrementalCalibrator(serial, CF_IR, pattern_size)}
+        self._queue = queue.Queue()
+
+    def add(self, paths):
+        # {camera: picture path} of one capture
+        self._queue.put(paths)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def estimates(self):
+        # {camera: last estimate or None}
+        return {camera: calibrator.estimate for camera, calibrator in self._calibrators.items()}
+
+    def converged(self):
+        return all(estimate is not None and estimate.converged for estimate in self.estimates().values())
+
+    def run(self):
+        logger.debug(f"live calibration of {self.serial} started")
+        while True:
+            paths = self._queue.get()
+            if paths is None:
+                break
+            for camera, path in paths.items():
+                try:
+                    self._calibrators[camera].add(path)
+                except cv2.error as e:
+                    logger.warning(f"{camera} estimate of {self.serial} failed: {e}")
+        logger.debug(f"live calibration of {self.serial} stopped")
+
+
+class LiveBoardDetector(threading.Thread):
+    # finds the board in the newest color and ir frames at preview resolution while pictures are taken. frame sets
+    # arriving while a detection runs are skipped, corners are normalized to [0, 1] in the mirrored preview image
+
+    def __init__(self, serial, pattern_size=PATTERN_SIZE_PARSED, max_side=CB_LIVE_MAX_SIDE, streams=(IB_COLOR, IB_IR)):
+        super().__init__(name=f"board-detector-{serial}", daemon=True)
+        self._serial = serial
+        self._pattern_size = tuple(pattern_size)
+        self._max_side = max_side
+        self._streams = tuple(streams)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._pending = None
+        self._busy = False
+        # (monotonic time, frame sequence, {stream: corners or None})
+        self._result = (0.0, 0, {})
+        self.detections = 0
+        self.skipped = 0
+
+    def push(self, slot):
+        # frame sink, called on the capture thread
+        with self._lock:
+            if self._busy or self._pending is not None:
+                self.skipped += 1
+                return
+            slot.retain()
+            self._pending = slot
+        self._wake.set()
+
+    def result(self, max_age=CB_LIVE_MAX_AGE):
+        # {stream: corners or None} of the last detection, empty if it is older than max_age seconds
+        with self._lock:
+            timestamp, _, corners = self._result
+        if time.monotonic() - timestamp > max_age:
+            return {}
+        return corners
+
+    def sequence(self):
+        # frame sequence of the last detection
+        with self._lock:
+            return self._result[1]
+
+    def found(self):
+        corners = self.result()
+        return all(corners.get(key) is not None for key in self._streams)
+
+    def stop(self, timeout=1.0):
+        logger.debug(f"stop board detector of {self._serial}, {self.detections} detections, {self.skipped} skipped")
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.release()
+                self._pending = None
+
+    def __gray(self, key, array):
+        if key == IB_COLOR:
+            h, w = array.shape[:2]
+            scale = min(1.0, self._max_side / max(h, w))
+            small = cv2.resize(array, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+            gray = cv2.cvtColor(small, cv2.COLOR_BGRA2GRAY)
+        else:
+            gray = cv2.convertScaleAbs(array, alpha=NP_UINT8_MAX / IR_NORMALIZATOR)
+        return cv2.flip(gray, 1)
+
+    def run(self):
+        logger.debug(f"board detector of {self._serial} started")
+        while not self._stop_event.is_set():
+            if not self._wake.wait(0.1):
+                continue
+            self._wake.clear()
+            with self._lock:
+                slot, self._pending = self._pending, None
+                self._busy = slot is not None
+            if slot is None:
+                continue
+            # only the reduced images are kept, the slot goes back to the ring before detecting
+            with slot:
+                sequence = slot.sequence
+                images = {key: self.__gray(key, slot[key]) for key in self._streams if key in slot}
+            corners = {}
+            for key, gray in images.items():
+                found, points = cv2.findChessboardCorners(gray, self._pattern_size, flags=CB_SEARCH_FLAGS)
+                h, w = gray.shape[:2]
+                corners[key] = (points.reshape(-1, 2) + 0.5) / (w, h) if found else None
+            with self._lock:
+                self._result = (time.monotonic(), sequence, corners)
+                self._busy = False
+            self.detections += 1
+
+
+class BoardMotion:
+    # tells when the board has been still for a number of consecutive detections
+
+    def __init__(self, frames=AUTO_STILL_FRAMES_DEFAULT, threshold=AUTO_STILL_MOTION_DEFAULT):
+        self.frames = frames
+        self.threshold = threshold
+        self._last = None
+        self._still = 0
+
+    def update(self, corners):
+        # corners normalized to the image, None when the board is not found
+        if corners is None:
+            self._last, self._still = None, 0
+            return False
+        if self._last is not None and self._last.shape == corners.shape:
+            motion = np.abs(corners - self._last).mean()
+            self._still = self._still + 1 if motion < self.threshold else 0
+        self._last = corners
+        return self._still >= self.frames
+
+    def reset(self):
+        self._still = 0
+
+
+class PoseCoverage:
+    # pose regions already captured: cell of the board center, near or far, and the direction the board is tilted to
+
+    def __init__(self, grid=TK_AUTO_GRID, near=TK_AUTO_NEAR, tilt=TK_AUTO_TILT, pattern_size=PATTERN_SIZE_PARSED):
+        self.grid = grid
+        self.pattern_size = tuple(pattern_size)
+        self.near = near
+        self.tilt = tilt
+        self.covered = set()
+
+    def region(self, corners):
+        columns, rows = self.pattern_size
+        board = corners.reshape(rows, columns, 2)
+        center = board.reshape(-1, 2).mean(axis=0)
+        cell = tuple(np.clip((center * self.grid).astype(int), 0, self.grid - 1))
+        top, bottom = board[0, -1] - board[0, 0], board[-1, -1] - board[-1, 0]
+        left, right = board[-1, 0] - board[0, 0], board[-1, -1] - board[0, -1]
+        near = bool(np.linalg.norm(board[-1, -1] - board[0, 0]) > self.near)
+        # perspective shortens the far edge of a tilted board
+        horizontal = np.linalg.norm(top) / max(np.linalg.norm(bottom), 1e-6)
+        vertical = np.linalg.norm(left) / max(np.linalg.norm(right), 1e-6)
+        tilt = (0 if 1 / self.tilt < horizontal < self.tilt else int(np.sign(horizontal - 1)),
+                0 if 1 / self.tilt < vertical < self.tilt else int(np.sign(vertical - 1)))
+        return cell, near, tilt
+
+    def is_new(self, corners):
+        return self.region(corners) not in self.covered
+
+    def add(self, corners):
+        self.covered.add(self.region(corners))
+
+    def missing_cells(self):
+        # (left, top, right, bottom) in normalized image coordinates of the cells no board center was captured in
+        seen = {cell for cell, _, _ in self.covered}
+        return [(column / self.grid, row / self.grid, (column + 1) / self.grid, (row + 1) / self.grid)
+                for row in range(self.grid) for column in range(self.grid) if (column, row) not in seen]
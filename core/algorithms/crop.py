@@ -0,0 +1,123 @@
+# crop volume of PAS_FACE_CROP scans: the background is dropped before a frame set is stored. the volume is a near /
+# far depth window, optionally limited to a box on the depth frame and to a box in millimeters around the ir camera
+# axis. every constraint becomes a per pixel depth interval computed once, so a frame costs two comparisons
+import numpy as np
+
+from core.algorithms.point_cloud import RayTable
+from core.algorithms.registration import Registration
+from core.util.config import logger, nect_config
+from core.util.constants import *
+
+
+def parse_box(text):
+    # "(a, b, c, d)" to a tuple of floats, None if empty
+    text = text.strip().strip("()").strip()
+    return tuple(float(value) for value in text.split(",")) if text else None
+
+
+class CropVolume:
+    # scan stage keeping the depth (and ir, same pixel grid) inside the volume, the rest is set to 0 (no depth).
+    # color is limited to the region the kept depth falls on, through the registration of the device.
+    # shade gives the same cut on the previews, pixels outside are painted with the background level
+
+    def __init__(self, near, far, box=None, box_3d=None, rays: RayTable = None, size=None,
+                 background=INDEX_FOR_BACKGROUND_DEFAULT, registration: Registration = None):
+        # box (x0, y0, x1, y1) in pixels of the raw depth frame, box_3d (x_min, x_max, y_min, y_max) in millimeters
+        # of the ir camera frame, which needs the rays of the device. without a registration color is kept whole
+        width, height = size if size is not None else (IB_DEPTH_SHAPE[1], IB_DEPTH_SHAPE[0])
+        if box_3d is not None and rays is None:
+            raise ValueError("a 3d crop box needs the rays of the device")
+        self.near, self.far = near, far
+        self.box, self.box_3d = box, box_3d
+        self.background = background
+        self.registration = registration
+        self._near = np.full((height, width), near, dtype=np.float32)
+        self._far = np.full((height, width), far, dtype=np.float32)
+        if box_3d is not None:
+            x_min, x_max, y_min, y_max = box_3d
+            for ray, low, high in ((rays.x, x_min, x_max), (rays.y, y_min, y_max)):
+                # low <= ray * z <= high, the bounds swap where the ray points the other way
+                with np.errstate(divide="ignore"):
+                    bounds = np.stack((low / ray, high / ray))
+                np.maximum(self._near, np.where(ray > 0, bounds[0], np.where(ray < 0, bounds[1], -np.inf)),
+                           out=self._near)
+                np.minimum(self._far, np.where(ray > 0, bounds[1], np.where(ray < 0, bounds[0], np.inf)),
+                           out=self._far)
+                if not low <= 0 <= high:
+                    self._far[ray == 0] = -np.inf
+        if box is not None:
+            x0, y0, x1, y1 = (int(value) for value in box)
+            outside = np.ones((height, width), dtype=bool)
+            outside[max(0, y0):y1, max(0, x0):x1] = False
+            self._far[outside] = -np.inf
+        # region of the depth frame that can hold depth, the scan stages downstream only look there
+        rows, cols = np.nonzero(self._near <= self._far)
+        self.roi = (int(cols.min()), int(rows.min()), int(cols.max()) + 1, int(rows.max()) + 1) if len(rows) else \
+            (0, 0, 0, 0)
+        self.kept = None
+        logger.debug(f"crop volume {near}-{far} mm, box {box}, 3d box {box_3d}, region {self.roi}")
+
+    @classmethod
+    def from_config(cls, rays: RayTable = None, registration: Registration = None):
+        near = nect_config.getfloat(FRAMES, CROP_NEAR, fallback=CROP_NEAR_DEFAULT)
+        far = nect_config.getfloat(FRAMES, CROP_FAR, fallback=CROP_FAR_DEFAULT)
+        box = parse_box(nect_config.get(FRAMES, CROP_BOX, fallback=CROP_BOX_DEFAULT))
+        box_3d = parse_box(nect_config.get(FRAMES, CROP_BOX_3D, fallback=CROP_BOX_3D_DEFAULT))
+        background = nect_config.getint(FRAMES, INDEX_FOR_BACKGROUND, fallback=INDEX_FOR_BACKGROUND_DEFAULT)
+        return cls(near, far, box, box_3d if rays is not None else None, rays, background=background,
+                   registration=registration)
+
+    def mask(self, depth):
+        # true where depth is inside the volume, the one pass over the frame
+        inside = depth >= self._near
+        inside &= depth <= self._far
+        return inside
+
+    def __call__(self, arrays):
+        depth = arrays.get(IB_DEPTH)
+        if depth is None:
+            return arrays
+        inside = self.mask(depth)
+        self.kept = np.count_nonzero(inside) / inside.size
+        # the arrays belong to the frame ring, the cropped ones are new
+        for key in (IB_DEPTH, IB_IR):
+            if key in arrays:
+                arrays[key] = np.where(inside, arrays[key], np.float32(0))
+        if IB_COLOR in arrays and self.registration is not None:
+            color = arrays[IB_COLOR]
+            roi = self.color_roi(arrays[IB_DEPTH], (color.shape[1], color.shape[0]))
+            cropped = np.zeros_like(color)
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                cropped[y0:y1, x0:x1] = color[y0:y1, x0:x1]
+            arrays[IB_COLOR] = cropped
+        arrays[SCAN_ROI] = np.array(self.roi, dtype=np.int32)
+        return arrays
+
+    def color_roi(self, depth, color_size):
+        # region (x0, y0, x1, y1) of a raw color frame of color_size (width, height) where the depth left by the crop
+        # lands, None if it lands nowhere
+        # the registration works on mirrored frames at the calibration size
+        color_width = self.registration.rgb_size[0]
+        map_x, map_y = self.registration.color_coordinates(depth[:, ::-1], CROP_COLOR_STEP)
+        valid = map_x >= 0
+        if not valid.any():
+            return None
+        x = color_width - 1 - map_x[valid]
+        y = map_y[valid]
+        scale = color_size[0] / color_width
+        # the mapped pixels are CROP_COLOR_STEP depth pixels apart
+        margin = CROP_COLOR_STEP * color_width / depth.shape[1]
+        return (max(0, int((x.min() - margin) * scale)), max(0, int((y.min() - margin) * scale)),
+                min(color_size[0], int(np.ceil((x.max() + margin) * scale)) + 1),
+                min(color_size[1], int(np.ceil((y.max() + margin) * scale)) + 1))
+
+    def shade(self, rgba, depth):
+        # paints the pixels of a mirrored preview outside the volume, rgba at any size
+        outside = ~self.mask(depth)[:, ::-1]
+        if outside.shape != rgba.shape[:2]:
+            rows = np.arange(rgba.shape[0]) * outside.shape[0] // rgba.shape[0]
+            cols = np.arange(rgba.shape[1]) * outside.shape[1] // rgba.shape[1]
+            outside = outside[rows[:, None], cols]
+        np.copyto(rgba[..., :3], np.uint8(self.background), where=outside[..., None])
+        return rgba
@@ -0,0 +1,205 @@
+# lossless depth codec at the millimeter precision of the sensor, numpy only: every step is a whole array operation
+#   quantize: float millimeters rounded to uint16, 0 where there is no depth
+#   run length: the no depth mask as alternating lengths of runs without and with depth, varint coded
+#   predict: every pixel with depth from the previous one in raster order, zigzag coded to small unsigned residuals
+#   bit packing: residuals in blocks of DC_BLOCK, each block stored with the bits of its largest residual, so flat
+#                surfaces cost almost nothing and noisy ones a few bits per pixel
+# payload: header, runs, block widths (uint8), bit planes of the blocks (uint32)
+import struct
+import sys
+import time
+import zlib
+
+import cv2 as open_cv
+import numpy as np
+
+from core.util.constants import *
+
+# height, width, pixels with depth, byte length of the runs
+DC_HEADER = struct.Struct("<HHII")
+# residuals per block, one uint32 word per bit plane
+DC_BLOCK = 32
+# a uint32 needs 5 groups of 7 bits
+DC_VARINT_BYTES = 5
+
+
+def quantize_depth(depth):
+    # float millimeters to uint16, non finite and out of range values are no depth
+    depth = np.asarray(depth)
+    if depth.dtype == np.uint16:
+        return depth
+    millimeters = np.rint(depth)
+    valid = np.isfinite(millimeters) & (millimeters > 0) & (millimeters <= np.iinfo(np.uint16).max)
+    return np.where(valid, millimeters, 0).astype(np.uint16)
+
+
+def varint_encode(values):
+    values = np.asarray(values, dtype=np.uint32)
+    lengths = np.ones(len(values), dtype=np.intp)
+    for group in range(1, DC_VARINT_BYTES):
+        lengths += values >= (1 << (7 * group))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    out = np.empty(int(ends[-1]) if len(values) else 0, dtype=np.uint8)
+    for group in range(DC_VARINT_BYTES):
+        present = lengths > group
+        if not present.any():
+            break
+        chunk = (values[present] >> (7 * group)) & 0x7F
+        # the high bit tells a group follows
+        chunk |= np.where(lengths[present] > group + 1, 0x80, 0).astype(np.uint32)
+        out[starts[present] + group] = chunk
+    return out
+
+
+def varint_decode(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = (data[starts] & 0x7F).astype(np.uint32)
+    for group in range(1, DC_VARINT_BYTES):
+        present = lengths > group
+        if not present.any():
+            break
+        values[present] |= (data[starts[present] + group] & 0x7F).astype(np.uint32) << (7 * group)
+    return values
+
+
+def encode_depth(depth) -> bytes:
+    quantized = quantize_depth(depth).ravel()
+    height, width = np.shape(depth)
+    valid = quantized != 0
+    bounds = np.concatenate(([0], np.flatnonzero(valid[1:] != valid[:-1]) + 1, [len(valid)]))
+    # the first run is without depth, possibly empty
+    runs = np.diff(bounds, prepend=0) if len(valid) and valid[0] else np.diff(bounds)
+    runs = varint_encode(runs)
+    pixels = quantized[valid].astype(np.int32)
+    residuals = np.diff(pixels, prepend=np.int32(0))
+    symbols = np.zeros(-(-len(pixels) // DC_BLOCK) * DC_BLOCK, dtype=np.uint32)
+    symbols[:len(pixels)] = (residuals << 1) ^ (residuals >> 31)
+    blocks = symbols.reshape(-1, DC_BLOCK)
+    # bits of the largest residual of every block, 0 for a block of equal pixels
+    widths = np.frexp(blocks.max(axis=1))[1].astype(np.uint8)
+    # a block is stored bit plane by bit plane, each plane one little endian word of DC_BLOCK bits. with the blocks
+    # sorted by width the ones having a plane are a prefix, so every plane is a single pass over a slice
+    order = np.argsort(-widths.astype(np.int8), kind="stable")
+    starts = (np.cumsum(widths, dtype=np.intp) - widths)[order]
+    blocks = blocks[order]
+    remaining = np.bincount(widths, minlength=33)[::-1].cumsum()[::-1]
+    words = np.empty(int(widths.sum(dtype=np.intp)), dtype="<u4")
+    for plane in range(int(widths.max(initial=0))):
+        present = remaining[plane + 1]
+        bits = (blocks[:present] & np.uint32(1 << plane)) != 0
+        words[starts[:present] + plane] = np.packbits(bits, axis=1, bitorder="little").view("<u4").ravel()
+    return DC_HEADER.pack(height, width, len(pixels), len(runs)) + runs.tobytes() + widths.tobytes() + \
+        words.tobytes()
+
+
+def decode_depth(payload, dtype=np.float32):
+    # depth in millimeters, dtype uint16 to skip the conversion
+    height, width, count, runs_length = DC_HEADER.unpack_from(payload)
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    start = DC_HEADER.size
+    runs = varint_decode(payload[start:start + runs_length]).astype(np.intp)
+    start += runs_length
+    widths = payload[start:start + -(-count // DC_BLOCK)]
+    start += len(widths)
+    order = np.argsort(-widths.astype(np.int8), kind="stable")
+    starts = (np.cumsum(widths, dtype=np.intp) - widths)[order]
+    remaining = np.bincount(widths, minlength=33)[::-1].cumsum()[::-1]
+    words = np.frombuffer(payload, dtype="<u4", count=int(widths.sum(dtype=np.intp)), offset=start)
+    blocks = np.zeros((len(widths), DC_BLOCK), dtype=np.uint32)
+    for plane in range(int(widths.max(initial=0))):
+        present = remaining[plane + 1]
+        bits = np.unpackbits(words[starts[:present] + plane].view(np.uint8).reshape(-1, DC_BLOCK // 8), axis=1,
+                             bitorder="little")
+        blocks[:present] |= bits.astype(np.uint32) << np.uint32(plane)
+    symbols = np.empty_like(blocks)
+    symbols[order] = blocks
+    symbols = symbols.ravel()[:count]
+    residuals = (symbols >> 1).astype(np.int32) ^ -(symbols & 1).astype(np.int32)
+    valid = np.repeat(np.arange(len(runs)) % 2 == 1, runs)
+    if len(valid) != height * width or np.count_nonzero(valid) != count:
+        raise ValueError(f"depth payload does not match a {width}x{height} frame")
+    depth = np.zeros(height * width, dtype=dtype)
+    depth[valid] = np.cumsum(residuals, dtype=np.int32)
+    return depth.reshape(height, width)
+
+
+def benchmark(frames, repeat=3):
+    # compression ratio against the float32 frames and MB/s of float32 depth, for this codec, zlib of the uint16
+    # millimeters and 16 bit png
+    raw_size = sum(np.asarray(frame, dtype=np.float32).nbytes for frame in frames)
+    quantized = [quantize_depth(frame) for frame in frames]
+    codecs = {
+        "depth": (encode_depth, lambda payload: decode_depth(payload, np.uint16)),
+        "zlib-1": (lambda frame: zlib.compress(quantize_depth(frame).tobytes(), 1),
+                   lambda payload: np.frombuffer(zlib.decompress(payload), dtype=np.uint16)),
+        "zlib-6": (lambda frame: zlib.compress(quantize_depth(frame).tobytes(), 6),
+                   lambda payload: np.frombuffer(zlib.decompress(payload), dtype=np.uint16)),
+        "png-16": (lambda frame: open_cv.imencode(".png", quantize_depth(frame))[1].tobytes(),
+                   lambda payload: open_cv.imdecode(np.frombuffer(payload, dtype=np.uint8),
+                                                    open_cv.IMREAD_UNCHANGED)),
+    }
+    results = {}
+    for name, (encode, decode) in codecs.items():
+        encode_time = decode_time = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            payloads = [encode(frame) for frame in frames]
+            encode_time = min(encode_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            decoded = [decode(payload) for payload in payloads]
+            decode_time = min(decode_time, time.perf_counter() - start)
+        if not all(np.array_equal(np.asarray(out).reshape(frame.shape), frame) for out, frame in
+                   zip(decoded, quantized)):
+            raise AssertionError(f"{name} is not lossless")
+        results[name] = {"ratio": raw_size / sum(len(payload) for payload in payloads),
+                         "encode_mb_s": raw_size / encode_time / 1e6, "decode_mb_s": raw_size / decode_time / 1e6,
+                         "encode_ms": encode_time / len(frames) * 1000}
+    return results
+
+
+def synthetic_depth(count=30, shape=IB_DEPTH_SHAPE, seed=0):
+    # a person in front of a wall with sensor noise, flying pixels and holes, moving a little at every frame
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float32)
+    frames = []
+    for index in range(count):
+        depth = 2500 + 0.4 * cols
+        head = ((cols - 256 - index) / 70) ** 2 + ((rows - 160) / 90) ** 2
+        depth = np.where(head < 1, 900 - 60 * np.sqrt(np.clip(1 - head, 0, 1)), depth)
+        depth += rng.normal(0, 1.5, shape) * (depth / 1000)
+        depth[rng.random(shape) < 0.03] = 0
+        depth[:, :20] = 0
+        frames.append(depth.astype(np.float32))
+    return frames
+
+
+if __name__ == "__main__":
+    # python -m core.algorithms.depth_codec [scan or session files]
+    sets = {"synthetic": synthetic_depth()}
+    for recorded in sys.argv[1:]:
+        # imported here, both formats use this codec
+        from core.models.replay import ReplaySession
+        from core.models.scan_file import ScanFile
+
+        if recorded.endswith(REPLAY_EXTENSION):
+            session = ReplaySession(Path(recorded))
+            sets[recorded] = []
+            while (record := session.read()) is not None:
+                if IB_DEPTH in record[1]:
+                    sets[recorded].append(record[1][IB_DEPTH].asarray())
+            session.close()
+        else:
+            with ScanFile(recorded) as scan:
+                sets[recorded] = [scan.read(index, IB_DEPTH) for index in range(len(scan)) if
+                                  scan.has(index, IB_DEPTH)]
+    for label, depth_frames in sets.items():
+        print(f"{label}: {len(depth_frames)} frames")
+        for codec, result in benchmark(depth_frames).items():
+            print(f"  {codec:8} ratio {result['ratio']:5.1f}  encode {result['encode_mb_s']:7.1f} MB/s "
+                  f"({result['encode_ms']:.1f} ms/frame)  decode {result['decode_mb_s']:7.1f} MB/s")
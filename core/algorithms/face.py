@@ -0,0 +1,147 @@
+# face region of interest of PAS_FACE_DETECT scans. a haar cascade runs on a downscaled ir or color frame every few
+# frames, a template match follows the face in between, and the region is mapped onto the depth frame so that later
+# stages only see the face
+import cv2 as open_cv
+import numpy as np
+
+from core.algorithms.registration import Registration
+from core.util.config import logger
+from core.util.constants import *
+
+_cascade = None
+
+
+def face_cascade():
+    # the frontal face cascade shipped with opencv, loaded once. None if it cannot be loaded
+    global _cascade
+    if _cascade is None:
+        _cascade = open_cv.CascadeClassifier(open_cv.data.haarcascades + FACE_CASCADE)
+        if _cascade.empty():
+            logger.error(f"face cascade {FACE_CASCADE} not found, faces are not detected")
+    return None if _cascade.empty() else _cascade
+
+
+def expand(roi, factor, size):
+    # roi (x0, y0, x1, y1) grown by factor of its size on every side, clipped to size (width, height)
+    x0, y0, x1, y1 = roi
+    dx, dy = (x1 - x0) * factor, (y1 - y0) * factor
+    return (max(0, int(x0 - dx)), max(0, int(y0 - dy)), min(size[0], int(np.ceil(x1 + dx))),
+            min(size[1], int(np.ceil(y1 + dy))))
+
+
+class FaceTracker:
+    # scan stage: arrays of a frame set in, the same arrays with everything outside the face zeroed out plus the
+    # face region of the depth frame (SCAN_ROI, x0 y0 x1 y1) out. the frame set is kept whole while no face is found
+
+    def __init__(self, source=IB_IR, detect_every=FACE_DETECT_EVERY_DEFAULT, registration: Registration = None,
+                 width=FACE_DETECT_WIDTH, margin=FACE_MARGIN, detector=None):
+        # color frames need the registration of the device to reach the depth frame, ir frames are the depth grid
+        self.source = source
+        self.detect_every = max(1, detect_every)
+        self.registration = registration
+        self.width = width
+        self.margin = margin
+        self._detector = detector if detector is not None else face_cascade()
+        self._since_detection = 0
+        # face on the downscaled frame and its template, None while lost
+        self._roi = None
+        self._template = None
+        self.detections = 0
+        self.tracked = 0
+        self.lost = 0
+
+    def __small(self, image):
+        scale = self.width / image.shape[1]
+        small = open_cv.resize(image, (self.width, int(round(image.shape[0] * scale))),
+                               interpolation=open_cv.INTER_AREA)
+        if self.source == IB_COLOR:
+            small = open_cv.cvtColor(small, open_cv.COLOR_BGRA2GRAY)
+        else:
+            # ir intensity has no fixed range
+            small = open_cv.normalize(small, None, 0, NP_UINT8_MAX, open_cv.NORM_MINMAX, open_cv.CV_8U)
+        return open_cv.equalizeHist(small), scale
+
+    def __detect(self, small):
+        self.detections += 1
+        self._since_detection = 0
+        if self._detector is None:
+            return None
+        faces = self._detector.detectMultiScale(small, scaleFactor=1.1, minNeighbors=5,
+                                                minSize=(FACE_MIN_SIZE, FACE_MIN_SIZE))
+        if len(faces) == 0:
+            return None
+        # the largest face is the one being scanned
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+        return int(x), int(y), int(x + w), int(y + h)
+
+    def __track(self, small):
+        x0, y0, x1, y1 = expand(self._roi, FACE_SEARCH, (small.shape[1], small.shape[0]))
+        window = small[y0:y1, x0:x1]
+        if window.shape[0] < self._template.shape[0] or window.shape[1] < self._template.shape[1]:
+            return None
+        scores = open_cv.matchTemplate(window, self._template, open_cv.TM_CCOEFF_NORMED)
+        _, score, _, (x, y) = open_cv.minMaxLoc(scores)
+        if score < FACE_TRACK_MIN_SCORE:
+            return None
+        self.tracked += 1
+        return x0 + x, y0 + y, x0 + x + self._template.shape[1], y0 + y + self._template.shape[0]
+
+    def update(self, image):
+        # face (x0, y0, x1, y1) on image, None if there is none
+        small, scale = self.__small(image)
+        self._since_detection += 1
+        roi = None
+        if self._roi is not None and self._since_detection < self.detect_every:
+            roi = self.__track(small)
+            if roi is None:
+                self.lost += 1
+        if roi is None:
+            roi = self.__detect(small)
+            self._template = None if roi is None else small[roi[1]:roi[3], roi[0]:roi[2]].copy()
+        self._roi = roi
+        if roi is None:
+            return None
+        roi = expand(roi, self.margin, (small.shape[1], small.shape[0]))
+        return tuple(int(round(value / scale)) for value in roi)
+
+    def depth_roi(self, roi, depth, source_width):
+        # face of the source frame on the raw depth frame, None if it has no depth there
+        if self.source != IB_COLOR:
+            return roi
+        if self.registration is None:
+            return None
+        # the registration works on mirrored frames at the calibration size
+        height, width = depth.shape
+        color_width = self.registration.rgb_size[0]
+        scale = color_width / source_width
+        x0, y0, x1, y1 = (value * scale for value in roi)
+        map_x, map_y = self.registration.color_coordinates(depth[:, ::-1], FACE_MAP_STEP)
+        inside = (map_x >= color_width - 1 - x1) & (map_x <= color_width - 1 - x0) & (map_y >= y0) & (map_y <= y1)
+        rows, cols = np.nonzero(inside)
+        if len(rows) == 0:
+            return None
+        cols = width - 1 - cols * FACE_MAP_STEP
+        rows = rows * FACE_MAP_STEP
+        return (max(0, int(cols.min()) - FACE_MAP_STEP), max(0, int(rows.min()) - FACE_MAP_STEP),
+                min(width, int(cols.max()) + FACE_MAP_STEP + 1), min(height, int(rows.max()) + FACE_MAP_STEP + 1))
+
+    def __call__(self, arrays):
+        depth = arrays.get(IB_DEPTH)
+        if self.source not in arrays or depth is None:
+            return arrays
+        roi = self.update(arrays[self.source])
+        depth_roi = self.depth_roi(roi, depth, arrays[self.source].shape[1]) if roi is not None else None
+        if depth_roi is None:
+            arrays[SCAN_ROI] = np.array((0, 0, depth.shape[1], depth.shape[0]), dtype=np.int32)
+            return arrays
+        # the arrays belong to the frame ring, the cropped ones are new
+        crops = {IB_DEPTH: depth_roi, self.source: roi}
+        for key, (x0, y0, x1, y1) in crops.items():
+            cropped = np.zeros_like(arrays[key])
+            cropped[y0:y1, x0:x1] = arrays[key][y0:y1, x0:x1]
+            arrays[key] = cropped
+        arrays[SCAN_ROI] = np.array(depth_roi, dtype=np.int32)
+        return arrays
+
+    def stats(self):
+        return {"detections": self.detections, "tracked": self.tracked, "lost": self.lost}
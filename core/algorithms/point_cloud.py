@@ -0,0 +1,132 @@
+# point clouds from depth frames, every step is vectorized over the whole frame
+import time
+
+import cv2 as open_cv
+import numpy as np
+
+from core.algorithms.preview import palette
+from core.util.config import logger
+from core.util.constants import *
+
+
+class RayTable:
+    # direction (x/z, y/z) of the ray through every depth pixel, computed once per device from the ir intrinsics.
+    # lens distortion is removed here, so it costs nothing per frame
+
+    def __init__(self, fx, fy, cx, cy, distortion=None, size=(IB_DEPTH_SHAPE[1], IB_DEPTH_SHAPE[0])):
+        self.size = tuple(size)
+        width, height = self.size
+        u, v = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        if distortion is not None and np.any(distortion):
+            camera = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]], dtype=np.float64)
+            pixels = np.stack((u.ravel(), v.ravel()), axis=1).reshape(-1, 1, 2)
+            rays = open_cv.undistortPoints(pixels, camera, np.asarray(distortion, dtype=np.float64))
+            rays = rays.reshape(height, width, 2).astype(np.float32)
+            self.x, self.y = np.ascontiguousarray(rays[..., 0]), np.ascontiguousarray(rays[..., 1])
+        else:
+            self.x = (u - cx) / fx
+            self.y = (v - cy) / fy
+
+    @classmethod
+    def from_params(cls, params):
+        # params as returned by getIrCameraParams, the nominal kinect v2 intrinsics when they are unknown
+        fx, fy, cx, cy = (getattr(params, name, default) for name, default in
+                          zip(("fx", "fy", "cx", "cy"), PC_IR_INTRINSICS_DEFAULT))
+        # opencv order k1, k2, p1, p2, k3
+        distortion = [getattr(params, name, 0.0) for name in ("k1", "k2", "p1", "p2", "k3")]
+        logger.debug(f"ray table from fx={fx} fy={fy} cx={cx} cy={cy} distortion={distortion}")
+        return cls(fx, fy, cx, cy, distortion)
+
+    def strided(self, stride):
+        # rays of every stride-th pixel, shares nothing with this table
+        table = RayTable.__new__(RayTable)
+        table.x = np.ascontiguousarray(self.x[::stride, ::stride])
+        table.y = np.ascontiguousarray(self.y[::stride, ::stride])
+        table.size = (table.x.shape[1], table.x.shape[0])
+        return table
+
+
+def voxel_downsample(xyz, rgb, voxel):
+    # one point per occupied voxel: centroid of its points and the color of one of them.
+    # a single sort of the voxel keys, the voxels are the runs of equal keys
+    keys = np.floor(xyz / voxel).astype(np.int64)
+    keys -= keys.min(axis=0)
+    span = keys.max(axis=0) + 1
+    flat = (keys[:, 0] * span[1] + keys[:, 1]) * span[2] + keys[:, 2]
+    order = np.argsort(flat)
+    flat = flat[order]
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    counts = np.diff(np.append(starts, len(flat))).astype(np.float32)
+    centroid = np.add.reduceat(xyz[order], starts, axis=0) / counts[:, None]
+    return centroid, rgb[order[starts]]
+
+
+class PointCloud:
+    # xyz (millimeters, camera frame) and RGB of the valid pixels of a depth frame
+
+    def __init__(self, rays: RayTable, stride=1, voxel=None, d_min=DEPTH_MIN_DEFAULT, d_max=DEPTH_MAX_DEFAULT,
+                 colormap=VIS_JET):
+        self.stride = stride
+        self.rays = rays.strided(stride) if stride > 1 else rays
+        self.voxel = voxel
+        self.d_min, self.d_max = d_min, d_max
+        self._palette = palette(colormap)
+
+    def __call__(self, depth, colors=None, roi=None):
+        # colors, if given, is an RGB image aligned with depth, otherwise points are colored by depth. roi
+        # (x0, y0, x1, y1 on depth, e.g. the SCAN_ROI of a scan) limits the work to that region
+        rays_x, rays_y = self.rays.x, self.rays.y
+        if self.stride > 1:
+            depth = depth[::self.stride, ::self.stride]
+            colors = colors[::self.stride, ::self.stride] if colors is not None else None
+        if roi is not None:
+            x0, y0, x1, y1 = (int(value) for value in roi)
+            region = np.s_[-(-y0 // self.stride):-(-y1 // self.stride), -(-x0 // self.stride):-(-x1 // self.stride)]
+            depth, rays_x, rays_y = depth[region], rays_x[region], rays_y[region]
+            colors = colors[region] if colors is not None else None
+        valid = (depth > self.d_min) & (depth < self.d_max)
+        z = depth[valid]
+        xyz = np.empty((len(z), 3), dtype=np.float32)
+        np.multiply(rays_x[valid], z, out=xyz[:, 0])
+        np.multiply(rays_y[valid], z, out=xyz[:, 1])
+        xyz[:, 2] = z
+        if colors is None:
+            levels = ((z - self.d_min) * (NP_UINT8_MAX / (self.d_max - self.d_min))).astype(np.uint8)
+            rgb = self._palette[levels]
+        else:
+            rgb = colors[valid]
+        if self.voxel and len(z):
+            xyz, rgb = voxel_downsample(xyz, rgb, self.voxel)
+        return xyz, rgb
+
+
+def synthetic_depth(size=(IB_DEPTH_SHAPE[1], IB_DEPTH_SHAPE[0]), seed=0):
+    # tilted plane with a sphere in front of it and a few holes, in millimeters
+    width, height = size
+    rng = np.random.default_rng(seed)
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    depth = 2500 + 2 * u + v
+    sphere = (u - width / 2) ** 2 + (v - height / 2) ** 2
+    radius = min(width, height) / 4
+    inside = sphere < radius ** 2
+    depth[inside] = 1200 - np.sqrt(radius ** 2 - sphere[inside]) * 3
+    depth[rng.random(depth.shape) < 0.05] = 0
+    return depth.astype(np.float32)
+
+
+def benchmark(repeat=20, strides=(1, 2, 4), voxels=(None, 10.0, 20.0)):
+    # mean ms per frame for each (stride, voxel) on synthetic depth maps
+    rays = RayTable(*PC_IR_INTRINSICS_DEFAULT)
+    frames = [synthetic_depth(seed=seed) for seed in range(4)]
+    results = {}
+    for stride in strides:
+        for voxel in voxels:
+            cloud = PointCloud(rays, stride=stride, voxel=voxel)
+            points = len(cloud(frames[0])[0])
+            start = time.perf_counter()
+            for i in range(repeat):
+                cloud(frames[i % len(frames)])
+            results[(stride, voxel)] = ((time.perf_counter() - start) / repeat * 1000, points)
+            logger.debug(f"point cloud stride {stride} voxel {voxel}: {results[(stride, voxel)][0]:.2f} ms, "
+                         f"{points} points")
+    return results
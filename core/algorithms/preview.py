@@ -0,0 +1,127 @@
+# frame conversions for preview and saving
+import cv2 as open_cv
+import numpy as np
+
+from core.util.constants import *
+
+VIS_OPENCV_COLORMAPS = {VIS_JET: open_cv.COLORMAP_JET, VIS_TURBO: open_cv.COLORMAP_TURBO,
+                        VIS_BONE: open_cv.COLORMAP_BONE, VIS_INFERNO: open_cv.COLORMAP_INFERNO}
+# ir and depth are integers in millimeters / raw intensity, every value fits the lookup table index
+LUT_SIZE = np.iinfo(np.uint16).max + 1
+
+
+def palette(colormap):
+    # 256 RGB colors of the colormap
+    ramp = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    if colormap not in VIS_OPENCV_COLORMAPS:
+        return np.repeat(ramp, 3, axis=1)
+    return open_cv.cvtColor(open_cv.applyColorMap(ramp, VIS_OPENCV_COLORMAPS[colormap]),
+                            open_cv.COLOR_BGR2RGB).reshape(256, 3)
+
+
+def pack_rgba(rgb, alpha):
+    # RGBA bytes packed in one uint32, so a single gather writes color and mask together
+    rgb = rgb.astype(np.uint32)
+    return rgb[..., 0] | rgb[..., 1] << 8 | rgb[..., 2] << 16 | np.asarray(alpha, dtype=np.uint32) << 24
+
+
+class ColorPreview:
+    # display size RGB image straight from the raw BGRX frame: one area downscale of the full frame, then flip and
+    # channel swap on the small image, every step writes into a buffer reused across frames
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        width, height = self.size
+        self._small = np.empty((height, width, 4), dtype=np.uint8)
+        self._rgb = np.empty((height, width, 3), dtype=np.uint8)
+        self._flipped = np.empty((height, width, 3), dtype=np.uint8)
+
+    def __call__(self, raw):
+        open_cv.resize(raw, self.size, dst=self._small, interpolation=open_cv.INTER_AREA)
+        open_cv.cvtColor(self._small, open_cv.COLOR_BGRA2RGB, dst=self._rgb)
+        # kinect frames are mirrored
+        open_cv.flip(self._rgb, 1, dst=self._flipped)
+        return self._flipped
+
+
+def full_color(raw, size=None):
+    # full resolution BGR image for saving, only run on demand
+    color = open_cv.cvtColor(open_cv.flip(raw, 1), open_cv.COLOR_BGRA2BGR)
+    if size is not None and tuple(size) != (color.shape[1], color.shape[0]):
+        color = open_cv.resize(color, tuple(size), interpolation=open_cv.INTER_AREA)
+    return color
+
+
+def full_ir(raw, size=None):
+    # 8 bit ir image for saving, mirrored like the previews
+    ir = raw[:, ::-1]
+    if size is not None and tuple(size) != (ir.shape[1], ir.shape[0]):
+        ir = open_cv.resize(ir, tuple(size))
+    return open_cv.convertScaleAbs(ir, alpha=NP_UINT8_MAX / IR_NORMALIZATOR)
+
+
+class LutPreview:
+    # maps a float32 ir or depth frame to RGBA through a 65536 entries lookup table: one quantizing pass (mirroring
+    # included) and one gather. the alpha byte is the valid pixel mask, 0 where the sensor gave no data
+
+    def __init__(self, raw_size, size=None, colormap=VIS_GRAY):
+        self.raw_size = tuple(raw_size)
+        self.size = tuple(size) if size is not None else self.raw_size
+        width, height = self.size
+        self._raw_index = np.empty((self.raw_size[1], self.raw_size[0]), dtype=np.uint16)
+        self._index = self._raw_index if self.size == self.raw_size else np.empty((height, width), dtype=np.uint16)
+        self._packed = np.empty((height, width), dtype=np.uint32)
+        self.rgba = self._packed.view(np.uint8).reshape(height, width, 4)
+        self.mask = self.rgba[..., 3]
+        self.colormap = colormap
+        self._lut = None
+        self.build()
+
+    def build(self):
+        raise NotImplementedError
+
+    def set_colormap(self, colormap):
+        self.colormap = colormap
+        self.build()
+
+    def __call__(self, raw):
+        # raw values are within the uint16 range, unsafe casting truncates them to integers
+        np.copyto(self._raw_index, raw[:, ::-1], casting="unsafe")
+        if self._index is not self._raw_index:
+            open_cv.resize(self._raw_index, self.size, dst=self._index, interpolation=open_cv.INTER_NEAREST)
+        np.take(self._lut, self._index, out=self._packed)
+        return self.rgba, self.mask
+
+
+class IrPreview(LutPreview):
+
+    def __init__(self, raw_size, size=None, colormap=VIS_GRAY, ir_max=IR_NORMALIZATOR):
+        self.ir_max = ir_max
+        super().__init__(raw_size, size, colormap)
+
+    def build(self):
+        values = np.arange(LUT_SIZE, dtype=np.float32)
+        levels = np.clip(values / self.ir_max * NP_UINT8_MAX, 0, NP_UINT8_MAX).astype(np.uint8)
+        self._lut = pack_rgba(palette(self.colormap)[levels], NP_UINT8_MAX)
+
+
+class DepthPreview(LutPreview):
+    # depth outside the (d_min, d_max) window is invalid, the window can change at any time for the cost of a new
+    # lookup table
+
+    def __init__(self, raw_size, size=None, colormap=VIS_GRAY, d_min=DEPTH_MIN_DEFAULT, d_max=DEPTH_MAX_DEFAULT):
+        self.d_min = d_min
+        self.d_max = d_max
+        super().__init__(raw_size, size, colormap)
+
+    def set_window(self, d_min, d_max):
+        self.d_min, self.d_max = d_min, max(d_max, d_min + 1)
+        self.build()
+
+    def build(self):
+        values = np.arange(LUT_SIZE, dtype=np.float32)
+        valid = (values > self.d_min) & (values < self.d_max)
+        levels = np.clip((values - self.d_min) / (self.d_max - self.d_min) * NP_UINT8_MAX, 0, NP_UINT8_MAX)
+        rgb = palette(self.colormap)[levels.astype(np.uint8)]
+        rgb[~valid] = 0
+        self._lut = pack_rgba(rgb, np.where(valid, NP_UINT8_MAX, 0))
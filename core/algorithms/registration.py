@@ -0,0 +1,143 @@
+# color and depth alignment from the stereo calibration of a device. images are as saved for calibration: mirrored,
+# color at the rgb image size and ir / depth at the ir image size
+import hashlib
+import json
+import threading
+from typing import Optional
+
+import cv2 as open_cv
+import numpy as np
+
+from core.models.calibration_store import calibration_store
+from core.util.config import logger
+from core.util.constants import *
+
+_registrations = {}
+_registrations_lock = threading.Lock()
+
+
+def calibration_fingerprint(store):
+    # changes only when an input of the registration changes, not when corners are cached
+    entries = [store.camera_info(CF_IR), store.camera_info(CF_RGB), store.stereo_info()]
+    if any(entry is None for entry in entries):
+        return None
+    inputs = [{key: entry[key] for key in entry if key not in ("images", "rms")} for entry in entries]
+    return hashlib.blake2b(json.dumps(inputs, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class Registration:
+    # every depth pixel is a ray of the ir camera, rotated once into the color camera frame. per frame a point is
+    # depth * ray + translation, projected with the color intrinsics; the color lens distortion is a lookup in the
+    # distortion map of the color camera, so aligning costs a few array operations and one remap
+
+    def __init__(self, rays, translation, rgb_camera, color_map, fingerprint=None):
+        # rays (3, h, w) of the ir pixels in the color frame, translation (3,) in millimeters, color_map (2, H, W):
+        # distorted color position of every ideal color pixel
+        self.rays = rays
+        self.translation = translation
+        self.rgb_camera = rgb_camera
+        self.color_map = color_map
+        self.fingerprint = fingerprint
+        self.ir_size = (rays.shape[2], rays.shape[1])
+        self.rgb_size = (color_map.shape[2], color_map.shape[1])
+
+    @classmethod
+    def from_store(cls, store, depth_scale=REG_DEPTH_SCALE, undistorted=False):
+        # undistorted: the depth frames to align have no lens distortion left, their pixels are ideal ir pixels
+        ir_camera, ir_dist = store.camera(CF_IR)
+        rgb_camera, rgb_dist = store.camera(CF_RGB)
+        rotation, translation = store.stereo()
+        ir_size = tuple(store.camera_info(CF_IR)["size"])
+        rgb_size = tuple(store.camera_info(CF_RGB)["size"])
+        width, height = ir_size
+        u, v = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        pixels = np.stack((u.ravel(), v.ravel()), axis=1).reshape(-1, 1, 2)
+        ideal = open_cv.undistortPoints(pixels, ir_camera, None if undistorted else ir_dist).reshape(-1, 2)
+        rays = np.concatenate((ideal, np.ones((len(ideal), 1))), axis=1) @ rotation.T
+        rays = np.ascontiguousarray(rays.T.reshape(3, height, width), dtype=np.float32)
+        map_x, map_y = open_cv.initUndistortRectifyMap(rgb_camera, rgb_dist, None, rgb_camera, rgb_size,
+                                                       open_cv.CV_32FC1)
+        logger.debug(f"registration maps of {store.path} built, ir {ir_size} to rgb {rgb_size}")
+        return cls(rays, (translation.ravel() / depth_scale).astype(np.float32), rgb_camera,
+                   np.stack((map_x, map_y)), calibration_fingerprint(store))
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # np.savez adds the extension if it is missing
+        tmp = path.with_name(path.stem + "_tmp.npz")
+        np.savez(tmp, rays=self.rays, translation=self.translation, rgb_camera=self.rgb_camera,
+                 color_map=self.color_map, fingerprint=np.array(self.fingerprint or ""))
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as data:
+            return cls(data["rays"], data["translation"], data["rgb_camera"], data["color_map"],
+                       str(data["fingerprint"]) or None)
+
+    def color_coordinates(self, depth, step=1):
+        # (x, y) position in the color image of every step-th depth pixel, -1 where there is no depth or it falls
+        # outside
+        z = np.asarray(depth, dtype=np.float32)[::step, ::step]
+        rays = self.rays[:, ::step, ::step]
+        x = rays[0] * z + self.translation[0]
+        y = rays[1] * z + self.translation[1]
+        w = rays[2] * z + self.translation[2]
+        valid = (z > 0) & (w > 0)
+        np.divide(1, w, out=w, where=valid)
+        fx, fy, cx, cy = self.rgb_camera[0, 0], self.rgb_camera[1, 1], self.rgb_camera[0, 2], self.rgb_camera[1, 2]
+        u = np.rint(x * w * fx + cx)
+        v = np.rint(y * w * fy + cy)
+        valid &= (u >= 0) & (u < self.rgb_size[0]) & (v >= 0) & (v < self.rgb_size[1])
+        u = np.where(valid, u, 0).astype(np.intp)
+        v = np.where(valid, v, 0).astype(np.intp)
+        map_x = np.where(valid, self.color_map[0][v, u], -1)
+        map_y = np.where(valid, self.color_map[1][v, u], -1)
+        return map_x, map_y
+
+    def color_on_depth(self, color, depth):
+        # color image resampled on the depth grid, black where there is no depth
+        map_x, map_y = self.color_coordinates(depth)
+        return open_cv.remap(color, map_x, map_y, open_cv.INTER_LINEAR, borderMode=open_cv.BORDER_CONSTANT)
+
+    def depth_on_color(self, depth):
+        # depth splatted on the color grid, 0 where no depth pixel lands, the nearest one wins
+        map_x, map_y = self.color_coordinates(depth)
+        valid = map_x >= 0
+        u = np.rint(map_x[valid]).astype(np.intp)
+        v = np.rint(map_y[valid]).astype(np.intp)
+        z = np.asarray(depth)[valid]
+        inside = (u < self.rgb_size[0]) & (v >= 0) & (v < self.rgb_size[1])
+        # far points first, the nearer ones overwrite them
+        order = np.argsort(-z[inside], kind="stable")
+        out = np.zeros((self.rgb_size[1], self.rgb_size[0]), dtype=np.float32)
+        out[v[inside][order], u[inside][order]] = z[inside][order]
+        return out
+
+
+def registration(serial, undistorted=False) -> Optional[Registration]:
+    # registration of a device, None until both cameras and the stereo pair are calibrated. built once per
+    # calibration and cached next to the calibration store, the one of undistorted depth frames only in memory
+    store = calibration_store(serial)
+    fingerprint = calibration_fingerprint(store)
+    if fingerprint is None:
+        return None
+    with _registrations_lock:
+        cached = _registrations.get((serial, undistorted))
+        if cached is not None and cached.fingerprint == fingerprint:
+            return cached
+        if undistorted:
+            cached = _registrations[(serial, undistorted)] = Registration.from_store(store, undistorted=True)
+            return cached
+        path = store.path.parent / REGISTRATION_FILE
+        if path.is_file():
+            try:
+                cached = Registration.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"registration cache {path} not readable: {e}")
+                cached = None
+        if cached is None or cached.fingerprint != fingerprint:
+            cached = Registration.from_store(store)
+            cached.save(path)
+        _registrations[(serial, undistorted)] = cached
+        return cached
@@ -0,0 +1,118 @@
+# lens undistortion of frames from the calibrated intrinsics, the maps are built once per serial, stream and size
+import hashlib
+import json
+import threading
+from typing import Optional
+
+import cv2 as open_cv
+import numpy as np
+
+from core.algorithms.point_cloud import RayTable
+from core.models.calibration_store import calibration_store
+from core.util.config import logger
+from core.util.constants import *
+
+# calibration of the camera each stream comes from
+UD_CAMERAS = {IB_COLOR: CF_RGB, IB_IR: CF_IR, IB_DEPTH: CF_IR}
+
+# (serial, stream, size, raw, nearest) -> (store version, fingerprint, Undistorter)
+_undistorters = {}
+_undistorters_lock = threading.Lock()
+
+
+def camera_fingerprint(store, camera):
+    info = store.camera_info(camera)
+    if info is None:
+        return None
+    inputs = {key: info[key] for key in ("camera_matrix", "dist_coefs", "size")}
+    return hashlib.blake2b(json.dumps(inputs).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class Undistorter:
+    # fixed point maps (CV_16SC2 plus interpolation table) applied with one remap. depth is never interpolated across
+    # edges, it is resampled with the nearest neighbour
+
+    def __init__(self, camera_matrix, dist_coefs, calibration_size, size=None, raw=False, nearest=False):
+        # the pictures the calibration comes from are mirrored, raw frames are not: the mirrored camera has its
+        # principal point reflected and the sign of p2 changed
+        camera_matrix = np.array(camera_matrix, dtype=np.float64)
+        dist_coefs = np.array(dist_coefs, dtype=np.float64).ravel()
+        if raw:
+            camera_matrix[0, 2] = calibration_size[0] - 1 - camera_matrix[0, 2]
+            if len(dist_coefs) > 3:
+                dist_coefs[3] = -dist_coefs[3]
+        self.size = tuple(size) if size is not None else tuple(calibration_size)
+        if self.size != tuple(calibration_size):
+            scale_x, scale_y = self.size[0] / calibration_size[0], self.size[1] / calibration_size[1]
+            camera_matrix[0] *= scale_x
+            camera_matrix[1] *= scale_y
+            # pixel centers move when scaling
+            camera_matrix[0, 2] += (scale_x - 1) / 2
+            camera_matrix[1, 2] += (scale_y - 1) / 2
+        self.camera_matrix = camera_matrix
+        self.interpolation = open_cv.INTER_NEAREST if nearest else open_cv.INTER_LINEAR
+        self.map1, self.map2 = open_cv.initUndistortRectifyMap(camera_matrix, dist_coefs, None, camera_matrix,
+                                                               self.size, open_cv.CV_16SC2)
+
+    def __call__(self, image, out=None):
+        return open_cv.remap(image, self.map1, self.map2, self.interpolation, dst=out,
+                             borderMode=open_cv.BORDER_CONSTANT)
+
+
+def undistorter(serial, stream, size=None, raw=False, nearest=None) -> Optional[Undistorter]:
+    # maps of a stream of a device at size, None while its camera is not calibrated. checked against the calibration
+    # store at every call, the maps are rebuilt only when the intrinsics changed. only depth is resampled with the
+    # nearest neighbour unless told otherwise
+    store = calibration_store(serial)
+    camera = UD_CAMERAS[stream]
+    if nearest is None:
+        nearest = stream == IB_DEPTH
+    key = (serial, stream, tuple(size) if size is not None else None, raw, nearest)
+    with _undistorters_lock:
+        cached = _undistorters.get(key)
+        if cached is not None and cached[0] == store.version:
+            return cached[2]
+        fingerprint = camera_fingerprint(store, camera)
+        if fingerprint is None:
+            _undistorters[key] = (store.version, None, None)
+            return None
+        if cached is None or cached[1] != fingerprint:
+            camera_matrix, dist_coefs = store.camera(camera)
+            cached = (store.version, fingerprint,
+                      Undistorter(camera_matrix, dist_coefs, store.camera_info(camera)["size"], size, raw,
+                                  nearest=nearest))
+            logger.debug(f"undistortion maps of {serial} {stream} at {cached[2].size} built, raw {raw}")
+        else:
+            cached = (store.version, fingerprint, cached[2])
+        _undistorters[key] = cached
+        return cached[2]
+
+
+class UndistortStage:
+    # scan stage taking the lens distortion out of raw depth and ir frames. both use the nearest neighbour, so they
+    # stay pixel aligned and no depth is made up across edges. streams of an uncalibrated camera are left as they are
+
+    def __init__(self, serial, streams=(IB_DEPTH, IB_IR), size=(IB_DEPTH_SHAPE[1], IB_DEPTH_SHAPE[0])):
+        self._remaps = {}
+        for key in streams:
+            remap = undistorter(serial, key, size, raw=True, nearest=True)
+            if remap is not None:
+                self._remaps[key] = remap
+        # streams actually undistorted
+        self.streams = tuple(self._remaps)
+        logger.debug(f"undistort stage of {serial}: {self.streams}")
+
+    def ray_table(self) -> Optional[RayTable]:
+        # rays of the undistorted depth pixels (a pinhole camera), None if depth is not undistorted
+        remap = self._remaps.get(IB_DEPTH)
+        if remap is None:
+            return None
+        camera = remap.camera_matrix
+        return RayTable(camera[0, 0], camera[1, 1], camera[0, 2], camera[1, 2], size=remap.size)
+
+    def __call__(self, arrays):
+        # the arrays belong to the frame ring, the undistorted ones are new
+        for key, remap in self._remaps.items():
+            if key in arrays:
+                arrays[key] = remap(arrays[key])
+        return arrays
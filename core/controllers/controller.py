@@ -1,13 +1,24 @@
+import math
+import threading
+import time
 from datetime import datetime, timezone
+from typing import Optional
 import cv2 as open_cv
 from tkinter import filedialog
 
 import numpy as np
 
 from core import open_message_dialog, open_error_dialog
+from core.algorithms.calibration import RGBCameraCalibrator, IRCameraCalibrator, BoardMotion, PoseCoverage, \
+    LiveCalibration, StereoCalibrator
+from core.algorithms.crop import CropVolume
+from core.algorithms.face import FaceTracker
+from core.algorithms.preview import full_color, full_ir
+from core.algorithms.undistort import UndistortStage
 from core.controllers import Controller
 from core.models import store_open_project, add_to_open_projects, create_project_folder, create_calibration_folder, \
-    restore_calibration_backup, remove_calibration_backup
+    restore_calibration_backup, remove_calibration_backup, write_project
+from core.models.replay import is_replay_serial
 from core.util import open_guide, open_log_folder, check_if_folder_exist, check_if_is_project, is_int
 from core.util.config import logger, nect_config, change_fps, RGB_IMAGE_SIZE_PARSED, IR_IMAGE_SIZE_PARSED
 from core.util.constants import *
@@ -43,13 +54,17 @@ class MenuController(Controller):
         if not self.master.has_connected_device():
             self.view.update_command_or_cascade(M_CALIBRATE, {M_STATE: "disabled"}, update_state=True)
             self.view.update_command_or_cascade(M_FPS, {M_STATE: "disabled"}, update_state=True)
+            self.view.update_command_or_cascade(M_RECORD, {M_STATE: "disabled"}, update_state=True)
+            self.view.update_command_or_cascade(M_PIPELINE, {M_STATE: "disabled"}, update_state=True)
         else:
             self.view.update_command_or_cascade(M_10FPS, {M_COMMAND: lambda: self.fps_change(REFRESH_RATE_10FPS)})
             self.view.update_command_or_cascade(M_15FPS, {M_COMMAND: lambda: self.fps_change(REFRESH_RATE_15FPS)})
             self.view.update_command_or_cascade(M_30FPS, {M_COMMAND: lambda: self.fps_change(REFRESH_RATE_30FPS)})
+            self.view.update_command_or_cascade(M_RECORD, {M_COMMAND: lambda: self.master.toggle_recording()})
             self.view.add_sensors()
             for serial in self.master.devices:
                 self.view.update_command_or_cascade(serial, {M_COMMAND: lambda: self.calibrate(serial)})
+            self.bind_pipelines()
         # menu file
         self.view.update_command_or_cascade(M_NEW, {M_COMMAND: lambda: self.create_new_project()})
         self.view.update_command_or_cascade(M_OPEN, {M_COMMAND: lambda: self.open_project()})
@@ -123,11 +138,13 @@ class MenuController(Controller):
                 create_calibration_folder(device_to_calibrate, reset=True, backup=True)
                 self.master.take_pictures(data=configs, calibration=True)
         elif calibrate == I18N_ONLY_CALIBRATION_BUTTON:
-            # calibration()
-            return
+            # calibrate again from the saved pictures
+            self.master.calibrate(device_to_calibrate)
 
     def close_app(self):
         logger.debug("close app")
+        # pictures still queued are written before leaving
+        self.master.writer.stop()
         self.master.destroy()
 
     def ask_override_calibration(self):
@@ -167,6 +184,27 @@ class MenuController(Controller):
             logger.debug("menu_bar <<LanguageChange>> event generation")
             self.master.event_generate("<<LanguageChange>>")
 
+    def bind_pipelines(self):
+        # replay devices have no packet pipeline
+        pipelines = self.master.pipelines
+        serials = [serial for serial in self.master.devices if not is_replay_serial(serial)]
+        if not serials:
+            self.view.update_command_or_cascade(M_PIPELINE, {M_STATE: "disabled"}, update_state=True)
+            return
+        self.view.add_pipelines(serials, pipelines.available)
+        for serial in serials:
+            self.view.pipeline[serial].set(pipelines.override(serial) or M_PIPELINE_AUTO)
+            for name in (M_PIPELINE_AUTO,) + tuple(pipelines.available):
+                self.view.update_command_or_cascade(M_PIPELINE + serial + name, {
+                    M_COMMAND: lambda s=serial, n=name: self.pipeline_change(s, n)})
+
+    def pipeline_change(self, serial, name):
+        pipelines = self.master.pipelines
+        override = None if name == M_PIPELINE_AUTO else name
+        if override != pipelines.override(serial):
+            pipelines.set_override(serial, override)
+            open_message_dialog(self.master, "pipeline_override")
+
     def fps_change(self, fps):
         changed = change_fps(fps)
         if changed:
@@ -199,6 +237,22 @@ class SensorController(Controller):
         self.view = None
         self.missing_calibration_frames = None
         self.current_state = S_STATE_NONE
+        self._calibration = None
+        self._calibration_result = None
+        # timed or automatic capture in progress
+        self._capture_mode = None
+        self._capture_interval = None
+        self._next_capture = None
+        self._motion = None
+        self._coverage = None
+        # ir corners of the board last found by both cameras
+        self._board = None
+        self._board_sequence = None
+        # incremental calibration while taking pictures, its estimates start the final calibration
+        self._live_calibration = None
+        self._calibration_guess = (None, {})
+        # {(serial, picture name): {camera: path}} of calibration pictures partly written
+        self._written_pictures = {}
 
     def bind(self, v: SensorView):
         logger.debug("bind in sensor controller")
@@ -209,66 +263,201 @@ class SensorController(Controller):
         self.view.create_view()
         for serial in self.master.devices:
             self._views.append(
-                DeviceView(self.view.sensor_list, self.master.fn, serial=serial, borderwidth=5, relief="ridge",
-                           style="Device.TFrame"))
+                DeviceView(self.view.sensor_list, self.master.fn, self.master.pipelines, serial=serial, borderwidth=5,
+                           relief="ridge", style="Device.TFrame"))
             self._controllers.append(DeviceController(self.master))
             self._controllers[-1].bind(self._views[-1])
             self.view.sensor_list.add(serial, self._views[-1], serial)
 
+    def toggle_recording(self):
+        device = self.view.selected_device()
+        if device is None:
+            return
+        if device.recording():
+            device.stop_recording()
+        elif not device.start_recording():
+            logger.warning(f"device {device.serial()} is not open, can't record")
+
     def take_calibration_pictures(self, calib_conf):
         modality = calib_conf[I18N_MODALITY]
         frames = calib_conf[I18N_FRAMES]
+        device = self.view.selected_device()
+        device.require_streams(CS_CALIBRATION, CS_CALIBRATION_STREAMS)
+        self.missing_calibration_frames = frames
+        # pose regions of the pictures taken, in every modality
+        self._coverage = PoseCoverage()
+        self._board = None
+        self.current_state = S_STATE_CALIBRATION
         if modality == TK_MANUAL:
-            self.missing_calibration_frames = frames
-            self.current_state = S_STATE_CALIBRATION
-            self.view.set_mode(btn_name_list=[S_MANUAL_TAKE, S_STOP], title=S_CALIBRATION, frames=frames)
+            self.view.set_mode(btn_name_list=[S_MANUAL_TAKE, S_FINISH, S_STOP], title=S_CALIBRATION, frames=frames)
             self.view.set_command(btn_name=S_MANUAL_TAKE, command=lambda: self.take_manual_picture())
-            self.view.set_command(btn_name=S_STOP, command=lambda: self.unset_mode(True))
+            # pictures can only be taken while the board is seen by both cameras
+            self.view.set_button_state(S_MANUAL_TAKE, False)
         elif modality == TK_TIMED:
-            self.view.set_mode(btn_name_list=[S_TIME_START, S_STOP], title=S_CALIBRATION, frames=frames)
-            # self.view.set_command(btn_name=S_TIME_START, command=self.start_timed_capture())
-            self.view.set_command(btn_name=S_STOP, command=lambda: self.unset_mode())
+            self.view.set_mode(btn_name_list=[S_TIME_START, S_FINISH, S_STOP], title=S_CALIBRATION, frames=frames,
+                               countdown=True)
+            self.view.set_command(btn_name=S_TIME_START, command=lambda: self.take_pictures_timed())
+        elif modality == TK_AUTO:
+            self.view.set_mode(btn_name_list=[S_AUTO_START, S_FINISH, S_STOP], title=S_CALIBRATION, frames=frames)
+            self.view.set_command(btn_name=S_AUTO_START, command=lambda: self.take_pictures_auto())
+        self.view.set_command(btn_name=S_STOP, command=lambda: self.unset_mode(True))
+        # enabled once the live calibration has converged
+        self.view.set_command(btn_name=S_FINISH, command=lambda: self.finish_calibration())
+        self.view.set_button_state(S_FINISH, False)
+        self._live_calibration = LiveCalibration(device.serial())
+        self._live_calibration.start()
+        if device.start_board_detection():
+            self.master.after(CB_LIVE_POLL_MS, self.__poll_board)
+
+    def __poll_board(self):
+        device = self.view.selected_device()
+        if self.current_state != S_STATE_CALIBRATION or device is None or device.board_detector() is None:
+            return
+        detector = device.board_detector()
+        corners = detector.result()
+        found = detector.found()
+        device.set_overlays(corners)
+        # regions are worked out on the ir image
+        self._board = corners.get(IB_IR) if found else None
+        device.set_missing_regions({IB_IR: self._coverage.missing_cells()})
+        self.view.set_button_state(S_MANUAL_TAKE, found)
+        self.__show_estimates()
+        if self._capture_mode is not None:
+            self.__capture_tick(detector, corners, found)
+        # the last picture ends the calibration mode
+        if self.current_state == S_STATE_CALIBRATION:
+            self.master.after(CB_LIVE_POLL_MS, self.__poll_board)
+
+    def __show_estimates(self):
+        if self._live_calibration is None:
+            return
+        estimates = self._live_calibration.estimates()
+        if all(estimate is None for estimate in estimates.values()):
+            return
+        # reprojection error and relative uncertainty of the focal lengths
+        self.view.update_estimate(", ".join(f"{camera} {estimate.rms:.2f}px f±{estimate.relative_std():.1%}"
+                                            for camera, estimate in estimates.items() if estimate is not None))
+        self.view.set_button_state(S_FINISH, self._live_calibration.converged())
+
+    def __capture_tick(self, detector, corners, found):
+        now = time.monotonic()
+        if self._capture_mode == TK_TIMED:
+            remaining = self._next_capture - now
+            self.view.update_countdown(max(0, math.ceil(remaining)))
+            # a picture without the board would be discarded by the calibration, the timer waits for it
+            if remaining <= 0 and found:
+                self._next_capture = now + self._capture_interval
+                self.__take_calibration_picture()
+        elif self._capture_mode == TK_AUTO:
+            sequence = detector.sequence()
+            if sequence == self._board_sequence:
+                return
+            self._board_sequence = sequence
+            board = corners.get(IB_IR)
+            still = self._motion.update(board)
+            if found and still and self._coverage.is_new(board):
+                logger.debug(f"board still in new pose region {self._coverage.region(board)}")
+                self._motion.reset()
+                self.__take_calibration_picture()
 
     def unset_mode(self, restore=False):
         if restore and self.current_state == S_STATE_CALIBRATION:
-            restore_calibration_backup(self.view.sensor_list.selected_frame().serial())
+            # pictures still being written would end up in the restored folder
+            serial = self.view.selected_device_serial()
+            self.master.writer.when_flushed(lambda: restore_calibration_backup(serial))
+        if self.view.selected_device() is not None:
+            self.view.selected_device().stop_board_detection()
+            self.view.selected_device().release_streams(CS_CALIBRATION)
+        if self._live_calibration is not None:
+            self._live_calibration.stop()
+            guess = {} if restore else {camera: (estimate.camera_matrix, estimate.dist_coefs) for camera, estimate in
+                                        self._live_calibration.estimates().items() if estimate is not None}
+            self._calibration_guess = (self._live_calibration.serial, guess)
+            self._live_calibration = None
         self.missing_calibration_frames = None
         self.current_state = S_STATE_NONE
+        self._capture_mode = None
         self.view.unset_mode()
 
     def take_picture(self, name="_", calibration=False):
+        # {camera: path} of the pictures handed to the writer pool, None if they were not taken
         if calibration:
             # get frames asarray
             frame = self.view.selected_device().get_frame()
-            # save
-            calibration_path = Path(nect_config[CONFIG][CALIBRATION_PATH])
-            rgb_file_path = calibration_path / self.view.selected_device_serial() / F_RGB / (str(name) + '.jpg')
-            arr = open_cv.resize(np.flip(frame[IB_COLOR], axis=(1,)), RGB_IMAGE_SIZE_PARSED)
-            open_cv.imwrite(str(rgb_file_path.resolve()), arr)
-            ir_file_path = calibration_path / self.view.selected_device_serial() / F_IR / (str(name) + '.jpg')
-            arr = np.asarray(
-                open_cv.resize(np.flip(frame[IB_IR], axis=(1,)), IR_IMAGE_SIZE_PARSED) / IR_NORMALIZATOR * NP_UINT8_MAX,
-                dtype=np.uint8)
-            open_cv.imwrite(str(ir_file_path.resolve()), arr)
+            if frame is None:
+                logger.warning("no frame captured yet, picture not taken")
+                return None
+            if IB_COLOR not in frame or IB_IR not in frame:
+                frame.release()
+                logger.warning("color and ir streams are not both captured, picture not taken")
+                return None
+            with frame:
+                # copies owned by the writer, the slot goes back to the ring before encoding
+                color, ir = frame[IB_COLOR].copy(), frame[IB_IR].copy()
+            serial = self.view.selected_device_serial()
+            calibration_path = Path(nect_config[CONFIG][CALIBRATION_PATH]) / serial
+            paths = {CF_RGB: calibration_path / F_RGB / (str(name) + '.jpg'),
+                     CF_IR: calibration_path / F_IR / (str(name) + '.jpg')}
+            writer = self.master.writer
+            if writer.pending() + len(paths) > writer.depth:
+                logger.warning(f"{writer.pending()} pictures still being written, picture not taken")
+                return None
+            submitted = {
+                CF_RGB: writer.submit(paths[CF_RGB], color, lambda raw: full_color(raw, RGB_IMAGE_SIZE_PARSED),
+                                      tag=(S_STATE_CALIBRATION, serial, str(name), CF_RGB)),
+                CF_IR: writer.submit(paths[CF_IR], ir, lambda raw: full_ir(raw, IR_IMAGE_SIZE_PARSED),
+                                     tag=(S_STATE_CALIBRATION, serial, str(name), CF_IR))}
+            if not any(submitted.values()):
+                return None
+            if not all(submitted.values()):
+                # a picture the writer never got counts as not written, the capture is dropped with the other one
+                self._written_pictures[(serial, str(name))] = {camera: None for camera, ok in submitted.items()
+                                                               if not ok}
+            return paths
         else:
             print("foto")
+            return None
+
+    def writes_done(self):
+        # written pictures of the same capture go to the live calibration together
+        failed = []
+        for job in self.master.writer.completed():
+            if job.error is not None:
+                logger.error(f"picture {job.path} not written: {job.error}")
+                failed.append(f"{job.path.name}: {job.error}")
+            else:
+                logger.debug(f"{job.path} written in {job.latency * 1000:.0f} ms")
+            if job.tag is None or job.tag[0] != S_STATE_CALIBRATION:
+                continue
+            _, serial, name, camera = job.tag
+            written = self._written_pictures.setdefault((serial, name), {})
+            # None for a picture not written
+            written[camera] = job.path if job.error is None else None
+            if len(written) < len(CS_CALIBRATION_STREAMS):
+                continue
+            del self._written_pictures[(serial, name)]
+            if None in written.values():
+                self.__drop_capture(written)
+            elif self._live_calibration is not None and self._live_calibration.serial == serial:
+                self._live_calibration.add(written)
+        if failed:
+            open_message_dialog(self.master, "picture_failed", ERROR_ICON, extra="\n".join(failed))
+
+    def __drop_capture(self, written):
+        # the calibration pairs the pictures by name, the one written without its pair is removed
+        for path in written.values():
+            if path is not None:
+                logger.debug(f"remove {path}, its pair was not written")
+                path.unlink(missing_ok=True)
+        if self.current_state == S_STATE_CALIBRATION and isinstance(self.missing_calibration_frames, int):
+            # the capture is taken again
+            self.missing_calibration_frames += 1
+            self.view.update_frame_count(self.missing_calibration_frames)
 
     def take_manual_picture(self):
         if self.current_state == S_STATE_CALIBRATION:
             if isinstance(self.missing_calibration_frames, int):
-                # reduce frames
-                self.missing_calibration_frames = self.missing_calibration_frames - 1
-                self.view.update_frame_count(self.missing_calibration_frames)
-                # logic to take picture
-                self.take_picture(name=str(self.missing_calibration_frames), calibration=True)
-
-                # last picture?
-                if self.missing_calibration_frames <= 0:
-                    # yes start calibration, unset mode
-                    self.unset_mode(restore=False)
-                    remove_calibration_backup(self.view.sensor_list.selected_frame().serial())
-                    self.calibration()
-                # no wait for next
+                self.__take_calibration_picture()
             else:
                 self.unset_mode()
         elif self.current_state == S_STATE_CAPTURING:
@@ -276,75 +465,92 @@ class SensorController(Controller):
         else:
             self.unset_mode()
 
-    def calibration(self):
-        if isRGB:
-            img_names = const.rgbFolder.glob('*.jpg')
-            CAMERA_PATH = str(const.rgbCameraIntrinsic.resolve())
+    def __take_calibration_picture(self):
+        # logic to take picture, the live calibration gets it once written
+        if self.take_picture(name=str(self.missing_calibration_frames - 1), calibration=True) is None:
+            return
+        if self._board is not None:
+            self._coverage.add(self._board)
+        # reduce frames
+        self.missing_calibration_frames = self.missing_calibration_frames - 1
+        self.view.update_frame_count(self.missing_calibration_frames)
+
+        # last picture?
+        if self.missing_calibration_frames <= 0:
+            # yes start calibration
+            self.finish_calibration()
+        # no wait for next
+
+    def finish_calibration(self):
+        # unset mode, keep the new pictures and calibrate from them once they are all written
+        serial = self.view.selected_device_serial()
+        self.unset_mode(restore=False)
+        self.master.writer.when_flushed(lambda: self.__calibrate_written(serial))
+
+    def __calibrate_written(self, serial):
+        remove_calibration_backup(serial)
+        self.calibration(serial)
+
+    def calibration(self, serial=None):
+        # runs on a worker thread, the result is polled from the tk loop
+        if serial is None:
+            serial = self.view.selected_device_serial()
+        if self._calibration is not None and self._calibration.is_alive():
+            logger.warning(f"calibration already running, {serial} not calibrated")
+            return
+        logger.debug(f"start calibration of {serial}")
+        self._calibration_result = None
+        guess_serial, guess = self._calibration_guess
+        self._calibration_guess = (None, {})
+        self._calibration = threading.Thread(target=self.__run_calibration,
+                                             args=(serial, guess if guess_serial == serial else {}),
+                                             name=f"calibration-{serial}", daemon=True)
+        self._calibration.start()
+        self.master.after(CALIBRATION_POLL_MS, self.__poll_calibration)
+
+    def __run_calibration(self, serial, guess):
+        # guess holds the live calibration estimates, the solver only refines them
+        try:
+            self._calibration_result = {CF_RGB: RGBCameraCalibrator(serial).calibrate(guess=guess.get(CF_RGB)),
+                                        CF_IR: IRCameraCalibrator(serial).calibrate(guess=guess.get(CF_IR))}
+            # the color to depth registration is rebuilt from the new extrinsics the first time it is needed
+            self._calibration_result[CF_STEREO] = StereoCalibrator(serial).calibrate()
+        except Exception as e:
+            logger.exception(f"calibration of {serial} failed")
+            self._calibration_result = e
+
+    def __poll_calibration(self):
+        if self._calibration.is_alive():
+            self.master.after(CALIBRATION_POLL_MS, self.__poll_calibration)
+            return
+        if isinstance(self._calibration_result, Exception):
+            open_message_dialog(self.master, "calibration_failed", ERROR_ICON)
         else:
-            img_names = const.irFolder.glob('*.jpg')
-            CAMERA_PATH = str(const.irCameraIntrinsic.resolve())
-        # create object points
-        pattern_points = np.zeros((np.prod(const.pattern_size), 3), np.float32)
-        pattern_points[:, :2] = np.indices(const.pattern_size).T.reshape(-1, 2)
-        pattern_points *= const.square_size
-        # print(pattern_points)
-
-        obj_points = []
-        img_points = []
-        h, w = 0, 0
-        for fn in img_names:
-            print(f'processing {fn}...')
-            img = cv2.imread(str(fn.resolve()), 0)
-            if img is None:
-                print("Failed to load", fn)
-                continue
-
-            h, w = img.shape[:2]
-            found, corners = cv2.findChessboardCorners(img, const.pattern_size, flags=cv2.CALIB_CB_ADAPTIVE_THRESH)
-            if found:
-                cv2.cornerSubPix(img, corners, (5, 5), (-1, -1),
-                                 (cv2.TERM_CRITERIA_EPS +
-                                  cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
-                # Draw and display the corners
-                cv2.drawChessboardCorners(img, (6, 8), corners, found)
-                cv2.imshow('img', img)
-                cv2.waitKey(500)
-            if not found:
-                print('chessboard not found')
-                continue
-
-            img_points.append(corners.reshape(-1, 2))
-            obj_points.append(pattern_points)
-
-            # save img_points for future stereo calibration
-            img_file = shelve.open(os.path.splitext(fn)[0] + ".dat", 'n')
-            img_file['img_points'] = corners.reshape(-1, 2)
-            img_file.close()
-
-            print('ok')
-
-        rms, camera_matrix, dist_coefs, rvecs, tvecs = cv2.calibrateCamera(obj_points,
-                                                                           img_points,
-                                                                           (w, h),
-                                                                           None,
-                                                                           None,
-                                                                           criteria=(
-                                                                           cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
-                                                                           120, 0.001),
-                                                                           flags=0)
-
-        # save calibration results
-        camera_file = shelve.open(CAMERA_PATH, 'n')
-        camera_file['camera_matrix'] = camera_matrix
-        camera_file['dist_coefs'] = dist_coefs
-        camera_file.close()
-
-        print("RMS:", rms)
-        print("camera matrix:\n", camera_matrix)
-        print("distortion coefficients: ", dist_coefs.ravel())
-
-    def take_pictures_timed(self, frames_to_capture, time_between=1):
-        logger.error("not implemented")
+            for camera, result in self._calibration_result.items():
+                logger.info(f"{camera} calibration rms: {result.rms}")
+            open_message_dialog(self.master, "calibration_done")
+
+    def take_pictures_timed(self, frames_to_capture=None, time_between=None):
+        # one picture every time_between seconds, driven by the board polling loop
+        if frames_to_capture is not None:
+            self.missing_calibration_frames = frames_to_capture
+        if time_between is None:
+            time_between = nect_config.getfloat(CALIBRATION, CAPTURE_INTERVAL, fallback=CAPTURE_INTERVAL_DEFAULT)
+        logger.debug(f"take {self.missing_calibration_frames} pictures every {time_between}s")
+        self._capture_interval = time_between
+        self._next_capture = time.monotonic() + time_between
+        self._capture_mode = TK_TIMED
+        self.view.set_button_state(S_TIME_START, False)
+
+    def take_pictures_auto(self):
+        # a picture every time the board is held still in a pose region not captured yet
+        logger.debug(f"take {self.missing_calibration_frames} pictures automatically")
+        self._motion = BoardMotion(
+            nect_config.getint(CALIBRATION, AUTO_STILL_FRAMES, fallback=AUTO_STILL_FRAMES_DEFAULT),
+            nect_config.getfloat(CALIBRATION, AUTO_STILL_MOTION, fallback=AUTO_STILL_MOTION_DEFAULT))
+        self._board_sequence = None
+        self._capture_mode = TK_AUTO
+        self.view.set_button_state(S_AUTO_START, False)
 
     @staticmethod
     def switch(old_dev, new_dev):
@@ -354,8 +560,7 @@ class SensorController(Controller):
                 if old_dev != new_dev:
                     old_dev.close()
                 if not new_dev.opened():
-                    new_dev.open()
-                    new_dev.play()
+                    new_dev.open_and_play()
                 elif not new_dev.playing():
                     new_dev.play()
                 else:
@@ -534,6 +739,9 @@ class ScanController(Controller):
         self.master = master
         self.data = None
         self.scanning = False
+        self._form = None
+        self._scan_path: Optional[Path] = None
+        self._after_id = None
 
     def bind(self, v: ScanView):
         logger.debug(f"bind in Scan controller")
@@ -543,14 +751,26 @@ class ScanController(Controller):
         self.view.set_command(PAS_STOP, lambda: self.manual_stop())
         self.view.set_command(PAS_SEC_START, lambda: self.start())
         self.view.set_command(PAS_SEC_STOP, lambda: self.timed_cancel())
+        self.view.set_command(PAS_FACE_CROP, lambda: self.preview_crop(True))
+        self.view.set_command(PAS_FACE_DETECT, lambda: self.preview_crop(False))
 
     def start(self):
         logger.debug(f"manual start of scan")
         data = self.view.get_form()
         valid, missing = self.validate_form_data(data)
         logger.debug(f"check is {valid}, missing: {missing}")
+        if self.scanning:
+            logger.debug("scan already running")
+            return
         if valid:
+            device = self.master.kinect.selected_device()
+            if device is None or not device.playing():
+                logger.debug("scan refused, the sensor is not playing")
+                open_message_dialog(self.master, "scan_not_playing", ERROR_ICON)
+                return
             self.scanning = True
+            self._form = data
+            device.require_streams(CS_SCAN, self.__capture_streams())
             if data[PAS_TIME] == PAS_MANUAL:
                 self.manual_start()
             else:
@@ -597,22 +817,140 @@ class ScanController(Controller):
         return valid, missing
 
     def manual_start(self):
-        pass
+        self.__start_scan(None)
 
     def manual_stop(self):
-        pass
+        self.__finish_scan(keep=True)
 
     def timed_start(self):
-        pass
+        self.__start_scan(self._form[PAS_SEC])
 
     def timed_cancel(self):
-        pass
+        self.__finish_scan(keep=False)
+
+    def __face_source(self):
+        # faces on color frames reach the depth frame through the registration, without it they are found on ir
+        source = nect_config.get(FRAMES, FACE_SOURCE, fallback=FACE_SOURCE_DEFAULT)
+        if source == IB_COLOR and self.master.kinect.selected_device().registration() is None:
+            logger.warning("no stereo calibration to map color faces to depth, faces are detected on ir")
+            return IB_IR
+        return IB_COLOR if source == IB_COLOR else IB_IR
+
+    def __capture_streams(self):
+        streams = CS_SCAN_STREAMS[self._form[PAS_DATA]]
+        if self._form[PAS_FACE] == PAS_FACE_DETECT and self.__face_source() not in streams:
+            streams += (self.__face_source(),)
+        return streams
+
+    def preview_crop(self, enabled):
+        # the crop volume is shown on the previews while it is chosen in the form
+        device = self.master.kinect.selected_device()
+        if device is not None:
+            device.set_crop(CropVolume.from_config(device.ray_table()) if enabled else None)
+
+    def __scan_stages(self):
+        # the lens distortion goes first, the crop and the face are found on the undistorted frames
+        device = self.master.kinect.selected_device()
+        stages = []
+        rays = device.ray_table()
+        undistorted = False
+        if nect_config.getboolean(FRAMES, UNDISTORT, fallback=UNDISTORT_DEFAULT):
+            undistort = UndistortStage(device.serial())
+            if undistort.streams:
+                stages.append(undistort)
+                undistorted = IB_DEPTH in undistort.streams
+                rays = undistort.ray_table() if undistorted else rays
+        if self._form[PAS_FACE] == PAS_FACE_CROP:
+            # color is cut through the registration, without one it is stored whole
+            registration = device.registration(undistorted) if IB_COLOR in self.__capture_streams() else None
+            if IB_COLOR in self.__capture_streams() and registration is None:
+                logger.warning("no stereo calibration to map the crop volume to color, color is not cropped")
+            stages.append(CropVolume.from_config(rays, registration))
+        elif self._form[PAS_FACE] == PAS_FACE_DETECT:
+            source = self.__face_source()
+            registration = device.registration(undistorted) if source == IB_COLOR else None
+            detect_every = nect_config.getint(FRAMES, FACE_DETECT_EVERY, fallback=FACE_DETECT_EVERY_DEFAULT)
+            stages.append(FaceTracker(source, detect_every, registration))
+        return stages
+
+    def __start_scan(self, duration):
+        device = self.master.kinect.selected_device()
+        name = self.data.sections()[0]
+        folder = Path(self.data[name][P_PATH]) / F_SCANS
+        self._scan_path = folder / (device.serial() + time.strftime("_%Y%m%d_%H%M%S") + SCAN_EXTENSION)
+        metadata = {PAS_FPS: self._form[PAS_FPS], PAS_ROT: self._form[PAS_ROT], PAS_FACE: self._form[PAS_FACE],
+                    PAS_DATA: self._form[PAS_DATA]}
+        streams = CS_SCAN_STREAMS[self._form[PAS_DATA]]
+        stages = self.__scan_stages()
+        metadata[SCAN_UNDISTORTED] = [key for stage in stages if isinstance(stage, UndistortStage)
+                                      for key in stage.streams if key in streams]
+        if any(isinstance(stage, (CropVolume, FaceTracker)) for stage in stages):
+            streams += (SCAN_ROI,)
+        if not device.start_scan(self._scan_path, self._form[PAS_FPS], streams, duration, metadata, stages):
+            self._scan_path = None
+            self.release_streams()
+            open_message_dialog(self.master, "scan_failed", ERROR_ICON)
+            return
+        self.view.set_progress(0 if duration is not None else None)
+        self._after_id = self.master.after(SCAN_POLL_MS, self.__poll_scan)
+
+    def __poll_scan(self):
+        self._after_id = None
+        device = self.master.kinect.selected_device()
+        scan = device.scan() if device is not None else None
+        if scan is None:
+            self.__finish_scan(keep=False)
+            return
+        if scan.progress() is not None:
+            self.view.set_progress(scan.progress())
+        if scan.done():
+            self.__finish_scan(keep=True)
+        else:
+            self._after_id = self.master.after(SCAN_POLL_MS, self.__poll_scan)
+
+    def __finish_scan(self, keep):
+        if self._after_id is not None:
+            self.master.after_cancel(self._after_id)
+            self._after_id = None
+        device = self.master.kinect.selected_device()
+        stats = device.stop_scan() if device is not None else None
+        logger.debug(f"scan finished, keep {keep}: {stats}")
+        self.view.set_progress(None)
+        self.release_streams()
+        path, self._scan_path = self._scan_path, None
+        if stats is None or path is None:
+            return
+        if keep and not stats["written"]:
+            logger.warning(f"no frame was scanned, {path} discarded")
+            open_message_dialog(self.master, "scan_empty", ERROR_ICON)
+            keep = False
+        if not keep:
+            path.unlink(missing_ok=True)
+            return
+        if self._form[PAS_EXIST] == PAS_OVERRIDE:
+            # the old scans go only once the new one holds frames
+            for old in path.parent.glob("*" + SCAN_EXTENSION):
+                if old != path:
+                    logger.debug(f"override scan {old}")
+                    old.unlink()
+        self.data.set(P_SCAN, P_DONE, P_TRUE)
+        self.data.set(P_SCAN, P_SCAN_ROT, self._form[PAS_ROT])
+        write_project(self.data)
+        self.master.info_controller.update_view(self.data)
+        open_message_dialog(self.master, "scan_done")
+
+    def release_streams(self):
+        self.scanning = False
+        if self.master.kinect.selected_device() is not None:
+            self.master.kinect.selected_device().release_streams(CS_SCAN)
 
     def update_selected(self, data):
         logger.debug(f"update selected in Scan controller")
         if not self.data or (self.data and self.data != data):
             self.data = data
             self.view.update_selected_project(data)
+            # the form is cleared
+            self.preview_crop(False)
 
 
 class FinalController(Controller):
@@ -2,6 +2,7 @@ import os
 import shutil
 from configparser import ConfigParser
 
+from core.models.calibration_store import forget_calibration_store
 from core.util import nect_config
 from core.util.config import write_config, logger
 from core.util.constants import *
@@ -31,6 +32,7 @@ def restore_calibration_backup(serial):
         shutil.rmtree((calibration_path / serial))
     if (calibration_path / (serial + "_backup")).is_dir():
         os.rename((calibration_path / (serial + "_backup")), (calibration_path / serial))
+    forget_calibration_store(serial)
 
 
 def create_calibration_folder(serial, reset=False, backup=False):
@@ -41,6 +43,7 @@ def create_calibration_folder(serial, reset=False, backup=False):
         os.rename((calibration_path / serial), (calibration_path / (serial + "_backup")))
     elif reset and (calibration_path / serial).is_dir():
         shutil.rmtree((calibration_path / serial))
+    forget_calibration_store(serial)
     try:
         calibration_path.mkdir(parents=True, exist_ok=True)
         (calibration_path / serial).mkdir(parents=True, exist_ok=True)
@@ -62,6 +65,14 @@ def add_to_open_projects(path: Path, name=""):
     write_config()
 
 
+def write_project(p_config: ConfigParser):
+    # saves the project config file in place
+    name = p_config.sections()[0]
+    logger.debug(f"write project {name}.ini config file")
+    with open(Path(p_config[name][P_PATH]) / (name + '.ini'), 'w') as f:
+        p_config.write(f)
+
+
 def store_open_project(path, name):
     logger.debug(f"create project {name}.ini config file")
     p_config = ConfigParser()
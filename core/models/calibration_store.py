@@ -0,0 +1,263 @@
+import hashlib
+import itertools
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+from core.util.config import logger, nect_config
+from core.util.constants import *
+
+# store file layout:
+#   magic, version (uint8), json length (uint32), json header, float64 blob
+#   the header indexes the blob: corners of every image by content hash, object points by board, and the camera and
+#   stereo results. arrays are (offset, shape) in float64 items of the blob, which is memory mapped on first access
+STORE_MAGIC = b"PNCAL"
+STORE_VERSION = 1
+STORE_HEAD = len(STORE_MAGIC) + 5
+
+_stores = {}
+_stores_lock = threading.Lock()
+# every instance gets its own generation, so a revision of a reloaded store is never taken for one of the old store
+_generations = itertools.count(1)
+
+
+def file_signature(path):
+    # what tells a store file apart from the one an instance was read from, None if there is no file
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def calibration_store(serial) -> 'CalibrationStore':
+    # one instance per serial, so calibrators running one after the other see each other's entries. the instance is
+    # read again when its file was moved, replaced or removed behind it (calibration folder reset or restored)
+    path = Path(nect_config[CONFIG][CALIBRATION_PATH]) / serial / F_RESULTS / STORE_FILE
+    with _stores_lock:
+        store = _stores.get(serial)
+        if store is None or store.path != path or not store.current():
+            if store is not None:
+                logger.debug(f"calibration store {path} changed on disk, reloaded")
+            _stores[serial] = CalibrationStore(path)
+        return _stores[serial]
+
+
+def forget_calibration_store(serial):
+    # the next access reads the store of serial from disk again
+    with _stores_lock:
+        _stores.pop(serial, None)
+
+
+def image_hash(path) -> str:
+    with open(path, "rb") as file:
+        return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+
+def board_key(pattern_size, square_size):
+    return f"{pattern_size[0]}x{pattern_size[1]}@{square_size:g}"
+
+
+class CalibrationStore:
+    # every calibration input and output of one device in a single file, rewritten atomically on save
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._header = {"corners": {}, "objects": {}, "cameras": {}, "stereo": None, "selection": {}}
+        # arrays added or replaced since the last save, by header entry
+        self._pending = {}
+        self._blob = None
+        self._blob_offset = 0
+        self._signature = file_signature(path)
+        self.generation = next(_generations)
+        self.revision = 0
+        if path.is_file():
+            self.__read_header()
+
+    def __read_header(self):
+        with open(self.path, "rb") as file:
+            head = file.read(STORE_HEAD)
+            if head[:len(STORE_MAGIC)] != STORE_MAGIC:
+                logger.warning(f"{self.path} is not a calibration store, ignored")
+                return
+            version, length = struct.unpack("<BI", head[len(STORE_MAGIC):])
+            if version > STORE_VERSION:
+                logger.warning(f"unsupported calibration store version {version} in {self.path}, ignored")
+                return
+            self._header = json.loads(file.read(length).decode("utf-8"))
+            self._blob_offset = STORE_HEAD + length
+        self.revision = self._header.get("revision", 0)
+        logger.debug(f"calibration store {self.path}: {len(self._header['corners'])} images, revision {self.revision}")
+
+    def current(self):
+        # false when the file is not the one this instance read or last saved
+        with self._lock:
+            return file_signature(self.path) == self._signature
+
+    @property
+    def version(self):
+        # changes at every save and when the store is reloaded
+        return self.generation, self.revision
+
+    def __blob(self):
+        # mapped on first access, the header alone is enough to know what is cached
+        if self._blob is None and self.path.is_file() and os.path.getsize(self.path) > self._blob_offset:
+            self._blob = np.memmap(self.path, dtype=np.float64, mode="r", offset=self._blob_offset)
+        return self._blob
+
+    def __array(self, key, ref):
+        if key in self._pending:
+            return self._pending[key]
+        if ref is None:
+            return None
+        blob = self.__blob()
+        offset, shape = ref
+        size = int(np.prod(shape))
+        if blob is None or offset + size > len(blob):
+            # the file went away or was cut short: the entry is as good as never computed
+            logger.warning(f"{key} missing from calibration store {self.path}")
+            return None
+        return blob[offset:offset + size].reshape(shape)
+
+    # corners
+
+    def corners(self, digest, camera, pattern_size):
+        # (found, image size, image points) cached for an image content, None if it was never detected
+        with self._lock:
+            entry = self._header["corners"].get(digest)
+            if entry is None or entry["camera"] != camera or tuple(entry["pattern"]) != tuple(pattern_size):
+                return None
+            points = self.__array(("corners", digest), entry["points"]) if entry["found"] else None
+            if entry["found"] and points is None:
+                return None
+            return entry["found"], tuple(entry["size"]) if entry["size"] else None, points
+
+    def set_corners(self, digest, camera, name, pattern_size, size, points):
+        with self._lock:
+            self._header["corners"][digest] = {"camera": camera, "name": name, "pattern": list(pattern_size),
+                                               "size": list(size) if size is not None else None,
+                                               "found": points is not None, "points": None, "error": None}
+            self._pending.pop(("corners", digest), None)
+            if points is not None:
+                self._pending[("corners", digest)] = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+    def set_error(self, digest, error):
+        # reprojection error of one image in the last calibration
+        with self._lock:
+            self._header["corners"][digest]["error"] = float(error)
+
+    def error(self, digest):
+        with self._lock:
+            entry = self._header["corners"].get(digest)
+            return None if entry is None else entry["error"]
+
+    def images(self, camera):
+        # {content hash: name} of the images of camera with cached corners
+        with self._lock:
+            return {digest: entry["name"] for digest, entry in self._header["corners"].items()
+                    if entry["camera"] == camera}
+
+    def object_points(self, pattern_size, square_size):
+        key = board_key(pattern_size, square_size)
+        with self._lock:
+            points = self.__array(("objects", key), self._header["objects"].get(key))
+            if points is None:
+                points = np.zeros((np.prod(pattern_size), 3), np.float64)
+                points[:, :2] = np.indices(pattern_size).T.reshape(-1, 2)
+                points *= square_size
+                self._header["objects"][key] = None
+                self._pending[("objects", key)] = points
+            return points
+
+    # results
+
+    def set_selection(self, camera, chosen, rejected):
+        # content hashes of the images the last calibration of camera used, and {hash: reason} of the others
+        with self._lock:
+            self._header.setdefault("selection", {})[camera] = {"chosen": list(chosen), "rejected": dict(rejected)}
+
+    def selection(self, camera):
+        with self._lock:
+            return self._header.get("selection", {}).get(camera)
+
+    def set_camera(self, camera, camera_matrix, dist_coefs, rms, image_size, images):
+        with self._lock:
+            self._header["cameras"][camera] = {"camera_matrix": np.asarray(camera_matrix).tolist(),
+                                               "dist_coefs": np.asarray(dist_coefs).ravel().tolist(),
+                                               "rms": float(rms), "size": list(image_size), "images": list(images)}
+
+    def camera(self, camera):
+        # (camera matrix, distortion coefficients), None if not calibrated
+        with self._lock:
+            entry = self._header["cameras"].get(camera)
+            if entry is None:
+                return None
+            return np.array(entry["camera_matrix"]), np.array(entry["dist_coefs"])
+
+    def camera_info(self, camera):
+        with self._lock:
+            return self._header["cameras"].get(camera)
+
+    def set_stereo(self, rms, rotation, translation, essential, fundamental, images):
+        with self._lock:
+            self._header["stereo"] = {"rms": float(rms), "R": np.asarray(rotation).tolist(),
+                                      "T": np.asarray(translation).ravel().tolist(),
+                                      "E": np.asarray(essential).tolist(), "F": np.asarray(fundamental).tolist(),
+                                      "images": list(images)}
+
+    def stereo(self):
+        # (R, T) from the ir to the color camera, None if not calibrated
+        with self._lock:
+            entry = self._header.get("stereo")
+            if entry is None:
+                return None
+            return np.array(entry["R"]), np.array(entry["T"]).reshape(3, 1)
+
+    def stereo_info(self):
+        with self._lock:
+            return self._header.get("stereo")
+
+    def save(self):
+        with self._lock:
+            arrays = []
+            offset = 0
+            header = json.loads(json.dumps(self._header))
+            for section in ("corners", "objects"):
+                for key, entry in self._header[section].items():
+                    ref = entry["points"] if section == "corners" else entry
+                    array = self.__array((section, key), ref)
+                    if array is None:
+                        # corners found but lost with the file are detected again, object points are rebuilt
+                        if section == "corners" and entry["found"]:
+                            del header[section][key]
+                        elif section == "objects":
+                            del header[section][key]
+                        continue
+                    array = np.ascontiguousarray(array, dtype=np.float64)
+                    if section == "corners":
+                        header[section][key]["points"] = [offset, list(array.shape)]
+                    else:
+                        header[section][key] = [offset, list(array.shape)]
+                    arrays.append(array)
+                    offset += array.size
+            header["revision"] = self.revision + 1
+            encoded = json.dumps(header).encode("utf-8")
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "wb") as file:
+                file.write(STORE_MAGIC + struct.pack("<BI", STORE_VERSION, len(encoded)) + encoded)
+                for array in arrays:
+                    file.write(array.tobytes())
+            # the old mapping must be closed before the file is replaced
+            self._blob = None
+            os.replace(tmp, self.path)
+            self._signature = file_signature(self.path)
+            self._header = header
+            self._blob_offset = STORE_HEAD + len(encoded)
+            self._pending.clear()
+            self.revision = header["revision"]
+            logger.debug(f"saved calibration store {self.path}, revision {self.revision}")
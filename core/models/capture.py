@@ -0,0 +1,204 @@
+import threading
+import time
+
+import numpy as np
+
+from core.util.config import logger
+from core.util.constants import *
+
+# dtype and shape of each stream as returned by pylibfreenect2 Frame.asarray
+STREAM_DTYPES = {IB_COLOR: np.uint8, IB_IR: np.float32, IB_DEPTH: np.float32}
+STREAM_SHAPES = {IB_COLOR: IB_COLOR_SHAPE, IB_IR: IB_IR_SHAPE, IB_DEPTH: IB_DEPTH_SHAPE}
+
+
+class FrameSlot:
+    # one preallocated frame set of the ring, readable while its reference count is held
+
+    def __init__(self, ring, index, streams):
+        self._ring = ring
+        self.index = index
+        self.arrays = {key: np.zeros(STREAM_SHAPES[key], dtype=STREAM_DTYPES[key]) for key in streams}
+        # streams written in the last frame set, the other arrays hold stale data
+        self.streams = ()
+        self.sequence = 0
+        # frames of each stream captured up to this frame set, sequence counts frame sets of any stream
+        self.counts = {}
+        self.timestamp = None
+        self.refs = 0
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.streams
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def retain(self):
+        self._ring.retain(self)
+
+    def release(self):
+        self._ring.release(self)
+
+
+class FrameRing:
+    # fixed capacity ring of preallocated frame sets, every captured frame is copied in exactly once.
+    # readers acquire a slot (reference counted) and must release it, the writer never overwrites a held slot
+
+    def __init__(self, capacity=FRAME_BUFFER_DEFAULT, streams=IB_ALL):
+        logger.debug(f"allocate frame ring of {capacity} slots for {streams}")
+        self._lock = threading.Lock()
+        self._slots = [FrameSlot(self, index, streams) for index in range(max(2, capacity))]
+        self._head = None
+        self._sequence = 0
+        self._counts = {}
+        self.dropped = 0
+
+    def capacity(self):
+        return len(self._slots)
+
+    def sequence(self):
+        with self._lock:
+            return self._sequence
+
+    def __free_slot(self):
+        # oldest slot nobody is reading, the latest one is never reused
+        start = 0 if self._head is None else self._head.index + 1
+        for i in range(len(self._slots)):
+            slot = self._slots[(start + i) % len(self._slots)]
+            if slot.refs == 0 and slot is not self._head:
+                return slot
+        return None
+
+    def write(self, frames, streams, timestamp=None):
+        with self._lock:
+            slot = self.__free_slot()
+            if slot is None:
+                self.dropped += 1
+                return None
+            # unpublished while being written
+            slot.sequence = 0
+            slot.refs = 1
+        written = []
+        try:
+            for key in streams:
+                try:
+                    frame = frames[key]
+                except KeyError:
+                    # e.g. a stream missing from a recorded session, the slot only lists what it holds
+                    continue
+                np.copyto(slot.arrays[key], frame.asarray(dtype=STREAM_DTYPES[key]), casting="unsafe")
+                written.append(key)
+        except Exception:
+            # the slot is half written: it stays unpublished and free for the next frame set
+            with self._lock:
+                slot.refs = 0
+                slot.sequence = 0
+                slot.streams = ()
+                slot.counts = {}
+            raise
+        with self._lock:
+            self._sequence += 1
+            slot.sequence = self._sequence
+            slot.streams = tuple(written)
+            for key in written:
+                self._counts[key] = self._counts.get(key, 0) + 1
+            slot.counts = {key: self._counts[key] for key in written}
+            slot.timestamp = time.monotonic() if timestamp is None else timestamp
+            slot.refs -= 1
+            self._head = slot
+        return slot
+
+    def acquire_latest(self):
+        with self._lock:
+            if self._head is None:
+                return None
+            self._head.refs += 1
+            return self._head
+
+    def acquire_last(self, count):
+        # up to count most recent frame sets, newest first
+        with self._lock:
+            slots = sorted((slot for slot in self._slots if slot.sequence > 0), key=lambda slot: -slot.sequence)
+            slots = slots[:count]
+            for slot in slots:
+                slot.refs += 1
+            return slots
+
+    def retain(self, slot):
+        with self._lock:
+            slot.refs += 1
+
+    def release(self, slot):
+        with self._lock:
+            if slot.refs > 0:
+                slot.refs -= 1
+
+
+class CaptureThread(threading.Thread):
+    # acquisition thread of a single device, owns the listener so that Tk never waits on the sensor.
+    # the listener only needs hasNewFrame/waitForNewFrame/release, so a fake listener can be used in place of
+    # a SyncMultiFrameListener
+
+    def __init__(self, listener, serial, ring: FrameRing, streams=IB_ALL, poll_interval=0.002):
+        super().__init__(name=f"capture-{serial}", daemon=True)
+        self._listener = listener
+        self._serial = serial
+        self._ring = ring
+        self._streams = tuple(streams)
+        self._poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._playing = threading.Event()
+        self._frames = 0
+        # callables receiving every written slot on this thread, they must not block (e.g. a recorder queue)
+        self.sinks = []
+
+    def run(self):
+        logger.debug(f"capture thread of {self._serial} started")
+        while not self._stop_event.is_set():
+            # poll instead of blocking in waitForNewFrame, so stop() is never stuck behind the sensor
+            if not self._playing.is_set() or not self._listener.hasNewFrame():
+                self._stop_event.wait(self._poll_interval)
+                continue
+            frames = self._listener.waitForNewFrame()
+            try:
+                slot = self._ring.write(frames, self._streams)
+            except Exception as e:
+                # a bad frame set is lost, the capture goes on with the next one
+                logger.exception(f"capture of {self._serial} failed to copy a frame set: {e}")
+                continue
+            finally:
+                # give the frames back to libfreenect2 as soon as they are copied
+                self._listener.release(frames)
+            self._frames += 1
+            if slot is not None:
+                for sink in list(self.sinks):
+                    try:
+                        sink(slot)
+                    except Exception as e:
+                        logger.exception(f"capture sink {sink} of {self._serial} failed: {e}")
+        logger.debug(f"capture thread of {self._serial} stopped after {self._frames} frames, "
+                     f"{self._ring.dropped} dropped")
+
+    def set_streams(self, streams):
+        # streams copied from the listener, they must be a subset of the listener frame types
+        logger.debug(f"capture thread of {self._serial} copies {streams}")
+        self._streams = tuple(streams)
+
+    def play(self):
+        logger.debug(f"capture thread of {self._serial} play")
+        self._playing.set()
+
+    def pause(self):
+        logger.debug(f"capture thread of {self._serial} pause")
+        self._playing.clear()
+
+    def stop(self, timeout=1.0):
+        logger.debug(f"stop capture thread of {self._serial}")
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,171 @@
+import platform
+import threading
+import time
+
+import pylibfreenect2
+from pylibfreenect2 import FrameType, SyncMultiFrameListener
+
+from core.util.config import logger, nect_config, write_config
+from core.util.constants import *
+
+
+def available_pipelines():
+    # pipelines compiled in pylibfreenect2, in the historical fallback order
+    names = [name for name in PL_PIPELINES if hasattr(pylibfreenect2, name)]
+    logger.debug(f"available packet pipelines: {names}")
+    return names
+
+
+def _option(prefix, name):
+    return prefix + name
+
+
+class PipelineManager:
+    # chooses the packet pipeline of each device: per serial override, then the benchmark winner cached for this
+    # host, then the first pipeline that can be imported
+
+    def __init__(self, free_nect):
+        self._free_nect = free_nect
+        self._host = platform.node() or "localhost"
+        self.available = available_pipelines()
+        # name -> (decode fps, cpu usage of the whole process in % of one core). the decoding runs on libfreenect2
+        # threads, so the process time is measured and not the one of the benchmark thread
+        self.results = {}
+        # first start benchmark running off the tk thread, the fallback order is used until it is over
+        self._benchmark = None
+        # called from the tk loop once the benchmark released the devices
+        self._waiting = []
+        if not nect_config.has_section(PIPELINE):
+            nect_config.add_section(PIPELINE)
+
+    def host_pipeline(self):
+        name = nect_config.get(PIPELINE, _option(PL_HOST, self._host), fallback=None)
+        return name if name in self.available else None
+
+    def pipeline_name(self, serial):
+        name = nect_config.get(PIPELINE, _option(PL_SERIAL, serial), fallback=None)
+        if name in self.available:
+            return name
+        return self.host_pipeline() or self.available[0]
+
+    def override(self, serial):
+        name = nect_config.get(PIPELINE, _option(PL_SERIAL, serial), fallback=None)
+        return name if name in self.available else None
+
+    def set_override(self, serial, name=None):
+        logger.debug(f"set pipeline override of {serial} to {name}")
+        if name is None:
+            nect_config.remove_option(PIPELINE, _option(PL_SERIAL, serial))
+        else:
+            nect_config.set(PIPELINE, _option(PL_SERIAL, serial), name)
+        write_config()
+
+    def create(self, serial):
+        # every opened device owns its pipeline, libfreenect2 frees it on close. the benchmark holds the devices,
+        # callers open them through when_ready
+        name = self.pipeline_name(serial)
+        logger.info(f"Packet pipeline of {serial}: {name}")
+        return getattr(pylibfreenect2, name)()
+
+    def __needs_benchmark(self, serials, force):
+        return (force or not self.host_pipeline()) and serials and len(self.available) > 1
+
+    def select(self, serials, seconds=PL_BENCH_SECONDS, force=False):
+        # benchmark on first start only, the winner is cached per host in the config file
+        if not self.__needs_benchmark(serials, force):
+            return self.host_pipeline()
+        self.__measure(serials[0], seconds)
+        return self.__choose()
+
+    def select_async(self, root, serials, done, seconds=PL_BENCH_SECONDS, force=False) -> bool:
+        # select on a worker thread, done(winner) is called from the tk loop once it is over. False if there is
+        # nothing to benchmark
+        if self.benchmarking() or not self.__needs_benchmark(serials, force):
+            return False
+        self._benchmark = threading.Thread(target=self.__measure, args=(serials[0], seconds),
+                                           name="pipeline-benchmark", daemon=True)
+        self._benchmark.start()
+        self.__poll(root, done)
+        return True
+
+    def benchmarking(self):
+        # true until the winner is chosen, not only while the benchmark thread runs
+        return self._benchmark is not None
+
+    def when_ready(self, callback):
+        # callback runs now, or from the tk loop once the benchmark is over and its winner chosen
+        if self.benchmarking():
+            self._waiting.append(callback)
+        else:
+            callback()
+
+    def __poll(self, root, done):
+        if self._benchmark.is_alive():
+            root.after(PL_BENCH_POLL_MS, lambda: self.__poll(root, done))
+            return
+        self._benchmark = None
+        winner = self.__choose()
+        waiting, self._waiting = self._waiting, []
+        for callback in waiting:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"callback waiting for the pipeline benchmark failed: {e}")
+        done(winner)
+
+    def __measure(self, serial, seconds):
+        for name in self.available:
+            try:
+                self.results[name] = self.benchmark(serial, name, seconds)
+            except Exception as e:
+                logger.exception(f"{name} benchmark failed: {e}")
+                continue
+            fps, cpu = self.results[name]
+            logger.info(f"{name}: {fps:.1f} fps, {cpu:.0f}% process cpu")
+
+    def __choose(self):
+        # the config is only written here, on the thread that called select
+        if not self.results:
+            return None
+        for name, (fps, cpu) in self.results.items():
+            # % must be escaped for the config interpolation
+            nect_config.set(PIPELINE, _option(PL_BENCH, f"{self._host}_{name}"), f"{fps:.1f} fps {cpu:.0f}%% process cpu")
+        # the sensor caps fps, so pipelines within one frame per second are ranked by cpu usage
+        best_fps = max(fps for fps, _ in self.results.values())
+        winner = min((name for name, (fps, _) in self.results.items() if fps >= best_fps - 1),
+                     key=lambda name: self.results[name][1])
+        logger.info(f"Packet pipeline of host {self._host}: {winner}")
+        nect_config.set(PIPELINE, _option(PL_HOST, self._host), winner)
+        write_config()
+        return winner
+
+    def benchmark(self, serial, name, seconds=PL_BENCH_SECONDS, warm_up=0.5):
+        logger.debug(f"benchmark {name} on {serial} for {seconds}s")
+        listener = SyncMultiFrameListener(FrameType.Color | FrameType.Ir | FrameType.Depth)
+        device = self._free_nect.openDevice(serial.encode("utf-8"), pipeline=getattr(pylibfreenect2, name)())
+        device.setColorFrameListener(listener)
+        device.setIrAndDepthFrameListener(listener)
+        device.start()
+        try:
+            frames = 0
+            start = time.monotonic()
+            measure_start, cpu_start = None, None
+            while time.monotonic() - start < warm_up + seconds:
+                if measure_start is None and time.monotonic() - start >= warm_up:
+                    measure_start, cpu_start, frames = time.monotonic(), time.process_time(), 0
+                if listener.hasNewFrame():
+                    listener.release(listener.waitForNewFrame())
+                    frames += 1
+                else:
+                    time.sleep(0.001)
+            wall = time.monotonic() - measure_start
+            cpu = time.process_time() - cpu_start
+        finally:
+            device.stop()
+            device.close()
+        return frames / wall, cpu / wall * 100
+
+    def report(self):
+        # one line per benchmarked pipeline, the one used marked with *
+        return "\n".join(f"{'*' if name == self.host_pipeline() else '-'} {name}: {fps:.1f} fps, {cpu:.0f}% process cpu"
+                         for name, (fps, cpu) in self.results.items())
@@ -0,0 +1,274 @@
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import cv2 as open_cv
+import numpy as np
+
+from core.algorithms.depth_codec import encode_depth, decode_depth
+from core.util.config import logger, nect_config
+from core.util.constants import *
+
+# session file layout:
+#   header: magic, version (uint8), json length (uint32), json metadata (serial, camera params, streams)
+#   records: timestamp (float64, seconds), stream count (uint8), then for each stream
+#            name length (uint8), name, codec (uint8), ndim (uint8), shape (uint32 * ndim), payload length (uint32),
+#            payload
+REC_MAGIC = b"PNREC"
+REC_VERSION = 2
+REC_CODEC_ZLIB = 0
+REC_CODEC_JPEG = 1
+# depth in millimeters, see core.algorithms.depth_codec (version 2)
+REC_CODEC_DEPTH = 2
+REC_DTYPES = {IB_COLOR: np.uint8, IB_IR: np.float32, IB_DEPTH: np.float32}
+COLOR_PARAMS = ("fx", "fy", "cx", "cy")
+IR_PARAMS = ("fx", "fy", "cx", "cy", "k1", "k2", "k3", "p1", "p2")
+
+
+def is_replay_serial(serial: str) -> bool:
+    return serial.startswith(REPLAY_PREFIX)
+
+
+def replay_folder() -> Path:
+    return Path(nect_config.get(CONFIG, REPLAY_PATH, fallback=REPLAY_PATH_DEFAULT))
+
+
+def replay_serials():
+    folder = replay_folder()
+    if not folder.is_dir():
+        return []
+    return [REPLAY_PREFIX + path.stem for path in sorted(folder.glob("*" + REPLAY_EXTENSION))]
+
+
+def replay_session_path(serial: str) -> Path:
+    return replay_folder() / (serial[len(REPLAY_PREFIX):] + REPLAY_EXTENSION)
+
+
+def camera_params_dict(params, names):
+    if params is None:
+        return None
+    return {name: float(getattr(params, name)) for name in names if hasattr(params, name)}
+
+
+def _encode(key, array):
+    if key == IB_COLOR:
+        ok, payload = open_cv.imencode(".jpg", open_cv.cvtColor(array, open_cv.COLOR_BGRA2BGR),
+                                       [open_cv.IMWRITE_JPEG_QUALITY, 95])
+        return REC_CODEC_JPEG, payload.tobytes()
+    if key == IB_DEPTH:
+        return REC_CODEC_DEPTH, encode_depth(array)
+    return REC_CODEC_ZLIB, zlib.compress(np.ascontiguousarray(array).tobytes(), 1)
+
+
+def _decode(key, codec, shape, payload):
+    if codec == REC_CODEC_JPEG:
+        array = open_cv.imdecode(np.frombuffer(payload, dtype=np.uint8), open_cv.IMREAD_COLOR)
+        return open_cv.cvtColor(array, open_cv.COLOR_BGR2BGRA)
+    if codec == REC_CODEC_DEPTH:
+        return decode_depth(payload, REC_DTYPES[key])
+    return np.frombuffer(zlib.decompress(payload), dtype=REC_DTYPES[key]).reshape(shape)
+
+
+class SessionRecorder(threading.Thread):
+    # dumps live frame sets to a session file. slots are retained in the frame ring until written, so encoding
+    # never runs on the capture thread
+
+    def __init__(self, path: Path, serial, color_params=None, ir_params=None, streams=IB_ALL, max_pending=2):
+        super().__init__(name=f"recorder-{serial}", daemon=True)
+        self.path = path
+        self._streams = tuple(streams)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._metadata = {"serial": serial, "streams": list(self._streams),
+                          "color_params": camera_params_dict(color_params, COLOR_PARAMS),
+                          "ir_params": camera_params_dict(ir_params, IR_PARAMS)}
+        self._start_time = None
+        self.written = 0
+        self.dropped = 0
+
+    def push(self, slot):
+        # called from the capture thread, never blocks it. False if the frame set is dropped
+        slot.retain()
+        try:
+            self._queue.put_nowait(slot)
+        except queue.Full:
+            slot.release()
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        logger.debug(f"stop recording {self.path}")
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        logger.debug(f"start recording {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "wb") as file:
+            header = json.dumps(self._metadata).encode("utf-8")
+            file.write(REC_MAGIC + struct.pack("<BI", REC_VERSION, len(header)) + header)
+            while True:
+                slot = self._queue.get()
+                if slot is None:
+                    break
+                with slot:
+                    if self._start_time is None:
+                        self._start_time = slot.timestamp
+                    streams = [key for key in self._streams if key in slot]
+                    record = [struct.pack("<dB", slot.timestamp - self._start_time, len(streams))]
+                    for key in streams:
+                        codec, payload = _encode(key, slot[key])
+                        shape = slot[key].shape
+                        record.append(struct.pack(f"<B{len(key)}sBB{len(shape)}I", len(key), key.encode("ascii"),
+                                                  codec, len(shape), *shape))
+                        record.append(struct.pack("<I", len(payload)))
+                        record.append(payload)
+                file.write(b"".join(record))
+                self.written += 1
+        logger.info(f"recorded {self.written} frames to {self.path}, {self.dropped} dropped")
+
+
+class ReplayFrame:
+    # the subset of pylibfreenect2.Frame used by the capture path
+
+    def __init__(self, array, timestamp):
+        self._array = array
+        self.timestamp = timestamp
+        self.height, self.width = array.shape[:2]
+
+    def asarray(self, dtype=None):
+        return self._array if dtype is None else self._array.astype(dtype, copy=False)
+
+
+class ReplaySession:
+    # sequential reader of a session file, rewinds at the end
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "rb")
+        magic = self._file.read(len(REC_MAGIC))
+        if magic != REC_MAGIC:
+            self._file.close()
+            raise ValueError(f"{path} is not a recorded session")
+        version, header_length = struct.unpack("<BI", self._file.read(5))
+        if version > REC_VERSION:
+            self._file.close()
+            raise ValueError(f"unsupported session version {version} in {path}")
+        self.metadata = json.loads(self._file.read(header_length).decode("utf-8"))
+        self._first_record = self._file.tell()
+
+    def rewind(self):
+        self._file.seek(self._first_record)
+
+    def read(self):
+        # next (timestamp, frames) or None at the end of the session
+        head = self._file.read(9)
+        if len(head) < 9:
+            return None
+        timestamp, count = struct.unpack("<dB", head)
+        frames = {}
+        for _ in range(count):
+            name_length, = struct.unpack("<B", self._file.read(1))
+            key = self._file.read(name_length).decode("ascii")
+            codec, ndim = struct.unpack("<BB", self._file.read(2))
+            shape = struct.unpack(f"<{ndim}I", self._file.read(4 * ndim))
+            payload_length, = struct.unpack("<I", self._file.read(4))
+            frames[key] = ReplayFrame(_decode(key, codec, shape, self._file.read(payload_length)), timestamp)
+        return timestamp, frames
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayListener:
+    # stands in for SyncMultiFrameListener, frames become available at their recorded time divided by speed.
+    # a speed of 0 replays as fast as the consumer reads
+
+    def __init__(self, session: ReplaySession, speed=1.0, loop=True):
+        self._session = session
+        self._speed = speed
+        self._loop = loop
+        self._next = None
+        self._origin = None
+        self.running = False
+
+    def __due(self):
+        if self._speed <= 0:
+            return 0
+        return self._origin + self._next[0] / self._speed
+
+    def __prefetch(self):
+        if self._next is not None:
+            return True
+        self._next = self._session.read()
+        if self._next is None and self._loop:
+            self._session.rewind()
+            self._origin = None
+            self._next = self._session.read()
+        if self._next is not None and self._origin is None:
+            self._origin = time.monotonic() - (self._next[0] / self._speed if self._speed > 0 else 0)
+        return self._next is not None
+
+    def hasNewFrame(self):
+        return self.running and self.__prefetch() and time.monotonic() >= self.__due()
+
+    def waitForNewFrame(self):
+        while not self.__prefetch():
+            time.sleep(0.01)
+        delay = self.__due() - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        _, frames = self._next
+        self._next = None
+        return frames
+
+    def release(self, frames):
+        pass
+
+
+class ReplayDevice:
+    # the subset of pylibfreenect2.Freenect2Device used by DeviceView, backed by a session file
+
+    def __init__(self, serial, speed=None):
+        self._serial = serial
+        if speed is None:
+            speed = nect_config.getfloat(CONFIG, REPLAY_SPEED, fallback=REPLAY_SPEED_DEFAULT)
+        self._session = ReplaySession(replay_session_path(serial))
+        self.listener = ReplayListener(self._session, speed=speed)
+        logger.debug(f"open replay device {serial} from {self._session.path} at speed {speed}")
+
+    def getSerialNumber(self):
+        return self._serial
+
+    def setColorFrameListener(self, listener):
+        pass
+
+    def setIrAndDepthFrameListener(self, listener):
+        pass
+
+    def start(self):
+        self.listener.running = True
+
+    def startStreams(self, rgb, depth):
+        self.listener.running = rgb or depth
+
+    def stop(self):
+        self.listener.running = False
+
+    def close(self):
+        self.listener.running = False
+        self._session.close()
+
+    def streams(self):
+        # streams the session was recorded with
+        return tuple(key for key in IB_ALL if key in self._session.metadata.get("streams", IB_ALL))
+
+    def getColorCameraParams(self):
+        return SimpleNamespace(**(self._session.metadata.get("color_params") or {}))
+
+    def getIrCameraParams(self):
+        return SimpleNamespace(**(self._session.metadata.get("ir_params") or {}))
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from core.util.config import logger
+from core.util.constants import *
+
+
+class ScanEngine:
+    # picks frame sets at fps out of the capture stream for duration seconds (None: until stopped) and hands them to
+    # a writer, whose push(slot) returns False when it has no room (e.g. a SessionRecorder). frames are placed on a
+    # fixed monotonic grid started with the scan, each tick keeps the first frame within half a period of it, so the
+    # rate never drifts from the sensor clock. push is a capture sink, it never blocks the capture thread and the gui
+    # only polls progress()
+
+    def __init__(self, writer, fps, duration=None):
+        self._writer = writer
+        self._lock = threading.Lock()
+        self.fps = fps
+        self.period = 1 / fps
+        self.duration = duration
+        self.start_time = time.monotonic()
+        # index on the grid of the next frame to keep
+        self._next = 0
+        self.kept = 0
+        # ticks without a frame, and kept frames the writer had no room for
+        self.late = 0
+        self.dropped = 0
+        # sensor frames between ticks, not needed at this rate
+        self.skipped = 0
+        self.finished = False
+
+    def push(self, slot):
+        with self._lock:
+            if self.finished:
+                return
+            elapsed = slot.timestamp - self.start_time
+            if elapsed < -self.period / 2:
+                return
+            if self.duration is not None and elapsed >= self.duration - self.period / 2:
+                self.finished = True
+                return
+            tick = int(round(elapsed / self.period))
+            if tick < self._next:
+                self.skipped += 1
+                return
+            self.late += tick - self._next
+            self._next = tick + 1
+            self.kept += 1
+        if not self._writer.push(slot):
+            self.dropped += 1
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def progress(self):
+        # fraction of the duration elapsed, None for a scan without duration
+        if self.duration is None:
+            return None
+        return min(1.0, self.elapsed() / self.duration)
+
+    def done(self):
+        # true once the duration is over, even if the sensor stopped sending frames
+        return self.finished or (self.duration is not None and self.elapsed() >= self.duration)
+
+    def stats(self):
+        elapsed = min(self.elapsed(), self.duration) if self.duration is not None else self.elapsed()
+        return {"fps": self.fps, "seconds": elapsed, "expected": int(elapsed * self.fps), "kept": self.kept,
+                "late": self.late, "dropped": self.dropped, "skipped": self.skipped}
+
+    def stop(self):
+        with self._lock:
+            self.finished = True
+        stats = self.stats()
+        logger.info(f"scan stopped after {stats['seconds']:.1f}s: {stats['kept']} frames kept of "
+                    f"{stats['expected']} expected, {stats['late']} late, {stats['dropped']} dropped")
+        return stats
@@ -0,0 +1,322 @@
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import cv2 as open_cv
+import numpy as np
+
+from core.algorithms.depth_codec import encode_depth, decode_depth
+from core.models.capture import STREAM_SHAPES
+from core.models.replay import camera_params_dict, COLOR_PARAMS, IR_PARAMS
+from core.util.config import logger
+from core.util.constants import *
+
+# scan file layout, every block is appended and never rewritten:
+#   header: magic, version (uint8), json length (uint32), json metadata (serial, streams, shapes, camera params, ...)
+#   blocks: tag (4 bytes), payload length (uint64), crc32 of the payload (uint32), payload
+#     chunk: frame count n (uint32), timestamps (float64 * n), codecs (uint8 * n * streams),
+#            lengths (uint32 * n * streams), then the payloads of the frames, streams in header order
+#     index: frame count n (uint32), timestamps (float64 * n), codecs (uint8 * n * streams),
+#            offsets (uint64 * n * streams), lengths (uint32 * n * streams)
+#   trailer: offset of the last index block (uint64), trailer magic
+# a file without a valid trailer (the writer crashed) is read by walking the chunks up to the first damaged one
+SCAN_MAGIC = b"PNSCAN"
+SCAN_VERSION = 2
+SCAN_TRAILER_MAGIC = b"PNSCANIX"
+SCAN_BLOCK = struct.Struct("<4sQI")
+SCAN_TRAILER = struct.Struct("<Q8s")
+SCAN_TAG_CHUNK = b"CHNK"
+SCAN_TAG_INDEX = b"INDX"
+# payload codecs, a stream missing from a frame set has length 0
+SCAN_CODEC_RAW = 0
+SCAN_CODEC_SHUFFLE_ZLIB = 1
+SCAN_CODEC_JPEG = 2
+# depth in millimeters, see core.algorithms.depth_codec (version 2)
+SCAN_CODEC_DEPTH = 3
+SCAN_DTYPES = {IB_COLOR: np.uint8, IB_IR: np.float32, IB_DEPTH: np.float32, SCAN_ROI: np.int32}
+SCAN_SHAPES = {**STREAM_SHAPES, SCAN_ROI: (4,)}
+SCAN_JPEG_QUALITY = 95
+
+
+def encode_stream(key, array):
+    if key == IB_COLOR:
+        ok, payload = open_cv.imencode(".jpg", open_cv.cvtColor(array, open_cv.COLOR_BGRA2BGR),
+                                       [open_cv.IMWRITE_JPEG_QUALITY, SCAN_JPEG_QUALITY])
+        return SCAN_CODEC_JPEG, payload.tobytes()
+    if key == IB_DEPTH:
+        return SCAN_CODEC_DEPTH, encode_depth(array)
+    if key == SCAN_ROI:
+        return SCAN_CODEC_RAW, np.ascontiguousarray(array, dtype=SCAN_DTYPES[key]).tobytes()
+    # float planes: the bytes of the same significance together compress far better than interleaved
+    array = np.ascontiguousarray(array)
+    planes = array.view(np.uint8).reshape(-1, array.itemsize).T
+    return SCAN_CODEC_SHUFFLE_ZLIB, zlib.compress(np.ascontiguousarray(planes).tobytes(), 1)
+
+
+def decode_stream(key, codec, shape, payload):
+    if codec == SCAN_CODEC_JPEG:
+        array = open_cv.imdecode(np.frombuffer(payload, dtype=np.uint8), open_cv.IMREAD_COLOR)
+        return open_cv.cvtColor(array, open_cv.COLOR_BGR2BGRA)
+    if codec == SCAN_CODEC_DEPTH:
+        return decode_depth(payload, SCAN_DTYPES[key])
+    dtype = np.dtype(SCAN_DTYPES[key])
+    if codec == SCAN_CODEC_RAW:
+        # a copy, arrays must not keep the mapping of the file alive
+        return np.frombuffer(payload, dtype=dtype).reshape(shape).copy()
+    if codec == SCAN_CODEC_SHUFFLE_ZLIB:
+        planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(dtype.itemsize, -1)
+        return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+    raise ValueError(f"unknown codec {codec} of stream {key}")
+
+
+class ScanWriter(threading.Thread):
+    # writes frame sets to a scan file in chunks of chunk_frames. slots are retained only while encoded, a chunk is
+    # written and synced to disk in one go, so a crash loses at most the chunk being filled. push never blocks the
+    # capture thread and returns False when the frame set is dropped.
+    # stages are called in order on the arrays of every frame set before it is stored, e.g. a FaceTracker. they
+    # must not write to the arrays they get, the frame ring owns them
+
+    def __init__(self, path: Path, serial, color_params=None, ir_params=None, streams=IB_ALL,
+                 chunk_frames=SCAN_CHUNK_FRAMES, max_pending=SCAN_MAX_PENDING, metadata=None, stages=()):
+        super().__init__(name=f"scan-{serial}", daemon=True)
+        self.path = path
+        self._streams = tuple(streams)
+        self._chunk_frames = chunk_frames
+        self._stages = tuple(stages)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._metadata = {"serial": serial, "streams": list(self._streams),
+                          "shapes": {key: list(SCAN_SHAPES[key]) for key in self._streams},
+                          "color_params": camera_params_dict(color_params, COLOR_PARAMS),
+                          "ir_params": camera_params_dict(ir_params, IR_PARAMS), **(metadata or {})}
+        self._start_time = None
+        # index of every frame written so far
+        self._timestamps = []
+        self._codecs = []
+        self._offsets = []
+        self._lengths = []
+        self.written = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def push(self, slot):
+        slot.retain()
+        try:
+            self._queue.put_nowait(slot)
+        except queue.Full:
+            slot.release()
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        logger.debug(f"stop scan file {self.path}")
+        self._queue.put(None)
+        self.join()
+
+    def __encode(self, slot):
+        with slot:
+            if self._start_time is None:
+                self._start_time = slot.timestamp
+            timestamp = slot.timestamp - self._start_time
+            arrays = {key: slot[key] for key in slot.streams}
+            for stage in self._stages:
+                arrays = stage(arrays)
+            encoded = [encode_stream(key, arrays[key]) if key in arrays else (SCAN_CODEC_RAW, b"")
+                       for key in self._streams]
+        return timestamp, encoded
+
+    def __write_block(self, file, tag, parts):
+        payload = b"".join(parts)
+        offset = file.tell()
+        file.write(SCAN_BLOCK.pack(tag, len(payload), zlib.crc32(payload)))
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+        self.bytes = file.tell()
+        return offset
+
+    def __write_chunk(self, file, frames):
+        timestamps = np.array([timestamp for timestamp, _ in frames], dtype=np.float64)
+        codecs = np.array([[codec for codec, _ in encoded] for _, encoded in frames], dtype=np.uint8)
+        lengths = np.array([[len(payload) for _, payload in encoded] for _, encoded in frames], dtype=np.uint32)
+        table = [struct.pack("<I", len(frames)), timestamps.tobytes(), codecs.tobytes(), lengths.tobytes()]
+        data_start = file.tell() + SCAN_BLOCK.size + sum(len(part) for part in table)
+        offsets = data_start + np.concatenate(([0], np.cumsum(lengths, dtype=np.uint64)[:-1])).astype(np.uint64)
+        self.__write_block(file, SCAN_TAG_CHUNK, table + [payload for _, encoded in frames for _, payload in encoded])
+        self._timestamps.append(timestamps)
+        self._codecs.append(codecs)
+        self._offsets.append(offsets.reshape(lengths.shape))
+        self._lengths.append(lengths)
+        self.written += len(frames)
+
+    def __write_index(self, file):
+        count = self.written
+        streams = len(self._streams)
+        timestamps = np.concatenate(self._timestamps) if count else np.empty(0, dtype=np.float64)
+        codecs = np.concatenate(self._codecs) if count else np.empty((0, streams), dtype=np.uint8)
+        offsets = np.concatenate(self._offsets) if count else np.empty((0, streams), dtype=np.uint64)
+        lengths = np.concatenate(self._lengths) if count else np.empty((0, streams), dtype=np.uint32)
+        offset = self.__write_block(file, SCAN_TAG_INDEX, [struct.pack("<I", count), timestamps.tobytes(),
+                                                           codecs.tobytes(), offsets.tobytes(), lengths.tobytes()])
+        file.write(SCAN_TRAILER.pack(offset, SCAN_TRAILER_MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+
+    def run(self):
+        logger.debug(f"start scan file {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "wb") as file:
+            header = json.dumps(self._metadata).encode("utf-8")
+            file.write(SCAN_MAGIC + struct.pack("<BI", SCAN_VERSION, len(header)) + header)
+            frames = []
+            while True:
+                slot = self._queue.get()
+                if slot is None:
+                    break
+                frames.append(self.__encode(slot))
+                if len(frames) >= self._chunk_frames:
+                    self.__write_chunk(file, frames)
+                    frames = []
+            if frames:
+                self.__write_chunk(file, frames)
+            self.__write_index(file)
+            self.bytes = file.tell()
+        logger.info(f"scanned {self.written} frames to {self.path} ({self.bytes / 2 ** 20:.1f} MiB), "
+                    f"{self.dropped} dropped")
+
+
+class ScanFile:
+    # random access reader of a scan file, memory mapped: opening reads only the header and the index, a frame is
+    # decoded straight from the mapping when asked for
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path} is empty")
+        try:
+            self.__read_header()
+            self.recovered = not self.__read_index()
+            if self.recovered:
+                self.__recover()
+        except Exception:
+            self.close()
+            raise
+        self.streams = tuple(self.metadata["streams"])
+        self._shapes = {key: tuple(shape) for key, shape in self.metadata["shapes"].items()}
+
+    def __read_header(self):
+        if self._map[:len(SCAN_MAGIC)] != SCAN_MAGIC:
+            raise ValueError(f"{self.path} is not a scan file")
+        version, header_length = struct.unpack_from("<BI", self._map, len(SCAN_MAGIC))
+        if version > SCAN_VERSION:
+            raise ValueError(f"unsupported scan file version {version} in {self.path}")
+        start = len(SCAN_MAGIC) + 5
+        self.metadata = json.loads(self._map[start:start + header_length].decode("utf-8"))
+        self._first_block = start + header_length
+
+    def __tables(self, offset, with_offsets):
+        # arrays of a chunk or index payload starting at offset, views on the mapping
+        streams = len(self.metadata["streams"])
+        count, = struct.unpack_from("<I", self._map, offset)
+        offset += 4
+        timestamps = np.frombuffer(self._map, dtype=np.float64, count=count, offset=offset)
+        offset += timestamps.nbytes
+        codecs = np.frombuffer(self._map, dtype=np.uint8, count=count * streams, offset=offset)
+        offset += codecs.nbytes
+        offsets = None
+        if with_offsets:
+            offsets = np.frombuffer(self._map, dtype=np.uint64, count=count * streams, offset=offset)
+            offset += offsets.nbytes
+        lengths = np.frombuffer(self._map, dtype=np.uint32, count=count * streams, offset=offset)
+        offset += lengths.nbytes
+        return (timestamps, codecs.reshape(count, streams), None if offsets is None else
+                offsets.reshape(count, streams), lengths.reshape(count, streams), offset)
+
+    def __read_index(self):
+        size = len(self._map)
+        if size < self._first_block + SCAN_TRAILER.size:
+            return False
+        offset, magic = SCAN_TRAILER.unpack_from(self._map, size - SCAN_TRAILER.size)
+        if magic != SCAN_TRAILER_MAGIC or offset + SCAN_BLOCK.size > size:
+            return False
+        tag, _, _ = SCAN_BLOCK.unpack_from(self._map, offset)
+        if tag != SCAN_TAG_INDEX:
+            return False
+        self.timestamps, self._codecs, self._offsets, self._lengths, _ = self.__tables(offset + SCAN_BLOCK.size,
+                                                                                       True)
+        return True
+
+    def __recover(self):
+        # walks the chunks written before the crash, stops at the first incomplete or damaged one
+        logger.warning(f"scan file {self.path} has no index, recovering its chunks")
+        timestamps, codecs, offsets, lengths = [], [], [], []
+        position = self._first_block
+        while position + SCAN_BLOCK.size <= len(self._map):
+            tag, length, crc = SCAN_BLOCK.unpack_from(self._map, position)
+            start = position + SCAN_BLOCK.size
+            if tag not in (SCAN_TAG_CHUNK, SCAN_TAG_INDEX) or start + length > len(self._map) or \
+                    zlib.crc32(self._map[start:start + length]) != crc:
+                break
+            if tag == SCAN_TAG_CHUNK:
+                chunk_timestamps, chunk_codecs, _, chunk_lengths, data_start = self.__tables(start, False)
+                chunk_offsets = data_start + np.concatenate(
+                    ([0], np.cumsum(chunk_lengths, dtype=np.uint64)[:-1])).astype(np.uint64)
+                timestamps.append(chunk_timestamps)
+                codecs.append(chunk_codecs)
+                offsets.append(chunk_offsets.reshape(chunk_lengths.shape))
+                lengths.append(chunk_lengths)
+            position = start + length
+        streams = len(self.metadata["streams"])
+        self.timestamps = np.concatenate(timestamps) if timestamps else np.empty(0, dtype=np.float64)
+        self._codecs = np.concatenate(codecs) if codecs else np.empty((0, streams), dtype=np.uint8)
+        self._offsets = np.concatenate(offsets) if offsets else np.empty((0, streams), dtype=np.uint64)
+        self._lengths = np.concatenate(lengths) if lengths else np.empty((0, streams), dtype=np.uint32)
+        logger.info(f"recovered {len(self.timestamps)} frames of {self.path}")
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def has(self, index, key):
+        return self._lengths[index, self.streams.index(key)] > 0
+
+    def read(self, index, key):
+        # array of stream key of frame set index, None if the frame set does not have it
+        column = self.streams.index(key)
+        length = int(self._lengths[index, column])
+        if length == 0:
+            return None
+        offset = int(self._offsets[index, column])
+        return decode_stream(key, int(self._codecs[index, column]), self._shapes[key],
+                             memoryview(self._map)[offset:offset + length])
+
+    def frame(self, index, streams=None):
+        # (timestamp, {stream: array}) of frame set index
+        streams = self.streams if streams is None else streams
+        arrays = {key: self.read(index, key) for key in streams if self.has(index, key)}
+        return float(self.timestamps[index]), arrays
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.frame(index)
+
+    def close(self):
+        # arrays of the index are views on the mapping, they are dropped before it is closed
+        self.timestamps = self._codecs = self._offsets = self._lengths = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
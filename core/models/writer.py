@@ -0,0 +1,155 @@
+import collections
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import cv2 as open_cv
+import numpy as np
+
+from core.util.config import logger
+from core.util.constants import *
+
+
+class WriteJob:
+    # one image file: prepare turns the arrays handed over into the image to encode, the extension of path picks the
+    # format. arrays belong to the job from submission on, the caller must not touch them anymore
+
+    def __init__(self, path, arrays, prepare=None, tag=None):
+        self.path = Path(path)
+        self.arrays = arrays
+        self.prepare = prepare
+        self.tag = tag
+        self.submitted = time.monotonic()
+        self.latency = None
+        self.error = None
+
+
+class WriterPool:
+    # bounded pool of threads encoding and writing images off the tk thread. submit never blocks, a full queue
+    # rejects the job. finished jobs are collected with completed(), the WR_EVENT virtual event announces them at the
+    # next check of the tk loop so the workers never call tk
+
+    def __init__(self, root, workers=WR_WORKERS, depth=WR_QUEUE_DEPTH, fsync=True):
+        self._root = root
+        self._fsync = fsync
+        self._queue = queue.Queue(maxsize=depth)
+        self._done = collections.deque()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self.depth = depth
+        self.max_pending = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self._latency_total = 0.0
+        self.worst_latency = 0.0
+        self._after_id = None
+        self._workers = [threading.Thread(target=self.__work, name=f"writer-{i}", daemon=True) for i in
+                         range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self._root.after(WR_FLUSH_POLL_MS, self.__notify)
+
+    def __notify(self):
+        if self._done:
+            self._root.event_generate(WR_EVENT, when="tail")
+        self._after_id = self._root.after(WR_FLUSH_POLL_MS, self.__notify)
+
+    def submit(self, path, arrays, prepare=None, tag=None) -> bool:
+        job = WriteJob(path, arrays, prepare, tag)
+        with self._condition:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                logger.warning(f"writer queue full, {path} not written")
+                return False
+            self._pending += 1
+            self.max_pending = max(self.max_pending, self._pending)
+        return True
+
+    def pending(self):
+        with self._condition:
+            return self._pending
+
+    def completed(self):
+        # jobs finished since the last call, job.error is None if the file was written
+        jobs = []
+        while self._done:
+            jobs.append(self._done.popleft())
+        return jobs
+
+    def flush(self, timeout=None) -> bool:
+        # waits for every submitted job, not to be called from the tk thread
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def when_flushed(self, callback):
+        # calls callback from the tk loop once every job submitted so far is finished
+        if self.pending() == 0:
+            callback()
+        else:
+            self._root.after(WR_FLUSH_POLL_MS, lambda: self.when_flushed(callback))
+
+    def stats(self):
+        with self._condition:
+            done = self.written + self.failed
+            return {"pending": self._pending, "max_pending": self.max_pending, "depth": self.depth,
+                    "written": self.written, "failed": self.failed, "rejected": self.rejected,
+                    "mean_ms": self._latency_total / done * 1000 if done else 0.0,
+                    "worst_ms": self.worst_latency * 1000}
+
+    def stop(self):
+        if self._after_id is not None:
+            self._root.after_cancel(self._after_id)
+            self._after_id = None
+        self.flush()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        logger.debug(f"writer pool stopped: {self.stats()}")
+
+    def __write(self, job: WriteJob):
+        image = job.prepare(job.arrays) if job.prepare is not None else job.arrays
+        ok, encoded = open_cv.imencode(job.path.suffix, image)
+        if not ok:
+            raise ValueError(f"{job.path.suffix} encoding failed")
+        job.path.parent.mkdir(parents=True, exist_ok=True)
+        # readers never see a partial file
+        tmp = job.path.with_name(job.path.name + ".tmp")
+        with open(tmp, "wb") as file:
+            file.write(np.asarray(encoded).tobytes())
+            if self._fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp, job.path)
+
+    def __work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self.__write(job)
+            except Exception as e:
+                logger.exception(f"writing {job.path} failed")
+                job.error = e
+            # the buffers are not needed anymore
+            job.arrays = None
+            job.latency = time.monotonic() - job.submitted
+            with self._condition:
+                self._pending -= 1
+                if job.error is None:
+                    self.written += 1
+                else:
+                    self.failed += 1
+                self._latency_total += job.latency
+                self.worst_latency = max(self.worst_latency, job.latency)
+                self._condition.notify_all()
+            self._done.append(job)
@@ -51,16 +51,34 @@ if not exist:
         PROJECTS_FOLDER: PROJECTS_FOLDER_DEFAULT,
         GUIDE_FILE: GUIDE_FILE_DEFAULT,
         REFRESH_RATE: REFRESH_RATE_15FPS,
-        CALIBRATION_PATH: CALIBRATION_PATH_DEFAULT
+        CALIBRATION_PATH: CALIBRATION_PATH_DEFAULT,
+        REPLAY_PATH: REPLAY_PATH_DEFAULT,
+        REPLAY_SPEED: REPLAY_SPEED_DEFAULT
     }
     nect_config[CALIBRATION] = {
         SQUARE_SIZE: SQUARE_SIZE_DEFAULT,
-        PATTERN_SIZE: PATTERN_SIZE_DEFAULT
+        PATTERN_SIZE: PATTERN_SIZE_DEFAULT,
+        CAPTURE_INTERVAL: CAPTURE_INTERVAL_DEFAULT,
+        AUTO_STILL_FRAMES: AUTO_STILL_FRAMES_DEFAULT,
+        AUTO_STILL_MOTION: AUTO_STILL_MOTION_DEFAULT,
+        MAX_FRAMES: MAX_FRAMES_DEFAULT
     }
     nect_config[FRAMES] = {
         IR_IMAGE_SIZE: IR_IMAGE_SIZE_DEFAULT,
         RGB_IMAGE_SIZE: RGB_IMAGE_SIZE_DEFAULT,
-        INDEX_FOR_BACKGROUND: INDEX_FOR_BACKGROUND_DEFAULT
+        INDEX_FOR_BACKGROUND: INDEX_FOR_BACKGROUND_DEFAULT,
+        FRAME_BUFFER: FRAME_BUFFER_DEFAULT,
+        IR_COLORMAP: IR_COLORMAP_DEFAULT,
+        DEPTH_COLORMAP: DEPTH_COLORMAP_DEFAULT,
+        DEPTH_MIN: DEPTH_MIN_DEFAULT,
+        DEPTH_MAX: DEPTH_MAX_DEFAULT,
+        UNDISTORT: UNDISTORT_DEFAULT,
+        FACE_SOURCE: FACE_SOURCE_DEFAULT,
+        FACE_DETECT_EVERY: FACE_DETECT_EVERY_DEFAULT,
+        CROP_NEAR: CROP_NEAR_DEFAULT,
+        CROP_FAR: CROP_FAR_DEFAULT,
+        CROP_BOX: CROP_BOX_DEFAULT,
+        CROP_BOX_3D: CROP_BOX_3D_DEFAULT
     }
     nect_config[OPEN_PROJECTS] = {}
 # global logger
@@ -73,6 +91,7 @@ IR_IMAGE_SIZE_PARSED = __config_tuple_parse(nect_config[FRAMES][IR_IMAGE_SIZE])
 RGB_IMAGE_SIZE_PARSED = __config_tuple_parse(nect_config[FRAMES][RGB_IMAGE_SIZE])
 RGB_IMAGE_SIZE_HALVED = tuple(x // 2 for x in RGB_IMAGE_SIZE_PARSED)
 PATTERN_SIZE_PARSED = __config_tuple_parse(nect_config[CALIBRATION][PATTERN_SIZE])
+FRAME_BUFFER_PARSED = nect_config.getint(FRAMES, FRAME_BUFFER, fallback=FRAME_BUFFER_DEFAULT)
 
 
 if not exist:
@@ -9,6 +9,7 @@ OPEN_PROJECTS = "open projects"
 CONFIG = "config"
 CALIBRATION = "calibration"
 FRAMES = "frames"
+PIPELINE = "pipeline"
 # config file config section items
 LANGUAGE = "language"
 I18N_PATH = "i18n_path"
@@ -20,6 +21,8 @@ PROJECTS_FOLDER = "projects_folder"
 GUIDE_FILE = "guide_file"
 REFRESH_RATE = "fps"
 CALIBRATION_PATH = "calibration_path"
+REPLAY_PATH = "replay_path"
+REPLAY_SPEED = "replay_speed"
 # config file config section default values
 LANGUAGE_DEFAULT = "it"
 I18N_PATH_DEFAULT = "var/i18n/"
@@ -29,20 +32,62 @@ LOG_FOLDER_DEFAULT = "var/.logs/"
 PROJECTS_FOLDER_DEFAULT = "projects/"
 GUIDE_FILE_DEFAULT = "var/guide.pdf"
 CALIBRATION_PATH_DEFAULT = "var/.calibration"
+REPLAY_PATH_DEFAULT = "var/.replay"
+REPLAY_SPEED_DEFAULT = 1.0
 # config file calibration section items
 SQUARE_SIZE = "square_size"
 PATTERN_SIZE = "pattern_size"
+CAPTURE_INTERVAL = "capture_interval"
+AUTO_STILL_FRAMES = "auto_still_frames"
+AUTO_STILL_MOTION = "auto_still_motion"
+MAX_FRAMES = "max_frames"
 # config file calibration section default values
 SQUARE_SIZE_DEFAULT = 0.03
 PATTERN_SIZE_DEFAULT = (6, 8)
+# seconds between timed captures
+CAPTURE_INTERVAL_DEFAULT = 2.0
+# detections the board must stay still for, and the mean corner motion (fraction of the image) still allows
+AUTO_STILL_FRAMES_DEFAULT = 4
+AUTO_STILL_MOTION_DEFAULT = 0.004
+# pictures a calibration is solved from at most, the most informative ones are chosen
+MAX_FRAMES_DEFAULT = 25
 # config file config section items
 IR_IMAGE_SIZE = "ir_image_size"
 RGB_IMAGE_SIZE = "rgb_image_size"
 INDEX_FOR_BACKGROUND = "indexForBackground"
+FRAME_BUFFER = "frame_buffer"
+IR_COLORMAP = "ir_colormap"
+DEPTH_COLORMAP = "depth_colormap"
+DEPTH_MIN = "depth_min"
+DEPTH_MAX = "depth_max"
+UNDISTORT = "undistort"
+FACE_SOURCE = "face_source"
+FACE_DETECT_EVERY = "face_detect_every"
+CROP_NEAR = "crop_near"
+CROP_FAR = "crop_far"
+CROP_BOX = "crop_box"
+CROP_BOX_3D = "crop_box_3d"
 # config file config section default values
 IR_IMAGE_SIZE_DEFAULT = (512, 424)
 RGB_IMAGE_SIZE_DEFAULT = (1920, 1080)
 INDEX_FOR_BACKGROUND_DEFAULT = 255
+FRAME_BUFFER_DEFAULT = 4
+IR_COLORMAP_DEFAULT = "gray"
+DEPTH_COLORMAP_DEFAULT = "gray"
+DEPTH_MIN_DEFAULT = 0
+DEPTH_MAX_DEFAULT = 5000
+# frames of calibrated devices are undistorted
+UNDISTORT_DEFAULT = True
+# stream faces are detected on in PAS_FACE_DETECT scans, frames between two detections (tracked in between)
+FACE_SOURCE_DEFAULT = "ir"
+FACE_DETECT_EVERY_DEFAULT = 5
+# crop volume of PAS_FACE_CROP scans: depth window in millimeters, box (x0, y0, x1, y1) on the raw depth frame and box
+# (x_min, x_max, y_min, y_max) in millimeters around the ir camera axis, empty for none. the previews show what is cut
+# in the INDEX_FOR_BACKGROUND gray level
+CROP_NEAR_DEFAULT = 400
+CROP_FAR_DEFAULT = 1500
+CROP_BOX_DEFAULT = ""
+CROP_BOX_3D_DEFAULT = ""
 
 # project config file items
 P_NAME = "name"
@@ -72,6 +117,88 @@ F_IR = "IR"
 CF_RGB = "rgb"
 CF_STEREO = "rgb_to_ir"
 CF_IR = "ir"
+STORE_FILE = "calibration.pncal"
+REGISTRATION_FILE = "registration.npz"
+# depth is in millimeters, the calibration in the unit of the square size (meters)
+REG_DEPTH_SCALE = 0.001
+# chessboard detection: the board is searched on the first pyramid level whose long side fits this
+CB_PYRAMID_MAX_SIDE = 640
+CB_STAGE_LOAD = "load"
+CB_STAGE_PYRAMID = "pyramid"
+CB_STAGE_SEARCH = "search"
+CB_STAGE_REFINE = "refine"
+# half size of the corner refinement window around an exact corner, the uncertainty of the corner is added to it
+CB_SUBPIX_WIN = 5
+# live detection while taking calibration pictures: long side of the color image searched, seconds a detection is
+# valid, ms between checks from the gui
+CB_LIVE_MAX_SIDE = 640
+CB_LIVE_MAX_AGE = 0.5
+CB_LIVE_POLL_MS = 100
+# ms between checks of a running calibration
+CALIBRATION_POLL_MS = 200
+# image writer pool: threads, jobs queued at most, virtual event raised for every finished job, ms between checks of
+# the pending jobs from the gui
+WR_WORKERS = 2
+WR_QUEUE_DEPTH = 16
+WR_EVENT = "<<WriteDone>>"
+WR_FLUSH_POLL_MS = 50
+# ms between two logs of the display, writer and preview counters, only when logging at debug level
+STATS_LOG_MS = 10000
+# scan capture: ms between checks of a running scan from the gui, frame sets waiting to be written at most, frame
+# sets per chunk of a scan file (lost at most on a crash)
+SCAN_POLL_MS = 100
+SCAN_MAX_PENDING = 2
+SCAN_CHUNK_FRAMES = 30
+# region of the depth frame (x0, y0, x1, y1) kept by the scan stages, stored as a stream of the scan file
+SCAN_ROI = "roi"
+# metadata of a scan: streams stored without lens distortion
+SCAN_UNDISTORTED = "undistorted"
+# step of the depth pixels of a crop volume mapped to the color frame
+CROP_COLOR_STEP = 4
+# face detection: width of the frame the cascade runs on, smallest face in pixels of that frame, growth of the face
+# on every side (the cascade box leaves out forehead and chin), growth of the tracking search window, least match
+# score of a tracked face, step of the depth pixels mapped to the color frame
+FACE_CASCADE = "haarcascade_frontalface_default.xml"
+FACE_DETECT_WIDTH = 320
+FACE_MIN_SIZE = 24
+FACE_MARGIN = 0.3
+FACE_SEARCH = 0.5
+FACE_TRACK_MIN_SCORE = 0.5
+FACE_MAP_STEP = 4
+# incremental calibration while taking pictures: pictures before the first solve, columns and rows of the image
+# coverage map, relative change of the intrinsics and relative uncertainty of the focal lengths below which the
+# estimate has converged, consecutive solves that must satisfy both
+CALIB_MIN_FRAMES = 3
+CALIB_COVERAGE_GRID = (8, 6)
+CALIB_CONVERGED_CHANGE = 0.005
+CALIB_CONVERGED_STD = 0.01
+CALIB_CONVERGED_SOLVES = 3
+# outlier pictures: reprojection error over the median plus this many (normal scaled) median absolute deviations and
+# over the minimum error, replaced by the next best pictures at most this many times
+CALIB_OUTLIER_MAD = 3.0
+CALIB_OUTLIER_MIN_ERROR = 1.0
+CALIB_OUTLIER_ROUNDS = 2
+# why a picture is not used
+CALIB_NO_BOARD = "no_board"
+CALIB_OUTLIER = "outlier"
+CALIB_REDUNDANT = "redundant"
+
+# packet pipelines, in fallback order
+PL_OPENGL = "OpenGLPacketPipeline"
+PL_OPENCL = "OpenCLPacketPipeline"
+PL_CPU = "CpuPacketPipeline"
+PL_PIPELINES = (PL_OPENGL, PL_OPENCL, PL_CPU)
+# pipeline config section option prefixes
+PL_HOST = "host_"
+PL_SERIAL = "serial_"
+PL_BENCH = "bench_"
+PL_BENCH_SECONDS = 2.0
+PL_BENCH_POLL_MS = 200
+
+# replay devices
+REPLAY_PREFIX = "replay-"
+REPLAY_EXTENSION = ".pnrec"
+SCAN_EXTENSION = ".pnscan"
 
 # tk icons
 BASENAME_ICON = "::tk::icons::"
@@ -97,6 +224,8 @@ I18N_MANUAL = "manual"
 I18N_MANUAL_TIP = "manual_tip"
 I18N_AUTOMATIC = "automatic"
 I18N_AUTOMATIC_TIP = "automatic_tip"
+I18N_AUTO_POSE = "auto_pose"
+I18N_AUTO_POSE_TIP = "auto_pose_tip"
 I18N_FRAMES = "frames"
 
 # Mac specific
@@ -123,6 +252,9 @@ M_EDIT = "edit"
 M_HELP = "help"
 M_SENSOR = "sensor"
 M_CALIBRATE = "calibrate"
+M_RECORD = "record"
+M_PIPELINE = "pipeline"
+M_PIPELINE_AUTO = "auto"
 M_FPS = "fps"
 M_10FPS = "10fps"
 M_15FPS = "15fps"
@@ -213,6 +345,12 @@ S_FRAMES_INFO_COUNT = "frames_count"
 S_TIME_START = "time_start"
 S_STOP = "stop"
 S_MANUAL_TAKE = "manual_take"
+S_AUTO_START = "auto_start"
+S_COUNTDOWN = "countdown"
+S_COUNTDOWN_VALUE = "countdown_value"
+S_FINISH = "finish"
+S_ESTIMATE = "estimate"
+S_ESTIMATE_VALUE = "estimate_value"
 # sensor state
 S_STATE_CALIBRATION = "calibration"
 S_STATE_NONE = "none"
@@ -221,21 +359,55 @@ S_STATE_CAPTURING = "capturing"
 # take pictures constants
 TK_MANUAL = "manual"
 TK_TIMED = "time"
+TK_AUTO = "auto"
+# pose regions of the automatic capture: grid of the board center, and the board size splitting near from far
+TK_AUTO_GRID = 3
+TK_AUTO_NEAR = 0.35
+# ratio of opposite board edges over which the board counts as tilted
+TK_AUTO_TILT = 1.12
 
 # device view strings
 D_RGB = "rgb"
 D_IR = "ir"
 D_DEPTH = "depth"
+D_CLOUD = "cloud"
 # image buffer
 IB_IR = "ir"
 IB_DEPTH = "depth"
 IB_COLOR = "color"
+# raw frame shapes as delivered by libfreenect2 (rows, columns[, channels])
+IB_COLOR_SHAPE = (1080, 1920, 4)
+IB_IR_SHAPE = (424, 512)
+IB_DEPTH_SHAPE = (424, 512)
+IB_ALL = (IB_COLOR, IB_IR, IB_DEPTH)
+# capture sessions, each one declares the streams it needs and the device decodes only their union
+CS_PREVIEW = "preview"
+CS_SCAN = "scan"
+CS_CALIBRATION = "calibration"
+CS_RECORD = "record"
+CS_PREVIEW_STREAMS = {D_RGB: (IB_COLOR,), D_IR: (IB_IR,), D_DEPTH: (IB_DEPTH,), D_CLOUD: (IB_DEPTH,)}
+CS_SCAN_STREAMS = {PAS_DEPTH: (IB_DEPTH,), PAS_BOTH: (IB_COLOR, IB_DEPTH)}
+# every capture is a color and ir pair, the stereo calibration needs both
+CS_CALIBRATION_STREAMS = (IB_COLOR, IB_IR)
 
 # kinect refresh rate in ms, should run at 15 and 30 fps
 REFRESH_RATE_10FPS = "100"
 REFRESH_RATE_15FPS = "66"
 REFRESH_RATE_30FPS = "33"
 
+# ir and depth preview colormaps
+VIS_GRAY = "gray"
+VIS_JET = "jet"
+VIS_TURBO = "turbo"
+VIS_BONE = "bone"
+VIS_INFERNO = "inferno"
+
+# point cloud preview
+# nominal kinect v2 ir intrinsics fx, fy, cx, cy, used when the device does not report them
+PC_IR_INTRINSICS_DEFAULT = (365.5, 365.5, 255.5, 211.5)
+PC_STRIDE_DEFAULT = 2
+PC_VOXEL_DEFAULT = 15.0
+
 # numbers for formulas
 IR_NORMALIZATOR = 65535
 NP_UINT8_MAX = np.iinfo(np.uint8).max
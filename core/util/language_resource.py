@@ -69,6 +69,9 @@ class I18N:
                 self.menu_sensor_fps_10 = data['menu']['menu_sensor']['fps']['10fps']
                 self.menu_sensor_fps_15 = data['menu']['menu_sensor']['fps']['15fps']
                 self.menu_sensor_fps_30 = data['menu']['menu_sensor']['fps']['30fps']
+                self.menu_sensor_record = data['menu']['menu_sensor']['record']
+                self.menu_sensor_pipeline = data['menu']['menu_sensor']['pipeline']
+                self.menu_sensor_pipeline_auto = data['menu']['menu_sensor']['pipeline']['auto']
                 # dialog buttons
                 self.dialog_buttons = data['dialog']['buttons']
                 # sensor buttons
@@ -107,6 +107,8 @@ class DialogTakePictureOptions(Dialog):
         self.manual_tip = i18n.tk_options_dialog[I18N_MANUAL_TIP]
         self.automatic_radio = i18n.tk_options_dialog[I18N_AUTOMATIC]
         self.automatic_tip = i18n.tk_options_dialog[I18N_AUTOMATIC_TIP]
+        self.pose_radio = i18n.tk_options_dialog[I18N_AUTO_POSE]
+        self.pose_tip = i18n.tk_options_dialog[I18N_AUTO_POSE_TIP]
         self.frames_label = i18n.tk_options_dialog[I18N_FRAMES]
         self.mode_var = tk.StringVar()
         self._abort = False
@@ -137,9 +139,12 @@ class DialogTakePictureOptions(Dialog):
         r_manual.grid(row=1, column=1, columnspan=1, pady=(7, 7), padx=(7, 7), sticky="we")
         r_auto = ttk.Radiobutton(self, text=self.automatic_radio, variable=self.mode_var, value=TK_TIMED)
         r_auto.grid(row=1, column=2, columnspan=1, pady=(7, 7), padx=(7, 7), sticky="we")
+        r_pose = ttk.Radiobutton(self, text=self.pose_radio, variable=self.mode_var, value=TK_AUTO)
+        r_pose.grid(row=1, column=3, columnspan=1, pady=(7, 7), padx=(7, 7), sticky="we")
         # radio buttons tip
         ToolTip(r_manual, text=self.manual_tip)
         ToolTip(r_auto, text=self.automatic_tip)
+        ToolTip(r_pose, text=self.pose_tip)
         # frame slider
         ttk.Label(self, text=self.frames_label, font="bold") \
             .grid(row=2, column=1, columnspan=2, pady=(7, 7), padx=(7, 7), sticky="we")
@@ -0,0 +1,131 @@
+import time
+
+from core.util.config import logger
+
+
+class ConsumerStats:
+    # time spent by one consumer, against its share of the tick budget
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.over_budget = 0
+
+    def add(self, elapsed, budget):
+        self.calls += 1
+        self.total += elapsed
+        self.worst = max(self.worst, elapsed)
+        if elapsed > budget:
+            self.over_budget += 1
+
+    def as_dict(self):
+        mean = self.total / self.calls if self.calls else 0.0
+        return {"calls": self.calls, "mean_ms": mean * 1000, "worst_ms": self.worst * 1000,
+                "over_budget": self.over_budget}
+
+
+class DisplayScheduler:
+    # single display clock of the app: every tick pulls the newest frame set of each device once and hands it to
+    # the visible consumers of that device. a consumer needs a device (get_frame, playing), visible() and
+    # on_frame(slot), and may set max_refresh (ms) to be served less often than the display rate
+
+    def __init__(self, root, interval_ms):
+        self._root = root
+        self._interval = int(interval_ms) / 1000
+        self._consumers = []
+        self._stats = {}
+        # sequence of the last frame set dispatched for each device
+        self._sequences = {}
+        # devices whose latest frame set is dispatched again at the next tick, even while paused
+        self._invalidated = set()
+        self._last_call = {}
+        self._deadline = None
+        self._after_id = None
+        self.ticks = 0
+        self.skipped = 0
+
+    def register(self, consumer):
+        logger.debug(f"register display consumer {consumer}")
+        self._consumers.append(consumer)
+        self._stats[consumer] = ConsumerStats()
+        self._last_call[consumer] = 0.0
+
+    def unregister(self, consumer):
+        logger.debug(f"unregister display consumer {consumer}")
+        if consumer in self._consumers:
+            self._consumers.remove(consumer)
+            self._stats.pop(consumer, None)
+            self._last_call.pop(consumer, None)
+
+    def start(self):
+        if self._after_id is None:
+            logger.debug(f"start display scheduler at {self._interval * 1000:.0f} ms")
+            self._deadline = time.monotonic() + self._interval
+            self._after_id = self._root.after(int(self._interval * 1000), self.__tick)
+
+    def stop(self):
+        if self._after_id is not None:
+            logger.debug("stop display scheduler")
+            self._root.after_cancel(self._after_id)
+            self._after_id = None
+
+    def set_interval(self, interval_ms):
+        logger.debug(f"display scheduler interval from {self._interval * 1000:.0f} ms to {interval_ms} ms")
+        self._interval = int(interval_ms) / 1000
+        self.stop()
+        self.start()
+
+    def interval(self):
+        return self._interval
+
+    def invalidate(self, device):
+        # the consumers of device rebuild their output from its latest frame set, e.g. after a preview setting changed
+        self._sequences.pop(device, None)
+        self._invalidated.add(device)
+
+    def stats(self):
+        return {str(consumer): stats.as_dict() for consumer, stats in self._stats.items()}
+
+    def __visible_by_device(self, now):
+        devices = {}
+        for consumer in self._consumers:
+            max_refresh = getattr(consumer, "max_refresh", None)
+            if max_refresh is not None and now - self._last_call[consumer] < int(max_refresh) / 1000 - 0.001:
+                continue
+            if (consumer.device.playing() or consumer.device in self._invalidated) and consumer.visible():
+                devices.setdefault(consumer.device, []).append(consumer)
+        return devices
+
+    def __tick(self):
+        start = time.monotonic()
+        self.ticks += 1
+        devices = self.__visible_by_device(start)
+        # budget of each consumer is its share of one tick
+        budget = self._interval / max(1, sum(len(consumers) for consumers in devices.values()))
+        for device, consumers in devices.items():
+            self._invalidated.discard(device)
+            slot = device.get_frame()
+            if slot is None:
+                continue
+            with slot:
+                if slot.sequence == self._sequences.get(device):
+                    continue
+                self._sequences[device] = slot.sequence
+                for consumer in consumers:
+                    consumer_start = time.monotonic()
+                    try:
+                        consumer.on_frame(slot)
+                    except Exception as e:
+                        logger.exception(f"display consumer {consumer} failed: {e}")
+                    end = time.monotonic()
+                    self._last_call[consumer] = end
+                    self._stats[consumer].add(end - consumer_start, budget)
+        now = time.monotonic()
+        # next deadline on the fixed grid, ticks that would already be late are skipped instead of queued
+        self._deadline += self._interval
+        if now > self._deadline:
+            late = int((now - self._deadline) / self._interval) + 1
+            self.skipped += late
+            self._deadline += late * self._interval
+        self._after_id = self._root.after(max(1, int((self._deadline - now) * 1000)), self.__tick)
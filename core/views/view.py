@@ -1,3 +1,4 @@
+import importlib.util
 import threading
 import time
 import tkinter as tk
@@ -8,33 +9,31 @@ from tkinter import ttk, VERTICAL
 from abc import abstractmethod, ABC
 from typing import Optional
 
-from pylibfreenect2 import FrameMap, SyncMultiFrameListener, FrameType
+from pylibfreenect2 import SyncMultiFrameListener, FrameType
 import cv2 as open_cv
 import numpy as np
 import PIL.Image
 import PIL.ImageTk
 
+from core.algorithms.calibration import LiveBoardDetector
+from core.algorithms.crop import CropVolume
+from core.algorithms.point_cloud import PointCloud, RayTable
+from core.algorithms.preview import ColorPreview, DepthPreview, IrPreview
+from core.algorithms.registration import Registration, registration
+from core.algorithms.undistort import undistorter
 from core.controllers import Controller
+from core.models.capture import CaptureThread, FrameRing, FrameSlot
+from core.models.pipeline import PipelineManager
+from core.models.replay import ReplayDevice, SessionRecorder, is_replay_serial, replay_folder
+from core.models.scan import ScanEngine
+from core.models.scan_file import ScanWriter
 from core.util import config
-from core.util.config import logger, nect_config, IR_IMAGE_SIZE_PARSED, RGB_IMAGE_SIZE_HALVED, RGB_IMAGE_SIZE_PARSED
+from core.util.config import logger, nect_config, IR_IMAGE_SIZE_PARSED, RGB_IMAGE_SIZE_HALVED, RGB_IMAGE_SIZE_PARSED, \
+    FRAME_BUFFER_PARSED
 from core.util.constants import *
 from core.util.language_resource import i18n
 from core.views import View, AutoScrollbar, AutoWrapMessage, ScrollFrame, DiscreteStep, check_num
 
-logger.debug("import pipeline module")
-try:
-    from pylibfreenect2 import OpenGLPacketPipeline as Pipeline
-except ImportError as error:
-    logger.exception("OpenGLPacketPipeline import error", error)
-    try:
-        from pylibfreenect2 import OpenCLPacketPipeline as Pipeline
-    except ImportError as error:
-        logger.exception("OpenCLPacketPipeline import error", error)
-        from pylibfreenect2 import CpuPacketPipeline as Pipeline
-pipeline = Pipeline()
-logger.debug("import pipeline module successfully")
-logger.info(f"Packet pipeline: {type(pipeline).__name__}")
-
 
 class ScrollWrapperView(View):
     def __init__(self, master=None):
@@ -139,8 +138,11 @@ class MenuBar(tk.Menu, View):
         self.menu_help_language = tk.Menu(self.menu_help)
         self.menu_sensor_fps = tk.Menu(self.menu_sensor)
         self.menu_sensor_calibrate = tk.Menu(self.menu_sensor)
+        self.menu_sensor_pipeline = tk.Menu(self.menu_sensor)
         self.refresh_rate = tk.StringVar()
         self.language = tk.StringVar()
+        # serial -> packet pipeline chosen for the device, M_PIPELINE_AUTO without an override
+        self.pipeline = {}
 
         self.__menu_names = {
             M_APPLE: {
@@ -240,6 +242,14 @@ class MenuBar(tk.Menu, View):
                 M_MASTER: self.menu_sensor,
                 M_INDEX: 1
             },
+            M_RECORD: {
+                M_MASTER: self.menu_sensor,
+                M_INDEX: 2
+            },
+            M_PIPELINE: {
+                M_MASTER: self.menu_sensor,
+                M_INDEX: 3
+            },
             M_10FPS: {
                 M_MASTER: self.menu_sensor_fps,
                 M_RADIO: True,
@@ -276,6 +286,9 @@ class MenuBar(tk.Menu, View):
         self.add_cascade_item(menu_name=M_CALIBRATE, menu_to_add=self.menu_sensor_calibrate,
                               info=i18n.menu_sensor_calibrate)
         self.add_cascade_item(menu_name=M_FPS, menu_to_add=self.menu_sensor_fps, info=i18n.menu_sensor_fps)
+        self.add_command_item(cmd_name=M_RECORD, info=i18n.menu_sensor_record)
+        self.add_cascade_item(menu_name=M_PIPELINE, menu_to_add=self.menu_sensor_pipeline,
+                              info=i18n.menu_sensor_pipeline)
         # menu_sensor_fps items
         self.add_command_item(cmd_name=M_10FPS, info=i18n.menu_sensor_fps_10)
         self.add_command_item(cmd_name=M_15FPS, info=i18n.menu_sensor_fps_15)
@@ -332,6 +345,12 @@ class MenuBar(tk.Menu, View):
         # menu_sensor items
         self.update_command_or_cascade(name=M_CALIBRATE, info_updated=i18n.menu_sensor_calibrate)
         self.update_command_or_cascade(name=M_FPS, info_updated=i18n.menu_sensor_fps)
+        self.update_command_or_cascade(name=M_RECORD, info_updated=i18n.menu_sensor_record)
+        self.update_command_or_cascade(name=M_PIPELINE, info_updated=i18n.menu_sensor_pipeline)
+        # menu_sensor_pipeline items
+        for serial in self.pipeline:
+            self.update_command_or_cascade(name=M_PIPELINE + serial + M_PIPELINE_AUTO,
+                                           info_updated=i18n.menu_sensor_pipeline_auto)
         # menu_sensor_fps items
         self.update_command_or_cascade(name=M_10FPS, info_updated=i18n.menu_sensor_fps_10)
         self.update_command_or_cascade(name=M_15FPS, info_updated=i18n.menu_sensor_fps_15)
@@ -370,6 +389,23 @@ class MenuBar(tk.Menu, View):
                                          else self.menu_sensor_calibrate.index(tk.END) + 1}
             self.add_command_item(cmd_name=serial)
 
+    def add_pipelines(self, serials, names):
+        logger.debug(f"add sensors to pipeline menu")
+        for serial in serials:
+            menu_serial = tk.Menu(self.menu_sensor_pipeline)
+            self.pipeline[serial] = tk.StringVar()
+            self.__menu_names[M_PIPELINE + serial] = {M_MASTER: self.menu_sensor_pipeline,
+                                                      M_INDEX: 0 if self.menu_sensor_pipeline.index(tk.END) is None
+                                                      else self.menu_sensor_pipeline.index(tk.END) + 1}
+            self.add_cascade_item(menu_name=M_PIPELINE + serial, menu_to_add=menu_serial, info={M_LABEL: serial})
+            for index, name in enumerate((M_PIPELINE_AUTO,) + tuple(names)):
+                self.__menu_names[M_PIPELINE + serial + name] = {M_MASTER: menu_serial, M_RADIO: True,
+                                                                 M_VARIABLE: self.pipeline[serial], M_VALUE: name,
+                                                                 M_INDEX: index}
+                self.add_command_item(cmd_name=M_PIPELINE + serial + name,
+                                      info=i18n.menu_sensor_pipeline_auto if name == M_PIPELINE_AUTO
+                                      else {M_LABEL: name})
+
     def update_command_or_cascade(self, name, info_updated, update_state=False):
         logger.debug(f"update item {name} with info {info_updated}")
         master = self.__menu_names[name][M_MASTER]
@@ -478,6 +514,36 @@ class SensorView(View):
             self._widget[S_FRAMES_INFO_COUNT][S_LABEL].grid(column=(
                 len(btn_name_list) if len(btn_name_list) > 1 else 1), row=0, sticky=(tk.W, tk.E))
             buttons_row = [i + 1 for i in buttons_row]
+            if kw.get("countdown"):
+                self._widget[S_COUNTDOWN] = {}
+                self._widget[S_COUNTDOWN][S_TEXT] = tk.StringVar()
+                self._widget[S_COUNTDOWN][S_TEXT].set(i18n.sensor_labels[S_COUNTDOWN])
+                self._widget[S_COUNTDOWN][S_LABEL] = ttk.Label(self.button_frame,
+                                                               textvariable=self._widget[S_COUNTDOWN][S_TEXT])
+                self._widget[S_COUNTDOWN][S_LABEL].grid(column=0, row=2, columnspan=(
+                    len(btn_name_list) - 1 if len(btn_name_list) > 1 else 1), sticky=(tk.W, tk.E))
+                self._widget[S_COUNTDOWN_VALUE] = {}
+                self._widget[S_COUNTDOWN_VALUE][S_TEXT] = tk.StringVar()
+                self._widget[S_COUNTDOWN_VALUE][S_TEXT].set("-")
+                self._widget[S_COUNTDOWN_VALUE][S_LABEL] = ttk.Label(self.button_frame,
+                                                                     textvariable=self._widget[S_COUNTDOWN_VALUE][
+                                                                         S_TEXT])
+                self._widget[S_COUNTDOWN_VALUE][S_LABEL].grid(column=(
+                    len(btn_name_list) if len(btn_name_list) > 1 else 1), row=2, sticky=(tk.W, tk.E))
+            self._widget[S_ESTIMATE] = {}
+            self._widget[S_ESTIMATE][S_TEXT] = tk.StringVar()
+            self._widget[S_ESTIMATE][S_TEXT].set(i18n.sensor_labels[S_ESTIMATE])
+            self._widget[S_ESTIMATE][S_LABEL] = ttk.Label(self.button_frame,
+                                                          textvariable=self._widget[S_ESTIMATE][S_TEXT])
+            self._widget[S_ESTIMATE][S_LABEL].grid(column=0, row=3, columnspan=(
+                len(btn_name_list) - 1 if len(btn_name_list) > 1 else 1), sticky=(tk.W, tk.E))
+            self._widget[S_ESTIMATE_VALUE] = {}
+            self._widget[S_ESTIMATE_VALUE][S_TEXT] = tk.StringVar()
+            self._widget[S_ESTIMATE_VALUE][S_TEXT].set("-")
+            self._widget[S_ESTIMATE_VALUE][S_LABEL] = ttk.Label(self.button_frame,
+                                                                textvariable=self._widget[S_ESTIMATE_VALUE][S_TEXT])
+            self._widget[S_ESTIMATE_VALUE][S_LABEL].grid(column=(
+                len(btn_name_list) if len(btn_name_list) > 1 else 1), row=3, sticky=(tk.W, tk.E))
 
         for key, btn_name in enumerate(btn_name_list):
             self._buttons[btn_name] = {}
@@ -505,6 +571,10 @@ class SensorView(View):
         if btn_name in self._buttons.keys():
             self._buttons[btn_name][S_BUTTON].configure(command=command)
 
+    def set_button_state(self, btn_name, enabled):
+        if btn_name in self._buttons.keys():
+            self._buttons[btn_name][S_BUTTON].state(["!disabled"] if enabled else ["disabled"])
+
     def update_language(self):
         logger.debug("update language in sensor view")
         self.sensor_list.update_language()
@@ -512,7 +582,7 @@ class SensorView(View):
         for btn_name in self._buttons.keys():
             self._buttons[btn_name][S_TEXT].set(i18n.sensor_buttons[btn_name])
         for wdt_name in self._widget.keys():
-            if wdt_name not in [S_FRAMES_INFO_COUNT]:
+            if wdt_name not in [S_FRAMES_INFO_COUNT, S_COUNTDOWN_VALUE, S_ESTIMATE_VALUE]:
                 self._widget[wdt_name][S_TEXT].set(i18n.sensor_labels[wdt_name])
 
     def create_view(self):
@@ -523,6 +593,14 @@ class SensorView(View):
     def update_frame_count(self, new_number):
         self._widget[S_FRAMES_INFO_COUNT][S_TEXT].set(new_number)
 
+    def update_countdown(self, seconds=None):
+        if S_COUNTDOWN_VALUE in self._widget:
+            self._widget[S_COUNTDOWN_VALUE][S_TEXT].set("-" if seconds is None else f"{seconds:.0f}s")
+
+    def update_estimate(self, text=None):
+        if S_ESTIMATE_VALUE in self._widget:
+            self._widget[S_ESTIMATE_VALUE][S_TEXT].set("-" if text is None else text)
+
     def _update_grid_weight(self):
         cols, _ = self.button_frame.grid_size()
         for col in range(cols):
@@ -535,71 +613,299 @@ class DeviceView(TabbedView):
         logger.debug("create view in device view")
         self.pack(side=tk.TOP, fill=tk.X, expand=False)
         # color = ImageView(self, lambda: self.get_image_color(), REFRESH_RATE_15FPS)
-        color = ImageView(self, lambda: self.get_image_color(), resize={"value": True, "size": RGB_IMAGE_SIZE_HALVED},
-                          style="Image.TFrame")
+        # the color preview is already built at display size
+        color = ImageView(self, lambda slot: self.get_image_color(slot), IB_COLOR, style="Image.TFrame")
+        self._image_views[IB_COLOR] = color
+        self._preview_streams[color] = CS_PREVIEW_STREAMS[D_RGB]
         self.add(i18n.device_view_frames[D_RGB], color, D_RGB)
 
-        ir = ImageView(self, lambda: self.get_image_ir(), style="Image.TFrame")
+        ir = ImageView(self, lambda slot: self.get_image_ir(slot), IB_IR, style="Image.TFrame")
+        self._image_views[IB_IR] = ir
+        self._preview_streams[ir] = CS_PREVIEW_STREAMS[D_IR]
         self.add(i18n.device_view_frames[D_IR], ir, D_IR)
 
-        depth = ImageView(self, lambda: self.get_image_depth(), style="Image.TFrame")
+        depth = ImageView(self, lambda slot: self.get_image_depth(slot), IB_DEPTH, style="Image.TFrame")
+        self._image_views[IB_DEPTH] = depth
+        self._preview_streams[depth] = CS_PREVIEW_STREAMS[D_DEPTH]
         self.add(i18n.device_view_frames[D_DEPTH], depth, D_DEPTH)
 
-        self.refresh()
+        # matplotlib is optional, without it there is no point cloud preview
+        if importlib.util.find_spec("matplotlib") is not None:
+            self._cloud_view = PlotFrame(self, self)
+            self._preview_streams[self._cloud_view] = CS_PREVIEW_STREAMS[D_CLOUD]
+            self.add(i18n.device_view_frames[D_CLOUD], self._cloud_view, D_CLOUD)
 
     def update_language(self):
         logger.debug("update language in device view")
         self.i18n_frame_names = i18n.device_view_frames
         super().update_language()
 
-    def __init__(self, master, free_nect, serial, **kw):
+    def __init__(self, master, free_nect, pipelines: PipelineManager, serial, **kw):
         super().__init__(master, **kw)
 
         self._free_nect = free_nect
+        self._pipelines = pipelines
         self._serial = serial
 
         self._device_index = self.__device_list_index()
 
         self._device = None
         self._listener = None
+        self._capture: Optional[CaptureThread] = None
+        self._recorder: Optional[SessionRecorder] = None
+        self._board_detector: Optional[LiveBoardDetector] = None
+        self._scan: Optional[ScanEngine] = None
+        self._scan_writer: Optional[ScanWriter] = None
+        self._crop: Optional[CropVolume] = None
+        self._sinks = []
+        self._color_params = None
+        self._ir_params = None
+        self._ray_table = None
+        self._cloud_view = None
+        # preallocated once per device, survives open/close
+        self._ring = FrameRing(FRAME_BUFFER_PARSED)
+        self._color_preview = ColorPreview(RGB_IMAGE_SIZE_HALVED)
+        ir_size = (IB_IR_SHAPE[1], IB_IR_SHAPE[0])
+        self._ir_preview = IrPreview(ir_size, IR_IMAGE_SIZE_PARSED,
+                                     nect_config.get(FRAMES, IR_COLORMAP, fallback=IR_COLORMAP_DEFAULT))
+        self._depth_preview = DepthPreview(ir_size, IR_IMAGE_SIZE_PARSED,
+                                           nect_config.get(FRAMES, DEPTH_COLORMAP, fallback=DEPTH_COLORMAP_DEFAULT),
+                                           nect_config.getint(FRAMES, DEPTH_MIN, fallback=DEPTH_MIN_DEFAULT),
+                                           nect_config.getint(FRAMES, DEPTH_MAX, fallback=DEPTH_MAX_DEFAULT))
+
+        self._undistort = nect_config.getboolean(FRAMES, UNDISTORT, fallback=UNDISTORT_DEFAULT)
+        # undistorted preview images, reused across frames
+        self._undistorted = {}
 
         self._opened = False
         self._playing = False
 
-        # self._pers_rgb_ir = PERSP_IR_TO_RGB[None]
-        # if serial in PERSP_IR_TO_RGB:
-        #    self._pers_rgb_ir = PERSP_IR_TO_RGB[serial]
+        # streams needed by each capture session, and the ones currently decoded
+        self._preview_streams = {}
+        self._image_views = {}
+        self._stream_requests = {}
+        self._streams = ()
+        # (rgb, depth) packet processors running, they can decode more than the copied streams
+        self._decoding = (False, False)
+
 
-        self.frames = FrameMap()
         self.image_buffer = {IB_COLOR: (None, None, None), IB_IR: (None, None, None), IB_DEPTH: (None, None, None)}
-        self.lock = threading.RLock()
+        # sequence number of the captured frame each image in the buffer was built from
+        self._image_sequence = {IB_COLOR: 0, IB_IR: 0, IB_DEPTH: 0}
+        # frames of the stream captured up to that one
+        self._image_count = {IB_COLOR: 0, IB_IR: 0, IB_DEPTH: 0}
+
+    def select(self, new_fr):
+        super().select(new_fr)
+        # the preview only needs the stream of the visible tab
+        self.require_streams(CS_PREVIEW, self.__preview_request(new_fr))
+
+    def __preview_request(self, frame):
+        streams = self._preview_streams.get(frame, IB_ALL)
+        # the ir preview shades the crop volume, which is cut on depth
+        if self._crop is not None and IB_IR in streams and IB_DEPTH not in streams:
+            streams += (IB_DEPTH,)
+        return streams
+
+    def require_streams(self, session, streams):
+        logger.debug(f"{session} needs {streams} from {self._serial}")
+        self._stream_requests[session] = tuple(streams)
+        self.__reconfigure(self.__needed_streams(), session)
+
+    def release_streams(self, session):
+        logger.debug(f"{session} releases its streams of {self._serial}")
+        self._stream_requests.pop(session, None)
+        self.__reconfigure(self.__needed_streams(), session)
+
+    def streams(self):
+        return self._streams
+
+    def __needed_streams(self):
+        needed = set()
+        for streams in self._stream_requests.values():
+            needed.update(streams)
+        needed = tuple(key for key in IB_ALL if key in needed) or IB_ALL
+        if self._opened and is_replay_serial(self._serial):
+            # a session only holds the streams it was recorded with
+            needed = tuple(key for key in needed if key in self._device.streams()) or self._device.streams()
+        return needed
+
+    def __reconfigure(self, streams, session):
+        if not self._opened:
+            return
+        decoders = self.__decoders(streams)
+        if session == CS_PREVIEW:
+            # switching tabs never stops a running packet processor, only a capture session changing its needs does
+            decoders = tuple(running or needed for running, needed in zip(self._decoding, decoders))
+        if streams == self._streams and decoders == self._decoding:
+            return
+        logger.debug(f"reconfigure {self._serial} streams from {self._streams} to {streams} for {session}")
+        if decoders == self._decoding:
+            # same packet processors running, only the copied streams change
+            self._capture.set_streams(streams)
+            self._streams = streams
+        else:
+            self.__stop_streams()
+            self.__start_streams(streams, decoders)
+
+    @staticmethod
+    def __decoders(streams):
+        # ir and depth come out of the same depth packet processor
+        return IB_COLOR in streams, IB_IR in streams or IB_DEPTH in streams
+
+    def __start_streams(self, streams, decoders=None):
+        rgb, depth = decoders or self.__decoders(streams)
+        if is_replay_serial(self._serial):
+            self._listener = self._device.listener
+        else:
+            frame_types = (FrameType.Color if rgb else 0) | (FrameType.Ir | FrameType.Depth if depth else 0)
+            self._listener = SyncMultiFrameListener(frame_types)
+        self._device.setColorFrameListener(self._listener)
+        self._device.setIrAndDepthFrameListener(self._listener)
+        self._device.startStreams(rgb, depth)
+        self._capture = CaptureThread(self._listener, self._serial, self._ring, streams)
+        # sinks outlive the capture thread, a recording goes on across reconfigurations
+        self._capture.sinks = self._sinks
+        self._capture.start()
+        if self._playing:
+            self._capture.play()
+        self._streams = streams
+        self._decoding = (rgb, depth)
+
+    def __stop_streams(self):
+        self._capture.stop()
+        self._capture = None
+        self._device.stop()
+        self._streams = ()
+        self._decoding = (False, False)
 
-    def get_frame(self):
-        with self.lock:
-            return {IB_COLOR: self.frames[IB_COLOR].asarray(dtype=np.uint8),
-                    IB_IR: self.frames[IB_IR].asarray(dtype=np.float32),
-                    IB_DEPTH: self.frames[IB_DEPTH].asarray(dtype=np.float32)}
+    def get_frame(self) -> Optional[FrameSlot]:
+        # latest frame set, the caller owns a reference and must release it (or use it as a context manager)
+        return self._ring.acquire_latest()
+
+    def get_frames(self, count):
+        # last count frame sets, newest first, each one must be released
+        return self._ring.acquire_last(count)
 
     def open(self):
         logger.debug("open device, start listener")
-        self._listener = SyncMultiFrameListener(FrameType.Color | FrameType.Ir | FrameType.Depth)
-        self._device = self._free_nect.openDevice(self._serial.encode("utf-8"), pipeline=pipeline)
+        if is_replay_serial(self._serial):
+            self._device = ReplayDevice(self._serial)
+        else:
+            self._device = self._free_nect.openDevice(self._serial.encode("utf-8"),
+                                                     pipeline=self._pipelines.create(self._serial))
         device_index = self.__device_list_index()
         if self._device_index != device_index:  # keep track of changes in the device list
             self._device_index = device_index
             self._device.close()
-            self._listener.release(self.frames)
             self.open()
             return
-        self._device.setColorFrameListener(self._listener)
-        self._device.setIrAndDepthFrameListener(self._listener)
-        self._device.start()
         self._opened = True
         self._playing = False
-        cp = self._device.getColorCameraParams()
-        ip = self._device.getIrCameraParams()
-        # logger.warning(str(cp.cx) + ", " + str(cp.cy) + ", " + str(cp.fx) + ", " + str(cp.fy))
-        # logger.warning(str(ip.cx) + ", " + str(ip.cy) + ", " + str(ip.fx) + ", " + str(ip.fy))
+        self.__start_streams(self.__needed_streams())
+        self._color_params = self._device.getColorCameraParams()
+        self._ir_params = self._device.getIrCameraParams()
+        self._ray_table = None
+        if self._cloud_view is not None:
+            self._cloud_view.reset()
+
+    def open_and_play(self):
+        # the first start pipeline benchmark holds the real devices, they are opened once it is over if still selected
+        if is_replay_serial(self._serial) or not self._pipelines.benchmarking():
+            self.open()
+            self.play()
+        else:
+            logger.info(f"{self._serial} opened after the pipeline benchmark")
+            self._pipelines.when_ready(self.__open_if_selected)
+
+    def __open_if_selected(self):
+        if not self._opened and self.master.selected_frame() is self:
+            self.open()
+            self.play()
+
+    def recording(self):
+        return self._recorder is not None
+
+    def start_recording(self, path: Path = None):
+        if not self._opened or self._recorder is not None:
+            return False
+        if path is None:
+            path = replay_folder() / (self._serial + time.strftime("_%Y%m%d_%H%M%S") + REPLAY_EXTENSION)
+        logger.debug(f"record {self._serial} to {path}")
+        # a session holds every stream, whatever the previews need while recording
+        self.require_streams(CS_RECORD, IB_ALL)
+        self._recorder = SessionRecorder(path, self._serial, self._color_params, self._ir_params, self._streams)
+        self._recorder.start()
+        self._sinks.append(self._recorder.push)
+        return True
+
+    def stop_recording(self):
+        if self._recorder is None:
+            return False
+        self._sinks.remove(self._recorder.push)
+        self._recorder.stop()
+        self._recorder = None
+        self.release_streams(CS_RECORD)
+        return True
+
+    def start_scan(self, path: Path, fps, streams, duration=None, metadata=None, stages=()):
+        # frame sets of streams at fps written to path, for duration seconds or until stop_scan. stages process
+        # every frame set before it is written
+        if not self._opened or self._scan is not None:
+            return False
+        logger.debug(f"scan {self._serial} to {path}: {streams} at {fps} fps for {duration} s")
+        self._scan_writer = ScanWriter(path, self._serial, self._color_params, self._ir_params, streams,
+                                       metadata=metadata, stages=stages)
+        self._scan_writer.start()
+        self._scan = ScanEngine(self._scan_writer, fps, duration)
+        self._sinks.append(self._scan.push)
+        return True
+
+    def stop_scan(self):
+        # stats of the scan, None if no scan was running. returns once every kept frame set is written
+        if self._scan is None:
+            return None
+        self._sinks.remove(self._scan.push)
+        stats = self._scan.stop()
+        self._scan_writer.stop()
+        stats["bytes"] = self._scan_writer.bytes
+        stats["written"] = self._scan_writer.written
+        self._scan = None
+        self._scan_writer = None
+        return stats
+
+    def scan(self) -> Optional[ScanEngine]:
+        return self._scan
+
+    def start_board_detection(self):
+        if not self._opened or self._board_detector is not None:
+            return False
+        self._board_detector = LiveBoardDetector(self._serial)
+        self._board_detector.start()
+        self._sinks.append(self._board_detector.push)
+        return True
+
+    def stop_board_detection(self):
+        if self._board_detector is None:
+            return
+        self._sinks.remove(self._board_detector.push)
+        self._board_detector.stop()
+        self._board_detector = None
+        self.set_overlays({})
+        self.set_missing_regions({})
+
+    def board_detector(self) -> Optional[LiveBoardDetector]:
+        return self._board_detector
+
+    def set_overlays(self, corners):
+        # corners of each stream in normalized preview coordinates, streams missing are cleared
+        for key, view in self._image_views.items():
+            view.set_overlay(corners.get(key))
+
+    def set_missing_regions(self, regions):
+        # rectangles of each stream in normalized preview coordinates still to be covered by the board
+        for key, view in self._image_views.items():
+            view.set_regions(regions.get(key, ()))
 
     def opened(self):
         return self._opened
@@ -608,6 +914,7 @@ class DeviceView(TabbedView):
         logger.debug("play device")
         if not self._opened:
             return False
+        self._capture.play()
         self._playing = True
         return True
 
@@ -618,6 +925,7 @@ class DeviceView(TabbedView):
         logger.debug("stop device")
         if not self._opened:
             return False
+        self._capture.pause()
         self._playing = False
         return True
 
@@ -625,67 +933,134 @@ class DeviceView(TabbedView):
         logger.debug("close device")
         if not self._opened:
             return
+        logger.debug(f"preview frames of {self._serial}: {self.frame_stats()}")
+        self.stop_recording()
+        self.stop_scan()
+        self.stop_board_detection()
+        self.__stop_streams()
         self._device.close()
         self._opened = False
         self._playing = False
 
-    def refresh(self):
-        if self._playing:
-            with self.lock:
-                self._listener.release(self.frames)
-                for key in self.image_buffer:
-                    self.image_buffer.update(
-                     {key: (None, None, self.image_buffer[key][2])})  # reset image buffer and keep depth map
-                # get frames from sensor here
-                self.frames = self._listener.waitForNewFrame()
-        self.after(REFRESH_RATE_30FPS, self.refresh)
-
-    def get_image_color(self):
-        color, _, _ = self.image_buffer[IB_COLOR]
-        if color is not None:
+    def __new_frame(self, key, slot=None):
+        # acquired frame set (the given one or the latest), None if the image buffer is already up to date
+        if slot is None:
+            slot = self._ring.acquire_latest()
+        else:
+            slot.retain()
+        if slot is None:
+            return None
+        if slot.sequence == self._image_sequence[key] or key not in slot:
+            slot.release()
+            return None
+        self._image_sequence[key] = slot.sequence
+        self._image_count[key] = slot.counts[key]
+        return slot
+
+    def get_image_color(self, slot=None):
+        slot = self.__new_frame(IB_COLOR, slot)
+        if slot is None:
             return self.image_buffer[IB_COLOR]
-        color = self.frames[IB_COLOR]
-        color = color.asarray(dtype=np.uint8)
-        color = np.flip(color, axis=(1,))
-        color = open_cv.resize(color, RGB_IMAGE_SIZE_PARSED)
-        # todo: no right color on save img
-        color = open_cv.cvtColor(color, open_cv.COLOR_BGRA2RGBA)
+        with slot:
+            color = self._color_preview(slot[IB_COLOR])
+        color = self.__undistort_preview(IB_COLOR, color)
         return self.__to_image(IB_COLOR, color)
 
-    def get_image_ir(self):
-        ir, _, _ = self.image_buffer[IB_IR]
-        if ir is not None:
+    def get_image_ir(self, slot=None):
+        slot = self.__new_frame(IB_IR, slot)
+        if slot is None:
             return self.image_buffer[IB_IR]
-        ir = self.frames[IB_IR]
-        ir = ir.asarray(dtype=np.float32)
-        ir = open_cv.resize(ir, IR_IMAGE_SIZE_PARSED)
-        ir = np.flip(ir, axis=(1,))
-        # ir = open_cv.warpPerspective(ir, self._pers_rgb_ir, None,
-        # borderMode=open_cv.BORDER_CONSTANT, borderValue=65535)
-        ir = ir / IR_NORMALIZATOR  # normalize
-        return self.__to_image(IB_IR, ir)
-
-    def get_image_depth(self, d_min=0, d_max=5000):
-        depth, _, _ = self.image_buffer[IB_DEPTH]
-        if depth is not None:
+        with slot:
+            rgba, mask = self._ir_preview(slot[IB_IR])
+            if self._crop is not None and IB_DEPTH in slot:
+                self._crop.shade(rgba, slot[IB_DEPTH])
+        rgba = self.__undistort_preview(IB_IR, rgba)
+        return self.__to_image(IB_IR, rgba, rgba[..., 3])
+
+    def get_image_depth(self, slot=None):
+        # depth outside the window of the depth preview is masked out
+        slot = self.__new_frame(IB_DEPTH, slot)
+        if slot is None:
             return self.image_buffer[IB_DEPTH]
-        depth = self.frames[IB_DEPTH]
-        depth = depth.asarray(dtype=np.float32)
-        depth = open_cv.resize(depth, IR_IMAGE_SIZE_PARSED)
-        depth = np.flip(depth, axis=(1,))
-        # depth = open_cv.warpPerspective(depth, self._pers_rgb_ir, None,
-        # borderMode=open_cv.BORDER_CONSTANT, borderValue=d_max)
-        buffer = depth.astype(int)
-        # logger.error(buffer == d_min)
-        # logger.error(buffer[buffer == d_min])
-        buffer[buffer == d_max], buffer[buffer == d_min] = -1, -1
-        depth = depth / d_max  # normalize
-        return self.__to_image(IB_DEPTH, depth, buffer)
+        with slot:
+            rgba, mask = self._depth_preview(slot[IB_DEPTH])
+            if self._crop is not None:
+                self._crop.shade(rgba, slot[IB_DEPTH])
+        rgba = self.__undistort_preview(IB_DEPTH, rgba)
+        return self.__to_image(IB_DEPTH, rgba, rgba[..., 3])
+
+    def undistort(self, key, image, raw=True, out=None):
+        # image of stream key without lens distortion, unchanged while the device is not calibrated. raw images are
+        # oriented as the sensor gives them, the others are mirrored like the previews
+        remap = undistorter(self._serial, key, (image.shape[1], image.shape[0]), raw)
+        if remap is None:
+            return image
+        return remap(image, out)
+
+    def __undistort_preview(self, key, image):
+        if not self._undistort:
+            return image
+        out = self._undistorted.get(key)
+        if out is None or out.shape != image.shape:
+            out = self._undistorted[key] = np.empty_like(image)
+        return self.undistort(key, image, raw=False, out=out)
+
+    def image_sequence(self, key):
+        # sequence number of the captured frame the buffered image of key was built from
+        return self._image_sequence[key]
+
+    def frame_stats(self):
+        # shown and dropped frames of every preview, frame sets the ring had no free slot for
+        stats = {key: view.frame_stats() for key, view in self._image_views.items()}
+        stats["ring_dropped"] = self._ring.dropped
+        return stats
+
+    def image_count(self, key):
+        # frames of stream key captured up to the one the buffered image was built from
+        return self._image_count[key]
+
+    def ray_table(self):
+        # built once per opened device from its ir intrinsics
+        if self._ray_table is None:
+            self._ray_table = RayTable.from_params(self._ir_params)
+        return self._ray_table
+
+    def registration(self, undistorted=False) -> Optional[Registration]:
+        # color to depth alignment of this device, None until it is stereo calibrated. undistorted for depth frames
+        # without lens distortion
+        return registration(self._serial, undistorted)
+
+    def set_crop(self, crop: Optional[CropVolume]):
+        # previews show what crop cuts away, None to show everything again
+        logger.debug(f"set crop of {self._serial} to {crop.roi if crop is not None else None}")
+        self._crop = crop
+        self._image_sequence[IB_IR] = self._image_sequence[IB_DEPTH] = 0
+        self.winfo_toplevel().display.invalidate(self)
+        if self.current_frame is not None:
+            self.require_streams(CS_PREVIEW, self.__preview_request(self.current_frame))
+
+    def depth_window(self):
+        return self._depth_preview.d_min, self._depth_preview.d_max
+
+    def set_depth_window(self, d_min, d_max):
+        logger.debug(f"set depth window of {self._serial} to ({d_min}, {d_max})")
+        self._depth_preview.set_window(d_min, d_max)
+        # rebuild the image from the latest frame even when the sensor is paused
+        self._image_sequence[IB_DEPTH] = 0
+        self.winfo_toplevel().display.invalidate(self)
+
+    def set_colormap(self, key, colormap):
+        logger.debug(f"set {key} colormap of {self._serial} to {colormap}")
+        preview = self._ir_preview if key == IB_IR else self._depth_preview
+        preview.set_colormap(colormap)
+        self._image_sequence[key] = 0
+        self.winfo_toplevel().display.invalidate(self)
 
     def __to_image(self, key, array, arg=None):
-        if array.dtype == np.float32 and len(array.shape) == 2:  # ir or depth, range between 0 and 1
-            array = np.asarray(array * NP_UINT8_MAX, dtype=np.uint8)
-        img = PIL.Image.fromarray(array)
+        if array.ndim == 3 and array.shape[2] == 4:  # packed ir or depth preview, the alpha channel is the mask
+            img = PIL.Image.frombuffer("RGB", (array.shape[1], array.shape[0]), array, "raw", "RGBX", 0, 1)
+        else:
+            img = PIL.Image.fromarray(array)
         self.image_buffer[key] = (img, array, arg)
         return self.image_buffer[key]
 
@@ -698,7 +1073,7 @@ class DeviceView(TabbedView):
 
 class ImageView(ttk.Frame):
 
-    def __init__(self, master, source, max_refresh=REFRESH_RATE_30FPS, resize=None, **kw):
+    def __init__(self, master, source, key, max_refresh=REFRESH_RATE_30FPS, resize=None, **kw):
         super().__init__(master, **kw)
 
         if resize is None:
@@ -706,149 +1081,183 @@ class ImageView(ttk.Frame):
         else:
             self.resize = resize
         self.device = master
+        self.key = key
         self.canvas = tk.Canvas(self)
+        # one photo image and one canvas item, pixels are pasted in place and both are only recreated on resize
         self.canvas.tk_img = None
+        self._canvas_item = None
+        # polyline through the detected board corners, drawn above the image
+        self._overlay = None
+        self._overlay_item = None
+        # shaded image regions, the calibration board has not been captured in them yet
+        self._regions = ()
+        self._region_items = []
+        # stream frame count of the image on the canvas, 0 after the view was hidden
+        self._count = 0
+        # image on the canvas, a source gives the same one back while it has nothing new
+        self._image = None
+        self.displayed = 0
+        self.dropped = 0
         self.rowconfigure(0, weight=1)
         self.columnconfigure(0, weight=1)
         self.canvas.grid(column=0, row=0)
         self.source = source
         self.max_refresh = max_refresh
-        self.refresh()
-
-    def refresh(self):
-        if self.winfo_viewable() and self.device.playing():
-            img, arr, arg = self.source()
-            if img is not None:
-                if self.resize["value"]:
-                    img = PIL.Image.fromarray(open_cv.resize(arr, self.resize["size"]))
-                self.canvas.img = img
-                tk_img = PIL.ImageTk.PhotoImage(image=img)
-                self.canvas.tk_img = tk_img
-                self.canvas.config(width=tk_img.width(), height=tk_img.height())
-                self.canvas.create_image(0, 0, image=tk_img, anchor=tk.NW)
-        self.after(max(int(nect_config[CONFIG][REFRESH_RATE]), int(self.max_refresh)) - 1, self.refresh)
-
-
-class PlotFrame(View):
-    _RES = 6  # less is more expensive (more points to render)
-
-    def __init__(self, parent, root, serial, source, xyz=(1, 1, (0, 1))):
-        View.__init__(self, parent)
-
-        self.master = root
-
-        self.source = source[0]
-        self.colors = source[1]
-
-        self._pers_rgb_ir = PERSP_IR_TO_RGB[None]
-        if serial in PERSP_IR_TO_RGB:
-            self._pers_rgb_ir = PERSP_IR_TO_RGB[serial]
-
-        crop = self._pers_rgb_ir[0][0]  # scaling by perspective projection
-        xsize, ysize = IR_SCREEN_SIZE  # given
-        xfov, yfov = IR_SCREEN_FOV  # given
-
-        self.px_to_deg = (xfov / xsize + yfov / ysize) / 2 * np.sin(crop)
-
-        self.xyz = xyz
-
-        self._interrupt = False
-
-        self.data = None
-        self.colmap = None
-
-        self.__refresh()
-
-    def __refresh(self, draw=False, autoscale=True):
-
-        r = PlotFrame._RES
-        d = -75 * r + 500
-        s = 0.5 * r
-        if self.colors is None:
-            r, s = r // 2, s / 16  # non-scatter
-
-        if self.winfo_viewable() and self.master.playing():
-
-            if not draw:
-
-                _, _, depmap = self.source()
-
-                self.colmap = depmap // 255  # gray
-                if self.colors is not None:
-                    _, self.colmap, _ = self.colors()
-                    self.colmap = self.colmap / 255  # rgb
-
-                a = len(depmap) // r
-                b = len(depmap[0]) // r
-                i = -1
-
-                davg = 0
-                result = []
-                x, y, z, c = [None] * a * b, [None] * a * b, [None] * a * b, [None] * a * b
-                for py in range(a):
-                    for px in range(b):
-                        i += 1
-                        iy, ix = py * r, px * r
-                        if depmap[iy][ix] < 0: continue  # value in valid range?
-                        x[i] = ix - b * r // 2
-                        y[i] = iy - a * r // 2
-                        z[i] = depmap[iy][ix]
-                        davg += z[i]
-                        c[i] = self.colmap[iy][ix]
-
-                        x[i] = np.tan(np.deg2rad(self.px_to_deg * x[i])) * z[i]
-                        y[i] = np.tan(np.deg2rad(self.px_to_deg * y[i])) * z[i]
-
-                        result.append((z[i], x[i], y[i], c[i]))
+        # frames are pushed by the display scheduler of the app
+        self.winfo_toplevel().display.register(self)
+
+    def visible(self):
+        viewable = self.winfo_viewable()
+        if not viewable:
+            # frames captured while hidden were not meant to be shown
+            self._count = 0
+        return viewable
+
+    def on_frame(self, slot):
+        img, arr, arg = self.source(slot)
+        if img is not None:
+            self.show(img, arr)
+
+    def destroy(self):
+        self.winfo_toplevel().display.unregister(self)
+        super().destroy()
+
+    def show(self, img, arr):
+        if img is self._image:  # nothing new since the last tick
+            return
+        self._image = img
+        count = self.device.image_count(self.key)
+        if self._count and count > self._count:
+            # captured frames of the stream that were never shown
+            self.dropped += count - self._count - 1
+        self._count = count
+        if self.resize["value"]:
+            img = PIL.Image.fromarray(open_cv.resize(arr, self.resize["size"]))
+        tk_img = self.canvas.tk_img
+        if tk_img is None or (tk_img.width(), tk_img.height()) != img.size:
+            logger.debug(f"new {self.key} photo image of size {img.size}")
+            tk_img = PIL.ImageTk.PhotoImage(image=img)
+            self.canvas.tk_img = tk_img
+            self.canvas.config(width=tk_img.width(), height=tk_img.height())
+            if self._canvas_item is None:
+                self._canvas_item = self.canvas.create_image(0, 0, image=tk_img, anchor=tk.NW)
+            else:
+                self.canvas.itemconfigure(self._canvas_item, image=tk_img)
+        else:
+            tk_img.paste(img)
+        self.displayed += 1
+        if self._overlay_item is not None:
+            self.__draw_overlay()
+        if self._region_items:
+            self.__draw_regions()
+
+    def set_overlay(self, points):
+        # points normalized to the image size, None hides the overlay
+        self._overlay = points
+        self.__draw_overlay()
+
+    def __draw_overlay(self):
+        tk_img = self.canvas.tk_img
+        if self._overlay is None or tk_img is None:
+            if self._overlay_item is not None:
+                self.canvas.itemconfigure(self._overlay_item, state=tk.HIDDEN)
+            return
+        coords = (np.asarray(self._overlay) * (tk_img.width(), tk_img.height())).ravel().tolist()
+        if self._overlay_item is None:
+            self._overlay_item = self.canvas.create_line(*coords, fill="lime", width=2)
+        else:
+            self.canvas.coords(self._overlay_item, *coords)
+            self.canvas.itemconfigure(self._overlay_item, state=tk.NORMAL)
+        self.canvas.tag_raise(self._overlay_item)
+
+    def set_regions(self, regions):
+        # rectangles normalized to the image size, empty hides them
+        regions = tuple(regions)
+        if regions == self._regions:
+            return
+        self._regions = regions
+        self.__draw_regions()
+
+    def __draw_regions(self):
+        for item in self._region_items:
+            self.canvas.delete(item)
+        self._region_items = []
+        tk_img = self.canvas.tk_img
+        if tk_img is None:
+            return
+        size = (tk_img.width(), tk_img.height()) * 2
+        for region in self._regions:
+            coords = (np.asarray(region) * size).tolist()
+            self._region_items.append(self.canvas.create_rectangle(*coords, outline="orange", fill="orange",
+                                                                   stipple="gray25", width=1))
+        if self._overlay_item is not None:
+            self.canvas.tag_raise(self._overlay_item)
 
-                if len(result) > 0:
+    def frame_stats(self):
+        return {"displayed": self.displayed, "dropped": self.dropped}
 
-                    dmax = davg / len(z) * 2
 
-                    if autoscale:
-                        xw = int(np.sin(np.deg2rad(IR_SCREEN_FOV[0] / 2)) * dmax * 2)
-                        yw = int(np.sin(np.deg2rad(IR_SCREEN_FOV[1] / 2)) * dmax * 2)
-                        if xw > 2 and yw > 2:
-                            self.ax.set_ylim(((-xw // 2), (+xw // 2)))
-                            self.ax.set_zlim(((+yw // 2), (-yw // 2)))
+class PlotFrame(View):
+    # point cloud preview of the depth stream, matplotlib is only imported when the view is created
 
-                    z, x, y, c = zip(*result)
-                    result = sorted(zip(z, x, y, c), reverse=True)  # sort by color
-                    self.data = list(zip(*result))  # z, x, y, c
+    def __init__(self, parent, device, stride=PC_STRIDE_DEFAULT, voxel=PC_VOXEL_DEFAULT, **kw):
+        View.__init__(self, parent, **kw)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
-            else:
+        self.device = device
+        self._stride = stride
+        self._voxel = voxel
+        self._cloud = None
+        self._points = None
 
-                if self._interrupt:
-                    self._interrupt = False
-                    self.after(max(REFRESH_RATE, d // 2), self.__refresh)
-                    return
+        self.figure = Figure(figsize=(6, 4.5))
+        self.ax = self.figure.add_subplot(projection="3d")
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
-                if len(self.data) > 0:
+        # slow consumer, served at most at 10 fps
+        self.max_refresh = REFRESH_RATE_10FPS
+        self.winfo_toplevel().display.register(self)
 
-                    z, x, y, c = self.data
+    def create_view(self):
+        pass
 
-                    # x, y, z = np.broadcast_arrays(*[np.ravel(np.ma.filled(t, np.nan)) for t in [x, y, z]])
-                    # points._offsets3d = (z, x, y)  # positions
-                    # points._sizes = [s] * len(c)   # sizes set_sizes()
-                    # points.set_array(np.array(c))  # colors setFacecolor(), set_edgecolor()
+    def update_language(self):
+        pass
 
-                    if self.colors is None:
-                        for lines in self.ax.lines:
-                            lines.remove()
-                        self.ax.plot(xs=z, ys=x, zs=y, marker='.', linestyle='', c='black', markersize=s)
-                    else:
-                        for child in self.ax.get_children():
-                            if isinstance(child, mpl3dart.Path3DCollection):
-                                child.remove()
-                        self.ax.scatter(xs=z, ys=x, zs=y, marker='.', cmap='jet', s=s, c=c)
-                        mpl.colors._colors_full_map.cache.clear()  # avoid memory leak by clearing the cache
+    def reset(self):
+        # the ray table changes with the device intrinsics
+        self._cloud = None
 
-                    self.__draw()
+    def visible(self):
+        return self.winfo_viewable()
 
-            self.after(max(REFRESH_RATE, d), self.__refresh, not draw)
+    def on_frame(self, slot):
+        if IB_DEPTH not in slot:
             return
+        d_min, d_max = self.device.depth_window()
+        if self._cloud is None:
+            self._cloud = PointCloud(self.device.ray_table(), self._stride, self._voxel)
+        self._cloud.d_min, self._cloud.d_max = d_min, d_max
+        xyz, rgb = self._cloud(slot[IB_DEPTH])
+        # depth along the plot x axis, mirrored like the image previews
+        xs, ys, zs = xyz[:, 2], -xyz[:, 0], -xyz[:, 1]
+        colors = rgb / NP_UINT8_MAX
+        if self._points is None:
+            self._points = self.ax.scatter(xs, ys, zs, marker=".", s=1, c=colors, depthshade=False)
+            self.ax.set_xlim(d_min, d_max)
+            self.ax.set_ylim(-d_max / 2, d_max / 2)
+            self.ax.set_zlim(-d_max / 2, d_max / 2)
+        else:
+            self._points._offsets3d = (xs, ys, zs)
+            self._points.set_facecolor(colors)
+            self._points.set_edgecolor(colors)
+        self.canvas.draw_idle()
 
-        self.after(max(REFRESH_RATE, d), self.__refresh, False)
+    def destroy(self):
+        self.winfo_toplevel().display.unregister(self)
+        super().destroy()
 
 
 class SelectedFileView(View):
@@ -1018,7 +1427,9 @@ class ScanView(View):
             PAS_START: lambda: self._man_start,
             PAS_STOP: lambda: self._man_stop,
             PAS_SEC_START: lambda: self._sec_start,
-            PAS_SEC_STOP: lambda: self._sec_stop
+            PAS_SEC_STOP: lambda: self._sec_stop,
+            PAS_FACE_CROP: lambda: self._face_crop,
+            PAS_FACE_DETECT: lambda: self._face_detect
         }
 
         self.update_language()
@@ -1113,6 +1524,14 @@ class ScanView(View):
         self._sec_progress = ttk.Progressbar(self.scrollFrame.viewPort, orient=tk.HORIZONTAL, length=200,
                                              mode='determinate')
 
+    def set_progress(self, value=None):
+        # fraction of a timed scan done, None hides the progress bar
+        if value is None:
+            self._sec_progress.grid_forget()
+            return
+        self._sec_progress.grid(column=0, row=20, columnspan=5)
+        self._sec_progress["value"] = value * 100
+
     def _has_scan(self):
         logger.debug("check if scan has been done")
         return self._project_info.getboolean(P_SCAN, P_DONE)